@@ -0,0 +1,74 @@
+# Copyright (C) [2015-2017] [Thomson Reuters LLC]
+# Copyright (C) [2015-2017] [Panos Kittenis]
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process caches"""
+
+from __future__ import absolute_import, print_function
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread safe, least recently used cache bounded by number of entries
+    and, optionally, by total weight of entries"""
+    __slots__ = ('maxsize', 'maxweight', 'weight', '_data', '_lock')
+
+    def __init__(self, maxsize, maxweight=None):
+        """
+        :param maxsize: Maximum number of entries
+        :param maxweight: (Optional) Maximum total weight of entries
+        """
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+        self.weight = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Return cached value for key or None"""
+        with self._lock:
+            try:
+                entry = self._data.pop(key)
+            except KeyError:
+                return
+            self._data[key] = entry
+            return entry[0]
+
+    def set(self, key, value, weight=1):
+        """Add value with weight to cache, evicting least recently used
+        entries while cache is over its limits.
+
+        Values heavier than maximum weight are not cached."""
+        if self.maxweight is not None and weight > self.maxweight:
+            return
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.weight -= entry[1]
+            self._data[key] = (value, weight)
+            self.weight += weight
+            while len(self._data) > self.maxsize or (
+                    self.maxweight is not None
+                    and self.weight > self.maxweight):
+                self.weight -= self._data.popitem(last=False)[1][1]
+
+    def clear(self):
+        """Clear cache"""
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
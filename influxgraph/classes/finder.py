@@ -20,39 +20,104 @@ compatible API.
 """
 
 from __future__ import absolute_import, print_function
+import os
+import re
 import json
 import threading
-from multiprocessing import Lock as processLock
+from multiprocessing import Lock as processLock, Pool
 import time
 import datetime
 import logging
 from logging.handlers import WatchedFileHandler
 from collections import deque
+from itertools import chain, islice
+from operator import attrgetter
+from io import BytesIO
 
 from influxdb import InfluxDBClient
 from graphite_api.node import BranchNode
 from ..constants import _INFLUXDB_CLIENT_PARAMS, \
      SERIES_LOADER_MUTEX_KEY, LOADER_LIMIT, MEMCACHE_SERIES_DEFAULT_TTL, \
-     DEFAULT_AGGREGATIONS, _MEMCACHE_FIELDS_KEY, FILL_PARAMS, FILE_LOCK
+     DEFAULT_AGGREGATIONS, _MEMCACHE_FIELDS_KEY, FILL_PARAMS, FILE_LOCK, \
+     FIND_CACHE_SIZE, FIND_CACHE_MAX_NODES, TAG_REGEX_MIN_VALUES, \
+     TAG_VALUES_MAX_NODES, TAG_VALUES_CACHE_SIZE
 from ..utils import calculate_interval, \
      get_aggregation_func, gen_memcache_key, gen_memcache_pattern_key, \
      get_retention_policy, _compile_aggregation_patterns, \
-     make_memcache_client
+     make_memcache_client, get_serie_paths, group_series_by_measurement, \
+     prefetch, gen_tag_sets_clause
 from ..templates import parse_influxdb_graphite_templates, apply_template, \
      TemplateMatchError
 try:
-    from ..ext.templates import parse_series, read_influxdb_values
+    from ..ext.templates import parse_series, read_influxdb_values, \
+        query_nodes, query_many_nodes, merge_index_file, compact_index
 except ImportError:
     from ..utils import parse_series, read_influxdb_values
+    from .matcher import query_nodes, query_many_nodes
+    merge_index_file = compact_index = None
 from .reader import InfluxDBReader
 from .leaf import InfluxDBLeafNode
-from .tree import NodeTreeIndex
 from .lock import FileLock
+from . import index_file
+from .index_file import MMapIndex, CompactIndex, IndexFileError
+from .tree import NodeTreeIndex
+from .cache import LRUCache
 
 _SERIES_LOADER_LOCK = processLock()
 
 logger = logging.getLogger('influxgraph')
 
+# InfluxDB duration literal, like 30d
+_DURATION = re.compile(r'^[0-9]+(ns|u|us|ms|s|m|h|d|w)$')
+# Characters of tag values that cannot be used in index query patterns
+_PATTERN_CHARS = frozenset('*?[]{},')
+
+
+def _has_pattern(value):
+    return not _PATTERN_CHARS.isdisjoint(value)
+
+
+class _SeriesLoadError(Exception):
+    """Raised on errors retrieving series list from InfluxDB"""
+    pass
+
+
+class FindResultsLimitError(Exception):
+    """Raised on find queries matching more nodes than configured maximum"""
+    pass
+
+
+def _get_series_fields(series, fields):
+    """Return field keys of measurements in batch of series"""
+    if fields is None:
+        return
+    page_fields = {}
+    for serie in series:
+        measurement = serie.split(',', 1)[0]
+        if measurement in fields:
+            page_fields[measurement] = fields[measurement]
+    return page_fields
+
+
+def _parse_series_batch(args):
+    """Build index of batch of series in worker process and return it in
+    binary index file format"""
+    series, fields, graphite_templates, separator = args
+    index = parse_series(series, fields, graphite_templates,
+                         separator=separator)
+    file_h = BytesIO()
+    # C extension index is dumped without node objects via compact index
+    index_file.dump(index if isinstance(index, NodeTreeIndex)
+                    else _make_compact_index(index), file_h)
+    return file_h.getvalue()
+
+
+def _make_compact_index(index):
+    """Make compact index from Python or C extension index"""
+    if compact_index is not None and not isinstance(index, NodeTreeIndex):
+        return compact_index(index)
+    return CompactIndex.from_index(index)
+
 
 class InfluxDBFinder(object):
     """Graphite-Api finder for InfluxDB.
@@ -65,7 +130,15 @@ class InfluxDBFinder(object):
                  'memcache_series_loader_mutex_key', 'memcache_fields_key',
                  'deltas', 'retention_policies', 'index', 'reader',
                  'index_lock', 'index_path', 'graphite_templates',
-                 'loader_limit', 'fill_param')
+                 'loader_limit', 'fill_param', 'index_mmap', 'index_compact',
+                 'index_incremental',
+                 'reindex_interval', 'index_series', 'index_generation',
+                 'find_cache', 'index_build_processes', 'index_file_mtime',
+                 'max_find_results', 'truncate_find_results',
+                 'index_trigram_min_children', 'series_horizon',
+                 'series_pruned', 'series_pruned_exact',
+                 'tag_regex_min_values',
+                 'tag_values_max_nodes', 'tag_values')
 
     def __init__(self, config):
         influxdb_config = config.get('influxdb', {})
@@ -102,6 +175,14 @@ class InfluxDBFinder(object):
         if not isinstance(self.loader_limit, int):
             raise Exception("Configured loader limit %s is not an integer",
                             self.loader_limit)
+        self.series_horizon = influxdb_config.get('series_horizon')
+        if self.series_horizon is not None and not _DURATION.match(
+                str(self.series_horizon)):
+            raise Exception("Configured series horizon %s is not an InfluxDB "
+                            "duration", self.series_horizon)
+        self.series_pruned = None
+        self.series_pruned_exact = influxdb_config.get(
+            'series_pruned_exact', False)
         self.deltas = influxdb_config.get('deltas', None)
         self.retention_policies = influxdb_config.get(
             'retention_policies', None)
@@ -113,7 +194,57 @@ class InfluxDBFinder(object):
         loader_startup_block = influxdb_config.get('loader_startup_block', True)
         self._start_loader(series_loader_interval, loader_startup_block)
         self.index = None
+        self.index_series = None
+        self.index_generation = 0
+        self.index_file_mtime = None
+        self.index_build_processes = influxdb_config.get(
+            'index_build_processes', 1)
+        if not isinstance(self.index_build_processes, int) or \
+           self.index_build_processes < 1:
+            raise Exception("Configured index build processes %s is not a "
+                            "positive integer", self.index_build_processes)
+        find_cache_size = influxdb_config.get('find_cache_size',
+                                              FIND_CACHE_SIZE)
+        self.find_cache = LRUCache(
+            find_cache_size, maxweight=influxdb_config.get(
+                'find_cache_max_nodes', FIND_CACHE_MAX_NODES)) \
+            if find_cache_size else None
+        self.max_find_results = influxdb_config.get('max_find_results', 0)
+        if not isinstance(self.max_find_results, int) or \
+           self.max_find_results < 0:
+            raise Exception("Configured max find results %s is not a "
+                            "non-negative integer", self.max_find_results)
+        self.truncate_find_results = influxdb_config.get(
+            'truncate_find_results', True)
+        self.tag_regex_min_values = influxdb_config.get(
+            'tag_regex_min_values', TAG_REGEX_MIN_VALUES)
+        if not isinstance(self.tag_regex_min_values, int) or \
+           self.tag_regex_min_values < 0:
+            raise Exception("Configured tag regex min values %s is not a "
+                            "non-negative integer", self.tag_regex_min_values)
+        self.tag_values_max_nodes = influxdb_config.get(
+            'tag_values_max_nodes', TAG_VALUES_MAX_NODES)
+        if not isinstance(self.tag_values_max_nodes, int) or \
+           self.tag_values_max_nodes < 0:
+            raise Exception("Configured tag values max nodes %s is not a "
+                            "non-negative integer", self.tag_values_max_nodes)
+        self.tag_values = LRUCache(TAG_VALUES_CACHE_SIZE)
         self.index_path = config.get('search_index')
+        self.index_mmap = influxdb_config.get('index_mmap', False)
+        if self.index_mmap and not self.index_path:
+            raise Exception("Memory mapped index requires search_index "
+                            "to be configured")
+        self.index_compact = influxdb_config.get('index_compact', False)
+        self.index_incremental = influxdb_config.get(
+            'index_incremental', False)
+        self.index_trigram_min_children = influxdb_config.get(
+            'index_trigram_min_children', 0)
+        if not isinstance(self.index_trigram_min_children, int) or \
+           self.index_trigram_min_children < 0:
+            raise Exception("Configured index trigram min children %s is not "
+                            "a non-negative integer",
+                            self.index_trigram_min_children)
+        self.reindex_interval = reindex_interval
         self.index_lock = FileLock(influxdb_config.get('index_lock_file',
                                                        FILE_LOCK))
         self.reader = InfluxDBReader(
@@ -165,17 +296,20 @@ class InfluxDBFinder(object):
         loader.start()
 
     def _start_reindexer(self, reindex_interval):
-        new_index = False
+        delay = reindex_interval
         if not self.index:
             self.load_index()
+            if self.index is not None:
+                # Serve from saved index until it is due to be re-built
+                delay = max(self.index_file_mtime + reindex_interval
+                            - time.time(), 0)
         if not self.index:
             self.build_index()
-            new_index = True
-        logger.debug("Starting reindexer thread with interval %s",
-                     reindex_interval)
+        logger.debug("Starting reindexer thread with interval %s, first "
+                     "re-index in %.0fs", reindex_interval, delay)
         reindexer = threading.Thread(target=self._reindex,
                                      kwargs={'interval': reindex_interval,
-                                             'new_index': new_index})
+                                             'delay': delay})
         reindexer.daemon = True
         reindexer.start()
 
@@ -213,7 +347,7 @@ class InfluxDBFinder(object):
         :type query: :mod:`graphite_api.storage.FindQuery` compatible class
         """
         memcache_key = gen_memcache_pattern_key("_".join([
-            '*', str(self.loader_limit), str(offset)]))
+            self._series_pattern(), str(self.loader_limit), str(offset)]))
         cached_series = self.memcache.get(memcache_key) \
             if self.memcache and cache else None
         if cached_series is not None:
@@ -226,10 +360,22 @@ class InfluxDBFinder(object):
                               min_compress_len=50)
         return series
 
+    def _series_pattern(self):
+        """Return pattern of series list for memcache keys - all series or
+        series with data within series horizon"""
+        if self.series_horizon is None:
+            return '*'
+        return '*_%s' % (self.series_horizon,)
+
     def _get_series(self, offset=0):
         memcache_key = gen_memcache_pattern_key("_".join([
-            '*', str(self.loader_limit), str(offset)]))
-        _query = "SHOW SERIES LIMIT %s OFFSET %s" % (self.loader_limit, offset,)
+            self._series_pattern(), str(self.loader_limit), str(offset)]))
+        # Time bounded series queries only look at shards with data within
+        # the horizon
+        _where = " WHERE time > now() - %s" % (self.series_horizon,) \
+            if self.series_horizon is not None else ""
+        _query = "SHOW SERIES%s LIMIT %s OFFSET %s" % (
+            _where, self.loader_limit, offset,)
         logger.debug("Series loader calling influxdb with query - %s", _query)
         data = self.client.query(_query, params=_INFLUXDB_CLIENT_PARAMS)
         series = [d.get('key') for k in data for d in k if d]
@@ -257,7 +403,8 @@ class InfluxDBFinder(object):
         # pylint: disable=unused-argument
         data = self.get_series(
             cache=cache, offset=offset)
-        return self._pagination_runner(data, '*', self.get_all_series,
+        return self._pagination_runner(data, self._series_pattern(),
+                                       self.get_all_series,
                                        limit=self.loader_limit,
                                        cache=cache,
                                        offset=offset)
@@ -266,7 +413,7 @@ class InfluxDBFinder(object):
                             *args, **kwargs):
         """Retrieve all series for series loader"""
         # pylint: disable=unused-argument
-        query_pattern = '*'
+        query_pattern = self._series_pattern()
         data = self._get_series(offset=offset)
         return self._pagination_runner(
             data, query_pattern, self.get_all_series_list,
@@ -324,13 +471,108 @@ class InfluxDBFinder(object):
             dt = datetime.datetime.now() - start_time
             logger.debug("Series list loader finished in %s", dt)
 
-    def find_nodes(self, query):
-        """Find and return nodes matching query
+    def _query_index(self, pattern):
+        index = self.index
+        if isinstance(index, (NodeTreeIndex, MMapIndex, CompactIndex)):
+            return index.query(pattern)
+        # C extension node trie - query with compiled matchers without
+        # holding the GIL
+        return query_nodes(index, pattern)
+
+    def _query_index_many(self, patterns):
+        index = self.index
+        if isinstance(index, (NodeTreeIndex, MMapIndex, CompactIndex)):
+            return index.query_many(patterns)
+        return query_many_nodes(index, patterns)
+
+    def _set_index(self, index):
+        """Set current index and invalidate find results of previous one"""
+        self.index = index
+        self._index_updated()
+
+    def _index_updated(self):
+        """Bump index generation and invalidate cached find results.
+
+        Must be called after current index is set"""
+        self.index_generation += 1
+        self.tag_values.clear()
+        if self.find_cache is not None:
+            self.find_cache.clear()
+
+    def find_nodes(self, query, offset=0, limit=None):
+        """Find and return nodes matching query, sorted by path.
+
+        Results are cached per index generation if find cache is enabled.
+
+        Nodes are looked up lazily - with a limit, matching stops once
+        offset plus limit nodes have been found.
 
         :param query: Query to search for
         :type query: :mod:`influxgraph.utils.Query`
+        :param offset: Number of matching nodes to skip
+        :type offset: int
+        :param limit: (Optional) Maximum number of nodes to return
+        :type limit: int
         """
-        node_paths = self.index.query(query.pattern)
+        stop = offset + limit if limit is not None else None
+        if self.find_cache is None:
+            return islice(self._find_nodes(query.pattern), offset, stop)
+        # Index is set before its generation is bumped so results cached
+        # under current generation never come from a previous index
+        key = (self.index_generation, query.pattern)
+        nodes = self.find_cache.get(key)
+        if nodes is None:
+            if stop is not None:
+                # Partial results are not cached
+                return islice(self._find_nodes(query.pattern), offset, stop)
+            nodes = list(self._find_nodes(query.pattern))
+            self.find_cache.set(key, nodes, weight=max(len(nodes), 1))
+        return islice(nodes, offset, stop)
+
+    def find_many_nodes(self, queries):
+        """Find nodes matching each of many queries, sorted by path.
+
+        Queries not in find cache are searched with one walk of the index
+        so that queries sharing path prefixes, like the targets of a
+        dashboard, only match their common prefix once.
+
+        :param queries: Queries to search for
+        :type queries: list of :mod:`influxgraph.utils.Query`
+        :rtype: dict of query pattern to list of matching nodes
+        """
+        results = {}
+        patterns = []
+        # Generation is read before index, as in `find_nodes`
+        generation = self.index_generation
+        for query in queries:
+            pattern = query.pattern
+            if pattern in results or pattern in patterns:
+                continue
+            nodes = self.find_cache.get((generation, pattern)) \
+                if self.find_cache is not None else None
+            if nodes is None:
+                patterns.append(pattern)
+            else:
+                results[pattern] = nodes
+        if not patterns:
+            return results
+        for pattern, node_paths in self._query_index_many(patterns).items():
+            if self.max_find_results:
+                node_paths = self._limit_find_results(pattern, node_paths)
+            nodes = list(self._make_nodes(node_paths))
+            if self.find_cache is not None:
+                self.find_cache.set((generation, pattern), nodes,
+                                    weight=max(len(nodes), 1))
+            results[pattern] = nodes
+        return results
+
+    def _find_nodes(self, pattern):
+        node_paths = self._query_index(pattern)
+        if self.max_find_results:
+            node_paths = self._limit_find_results(pattern, node_paths)
+        return self._make_nodes(node_paths)
+
+    def _make_nodes(self, node_paths):
         for path, node in node_paths:
             if node.is_leaf():
                 # Set path on existing reader to avoid having to create
@@ -342,6 +584,35 @@ class InfluxDBFinder(object):
             else:
                 yield BranchNode(path)
 
+    def _limit_find_results(self, pattern, node_paths):
+        """Limit number of nodes matched by query to configured maximum,
+        truncating results or raising :mod:`FindResultsLimitError`.
+
+        Index leaf counts, where available, are used to estimate matches so
+        that queries within the limit are found without walking all of their
+        matches. Without truncation, the limit is checked before results are
+        returned so that the error is raised by the find call itself."""
+        limit = self.max_find_results
+        index = self.index
+        if hasattr(index, 'estimate') and \
+           index.estimate(pattern, limit=limit) <= limit:
+            return node_paths
+        if not self.truncate_find_results:
+            node_paths = list(islice(node_paths, limit + 1))
+            if len(node_paths) > limit:
+                raise FindResultsLimitError(
+                    "Query %s matches more than %s nodes" % (pattern, limit))
+            return node_paths
+        return self._truncate_find_results(pattern, node_paths, limit)
+
+    def _truncate_find_results(self, pattern, node_paths, limit):
+        for i, node_path in enumerate(node_paths):
+            if i == limit:
+                logger.warning("Query %s matches more than %s nodes - "
+                               "truncating results", pattern, limit)
+                return
+            yield node_path
+
     def _gen_aggregation_func(self, paths):
         aggregation_funcs = list(set(get_aggregation_func(
             path, self.aggregation_functions) for path in paths))
@@ -352,90 +623,172 @@ class InfluxDBFinder(object):
         aggregation_func = aggregation_funcs[0]
         return aggregation_func
 
-    def _get_template_values_from_paths(self, paths, _filter, template,
-                                        default_tags, separator,
-                                        measurement_data):
-        _measurements = deque()
-        _tags = {}
-        _fields = deque()
-        matched_paths = deque()
-        for path in paths:
+    def _resolve_series(self, path, interned):
+        """Return (template index, measurement, tags, field) of series path
+        resolves to with first matching graphite template, or empty tuple if
+        no template matches.
+
+        Measurement, tags and field values are interned in `interned` dict so
+        that series of many paths share them"""
+        split_path = path.split('.')
+        for i, (_filter, template, default_tags, separator) in enumerate(
+                self.graphite_templates):
             if _filter and not _filter.match(path):
                 continue
             try:
                 measurement, tags, field = apply_template(
-                    path.split('.'), template, default_tags, separator)
+                    split_path, template, default_tags, separator)
             except TemplateMatchError:
                 continue
+            tags = tuple(interned.setdefault(tag, tag)
+                         for tag in tags.items())
+            return (i, interned.setdefault(measurement, measurement),
+                    interned.setdefault(tags, tags),
+                    interned.setdefault(field, field) if field else 'value')
+        return ()
+
+    def _get_node_series(self, node, interned):
+        """Return series of leaf node, resolving it once per node"""
+        series = getattr(node, 'series', None)
+        if series is None:
+            series = self._resolve_series(node.path, interned)
+            if isinstance(node, InfluxDBLeafNode):
+                node.series = series
+        return series
+
+    def _get_template_values(self, template_series, measurement_data):
+        """Return measurements, tag sets and fields to query for series of a
+        template and add series to measurement data.
+
+        Measurement data maps each series' (tag set, field) to its path so
+        that returned series are mapped to paths with a lookup"""
+        _measurements = deque()
+        _tag_sets = []
+        _fields = deque()
+        for path, (_, measurement, tags, field) in template_series:
             if measurement not in _measurements:
                 _measurements.append(measurement)
-            for tag in tags:
-                if tag not in _tags or tags[tag] not in _tags[tag]:
-                    _tags.setdefault(tag, []).append(tags[tag])
-            if not field:
-                field = 'value'
+            if tags:
+                _tag_sets.append(tags)
             if field not in _fields:
                 _fields.append(field)
-            matched_paths.append(path)
-            measurement_data.setdefault(measurement, {}).setdefault(
-                'paths', []).append(path)
-            if field not in measurement_data[measurement].setdefault(
-                    'fields', []):
-                measurement_data[measurement].setdefault(
-                    'fields', []).append(field)
-            measurement_data[measurement].setdefault(
-                'template', template)
-        return _measurements, _tags, _fields, matched_paths
-
-    def _get_all_template_values(self, paths):
-        paths = paths[:]
+            _measurement_data = measurement_data.setdefault(measurement, {})
+            _measurement_data.setdefault('tag_keys', set()).update(
+                tag for (tag, _) in tags)
+            _measurement_data.setdefault('series', {})[
+                (frozenset(tag for tag in tags if tag[1]), field)] = path
+            if field not in _measurement_data.setdefault('fields', []):
+                _measurement_data['fields'].append(field)
+        return _measurements, _tag_sets, _fields
+
+    def _get_all_template_values(self, nodes):
+        # Group series on template, in template order
+        series = {}
+        interned = {}
+        for node in nodes:
+            node_series = self._get_node_series(node, interned)
+            if node_series:
+                series.setdefault(node_series[0], []).append(
+                    (node.path, node_series))
         measurement_data = {}
         measurements, tags, fields = deque(), deque(), set()
-        for (_filter, template,
-             default_tags, separator) in self.graphite_templates:
+        for template_ind in sorted(series):
             # One influx measurement queried per template
-            if not paths:
-                break
-            _measurements, _tags, \
-                _fields, matched_paths = self._get_template_values_from_paths(
-                    paths, _filter, template, default_tags, separator,
-                    measurement_data)
-            if _measurements:
-                # Found template match for path, append query data and
-                # remove matched paths so we do not try to match them again
-                measurements.extend(_measurements)
-                if _tags:
-                    tags.append(_tags)
-                fields = fields.union(_fields)
-                for path in matched_paths:
-                    del paths[paths.index(path)]
+            _measurements, _tag_sets, _fields = self._get_template_values(
+                series[template_ind], measurement_data)
+            measurements.extend(_measurements)
+            if _tag_sets:
+                tags.append((template_ind, _tag_sets))
+            fields = fields.union(_fields)
         return measurements, tags, fields, measurement_data
 
+    def _get_index_names(self, pattern):
+        """Return names of index nodes matching pattern, or `None` if more
+        than configured maximum nodes match.
+
+        Names are cached per index generation"""
+        # Index is set before its generation is bumped so names cached under
+        # current generation never come from a previous index
+        key = (self.index_generation, pattern)
+        names = self.tag_values.get(key)
+        if names is None:
+            paths = [path for (path, _) in islice(
+                self._query_index(pattern), self.tag_values_max_nodes + 1)]
+            names = (frozenset(path.rsplit('.', 1)[-1] for path in paths)
+                     if len(paths) <= self.tag_values_max_nodes else None,)
+            self.tag_values.set(key, names)
+        return names[0]
+
+    def _get_tag_values(self, template_ind, tag, context):
+        """Return all values of tag of template in current index of series
+        with given values of other tags, or `None` if not known.
+
+        Values are names of index nodes at tag's path position, under index
+        nodes of values of other tags at preceding positions"""
+        _filter, template, _, _ = self.graphite_templates[template_ind]
+        positions = getattr(template, 'positions', {})
+        position = positions.get(tag)
+        if self.index is None or not position or len(position) != 1:
+            return
+        position = position[0]
+        parts = ['*' for _ in range(position + 1)]
+        for i, part in enumerate(_filter.pattern if _filter else []):
+            if i < position:
+                parts[i] = part
+        for context_tag, values in context:
+            context_position = positions.get(context_tag)
+            if not context_position or len(context_position) != 1 or \
+               context_position[0] >= position or \
+               any(_has_pattern(value) for value in values):
+                continue
+            parts[context_position[0]] = values[0] if len(values) == 1 \
+                else '{%s}' % (','.join(values),)
+        return self._get_index_names('.'.join(parts))
+
     def _gen_query(self, measurements, tags, fields, retention):
-        groupings = set([k for t in tags for k in t.keys()])
+        groupings = set([tag for (_, tag_sets) in tags
+                         for tag_set in tag_sets for (tag, _) in tag_set])
         measurements = ', '.join(
             ('"%s"."%s"' % (retention, measure,) for measure in measurements)) \
             if retention \
             else ', '.join(('"%s"' % (measure,) for measure in measurements))
-        _tags = ' OR '.join(['(%s)' % (tag_set,) for tag_set in [
-            ' AND '.join(['(%s)' % ' OR '.join([
-                """"%s" = '%s'""" % (tag, tag_val,)
-                for tag_val in __tags[tag]])
-                          for tag in __tags])
-            for __tags in tags]]) if tags else None
+        # Only requested tag sets of each template are selected, not the
+        # cross product of their tag values. Conditions of a single template
+        # are dropped for tags with all their known values requested
+        if len(tags) == 1 and self.tag_values_max_nodes:
+            template_ind = tags[0][0]
+            positions = getattr(
+                self.graphite_templates[template_ind][1], 'positions', {})
+
+            def known_values(tag, context):
+                return self._get_tag_values(template_ind, tag, context)
+
+            # Factor on tags in path order so that values of tags at
+            # preceding positions narrow down known values of the next
+            def tag_order(tag):
+                return positions.get(tag, [-1])[0]
+        else:
+            known_values = tag_order = None
+        _tags = [gen_tag_sets_clause(
+            tag_sets, regex_min_values=self.tag_regex_min_values,
+            known_values=known_values, tag_order=tag_order)
+                  for (_, tag_sets) in tags]
+        _tags = ' OR '.join(['(%s)' % (clause,) for clause in _tags]) \
+            if _tags and None not in _tags else None
         fields = fields if fields else ['value']
         return measurements, _tags, fields, groupings
 
-    def _gen_query_values_from_templates(self, paths, retention):
+    def _gen_query_values_from_templates(self, nodes, retention):
         measurements, tags, fields, measurement_data = \
-          self._get_all_template_values(paths)
+          self._get_all_template_values(nodes)
         measurements, tags, fields, groupings = self._gen_query(
             measurements, tags, fields, retention)
         return measurements, tags, fields, groupings, measurement_data
 
-    def _gen_query_values(self, paths, retention):
+    def _gen_query_values(self, nodes, retention):
         if self.graphite_templates:
-            return self._gen_query_values_from_templates(paths, retention)
+            return self._gen_query_values_from_templates(nodes, retention)
+        paths = [node.path for node in nodes]
         measurement = ', '.join(('"%s"."%s"' % (retention, path,)
                                  for path in paths)) if retention \
                       else ', '.join(('"%s"' % (path,)
@@ -458,13 +811,13 @@ class InfluxDBFinder(object):
             query_fields, measurements, where_clause, group_by,)
         return query
 
-    def _gen_influxdb_stmt(self, start_time, end_time, paths, interval,
+    def _gen_influxdb_stmt(self, start_time, end_time, nodes, interval,
                            aggregation_func):
         retention = get_retention_policy(interval, self.retention_policies) \
                     if self.retention_policies else None
         measurements, tags, fields, \
             groupings, measurement_data = self._gen_query_values(
-                paths, retention)
+                nodes, retention)
         query = self._gen_infl_stmt(measurements, tags, fields, groupings,
                                     start_time, end_time, aggregation_func,
                                     interval)
@@ -488,7 +841,9 @@ class InfluxDBFinder(object):
         time_info = start_time, end_time, interval
         if not nodes:
             return time_info, {}
-        paths = sorted([n.path for n in nodes if n.is_leaf])
+        leaf_nodes = sorted([n for n in nodes if n.is_leaf],
+                            key=attrgetter('path'))
+        paths = [n.path for n in leaf_nodes]
         if not len(paths) > 0:
             return self._make_empty_multi_fetch_result(
                 time_info, [n.path for n in nodes])
@@ -505,7 +860,8 @@ class InfluxDBFinder(object):
                      datetime.datetime.fromtimestamp(float(end_time)), interval)
         try:
             query, measurement_data = self._gen_influxdb_stmt(
-                start_time, end_time, paths, interval, aggregation_func)
+                start_time, end_time, leaf_nodes, interval,
+                aggregation_func)
         except TypeError as ex:
             logger.error("Type error generating query statement - %s", ex)
             return self._make_empty_multi_fetch_result(time_info, paths)
@@ -532,104 +888,471 @@ class InfluxDBFinder(object):
         data = json.load(open(data_file))['results'][0]['series'][0]['values']
         return [d for k in data for d in k if d]
 
-    def _reindex(self, new_index=False, interval=900):
-        """Perform re-index"""
-        save_thread = threading.Thread(target=self.save_index)
-        if new_index:
-            save_thread.start()
-        del new_index
+    def _reindex(self, interval=900, delay=None):
+        """Perform re-index every interval, first one after delay seconds if
+        given"""
         while True:
-            time.sleep(interval)
-            try:
-                save_thread.join()
-            except RuntimeError:
-                pass
-            finally:
-                del save_thread
+            time.sleep(interval if delay is None else delay)
+            delay = None
             try:
                 self.build_index()
             except Exception as ex:
                 logger.error("Error occured in reindexing thread - %s", ex)
-            save_thread = threading.Thread(target=self.save_index)
-            save_thread.start()
 
     def build_index(self, data=None, separator=b'.'):
-        """Build new node tree index
+        """Build new node tree index.
+
+        Without data, series are retrieved from InfluxDB page by page and
+        each page parsed into the new index while the next one is being
+        retrieved.
+
+        The new index is built privately and swapped in as current index
+        once complete so that queries never wait on index builds. With
+        incremental re-indexing enabled, changes since the previous build of
+        a tree index are applied to a copy of it that is swapped in the same
+        way - the current index is never modified.
+
+        With an index file configured, the index lock elects which process
+        builds. Other processes wait for the builder to publish its index
+        file and load that instead of building the same index again.
 
         :param data: (Optional) data to use to build index
         :type data: list
         """
         logger.info('Starting index build')
+        shared = not data and self.index_path is not None
+        if shared and self._reload_fresh_index_file():
+            return
+        locked = False
+        if shared:
+            locked = self.index_lock.acquire(blocking=False)
+            if not locked:
+                logger.info("Index build in progress in another process - "
+                            "waiting for index file %s", self.index_path)
+                locked = self.index_lock.acquire()
+                if self._reload_fresh_index_file():
+                    self.index_lock.release()
+                    return
         try:
-            data = self.get_all_series() if not data else data
-        except Exception as ex:
+            all_fields = self.get_field_keys() if self.graphite_templates \
+                else None
+            logger.info("Building index..")
+            start_time = datetime.datetime.now()
+            pages = self._split_pages(data) if data \
+                else prefetch(self._get_all_series_pages())
+            # Number of series indexed for counting series pruned by horizon
+            series_count = [0] if self.series_horizon is not None \
+                and not data else None
+            if series_count is not None:
+                pages = self._count_series(pages, series_count)
+            try:
+                self._build_index(pages, all_fields, separator)
+            except _SeriesLoadError as ex:
+                load_error = ex
+            else:
+                load_error = None
+        finally:
+            if locked:
+                self.index_lock.release()
+        if load_error is not None:
             logger.error("Error getting series list from InfluxDB - %s -"
-                         "Retrying after 30sec..", ex)
+                         "Retrying after 30sec..", load_error)
             time.sleep(30)
             return self.build_index()
-        all_fields = self.get_field_keys() if self.graphite_templates \
-            else None
-        with self.index_lock:
-            logger.info("Building index..")
-            start_time = datetime.datetime.now()
-            index = parse_series(data, all_fields, self.graphite_templates,
-                                 separator=separator)
-            self.index = index
         logger.info("Finished building index in %s",
                     datetime.datetime.now() - start_time)
+        if series_count is not None:
+            self.series_pruned = self._count_pruned_series(series_count[0])
+            logger.info("Indexed %s series with data in the last %s, pruned "
+                        "%s%s series", series_count[0], self.series_horizon,
+                        '' if self.series_pruned_exact else 'about ',
+                        self.series_pruned)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Index stats - %s", self.index_stats())
+
+    def _count_series(self, pages, series_count):
+        for page in pages:
+            series_count[0] += len(page)
+            yield page
+
+    def _count_pruned_series(self, indexed):
+        """Return number of series not indexed for having no data within
+        series horizon, from series cardinality of database, or None if
+        cardinality is not available.
+
+        Cardinality is estimated by InfluxDB unless exact count is
+        configured, as exact cardinality reads the series of all shards"""
+        query = 'SHOW SERIES EXACT CARDINALITY' if self.series_pruned_exact \
+            else 'SHOW SERIES CARDINALITY'
+        try:
+            data = self.client.query(query, params=_INFLUXDB_CLIENT_PARAMS)
+        except Exception as ex:
+            logger.warning("Could not get series cardinality to count "
+                           "pruned series - %s", ex)
+            return
+        total = sum(point.get('count', 0) for point in data.get_points())
+        return max(total - indexed, 0)
+
+    def _split_pages(self, data):
+        return (data[offset:offset + self.loader_limit]
+                for offset in range(0, len(data), self.loader_limit))
+
+    def _get_all_series_pages(self, cache=True):
+        """Generate pages of all series, up to loader limit series per page
+
+        :raises: :mod:`_SeriesLoadError` on errors retrieving series"""
+        offset = 0
+        while True:
+            try:
+                page = self.get_series(cache=cache, offset=offset)
+            except Exception as ex:
+                raise _SeriesLoadError(ex)
+            if page:
+                yield page
+            if len(page) < self.loader_limit:
+                self._store_last_offset(self._series_pattern(),
+                                        self.loader_limit, offset)
+                return
+            offset += self.loader_limit
+
+    def _build_index(self, pages, all_fields, separator):
+        """Build index from pages of series and publish it to queries and,
+        via index file, to other processes"""
+        if self._can_update_index():
+            measurements = {}
+            for page in pages:
+                group_series_by_measurement(page, measurements)
+            # Queries keep using current index while changes are applied
+            index = self.index.copy()
+            self._update_index(index, measurements, all_fields, separator)
+            self._index_trigrams(index)
+            self._set_index(index)
+            self.index_series = (index, measurements, all_fields)
+        else:
+            index, measurements = self._parse_series(
+                pages, all_fields, separator)
+            if self.index_mmap:
+                # Keep serving previous mapping until new file is written
+                self.save_index(index=index)
+                self._open_mmap_index()
+                return
+            if self.index_compact:
+                index = _make_compact_index(index)
+            self._index_trigrams(index)
+            self._set_index(index)
+            self.index_series = (index, measurements, all_fields) \
+                if measurements is not None else None
+        self.save_index()
+
+    def _index_trigrams(self, index):
+        """Build trigram index of child names of wide nodes of tree index,
+        if configured"""
+        if self.index_trigram_min_children and \
+           isinstance(index, NodeTreeIndex):
+            index.index_trigrams(self.index_trigram_min_children)
+
+    def _parse_series(self, pages, all_fields, separator):
+        """Parse pages of series into new index.
+
+        Returns new index and its series grouped by measurement if
+        incremental re-indexing is enabled and supported by index"""
+        # Empty index of the type parse_series builds
+        index = parse_series([], None, None)
+        # Only indexes that can be copied and support deletion can be
+        # updated incrementally
+        measurements = {} if self.index_incremental \
+            and not (self.index_mmap or self.index_compact) \
+            and hasattr(index, 'delete_split_path') \
+            and hasattr(index, 'copy') else None
+        pages = iter(pages)
+        first_page = next(pages, None)
+        if first_page is None:
+            return index, measurements
+        pages = chain([first_page], pages)
+        # More than one page of series
+        if self.index_build_processes > 1 and \
+           len(first_page) >= self.loader_limit:
+            try:
+                pool = Pool(processes=self.index_build_processes)
+            except Exception as ex:
+                logger.error("Error starting %s index build processes - %s - "
+                             "falling back to single process build",
+                             self.index_build_processes, ex)
+            else:
+                self._parse_series_parallel(
+                    pool, index, pages, all_fields, separator, measurements)
+                return index, measurements
+        # Field keys are split once per measurement for whole build
+        field_suffixes = {}
+        for page in pages:
+            if measurements is not None:
+                group_series_by_measurement(page, measurements)
+            parse_series(page, all_fields, self.graphite_templates,
+                         separator=separator, index=index,
+                         field_suffixes=field_suffixes)
+        return index, measurements
+
+    def _parse_series_parallel(self, pool, index, pages, all_fields,
+                               separator, measurements):
+        """Parse series in pool of processes and merge their indexes into
+        index.
+
+        Series are sharded by measurement, one shard per process, so that
+        shard indexes mostly cover separate branches and are grafted onto
+        index rather than merged path by path. Each shard is parsed in
+        batches of up to `loader_limit` series as pages are retrieved."""
+        shards = [[] for _ in range(self.index_build_processes)]
+        pending = deque()
+        try:
+            for page in pages:
+                if measurements is not None:
+                    group_series_by_measurement(page, measurements)
+                for serie in page:
+                    shards[hash(serie.split(',', 1)[0]) %
+                           len(shards)].append(serie)
+                del page
+                for i, shard in enumerate(shards):
+                    if len(shard) < self.loader_limit:
+                        continue
+                    pending.append(self._submit_shard(
+                        pool, shard, all_fields, separator))
+                    shards[i] = []
+                # Limit number of batches in flight
+                while len(pending) > self.index_build_processes:
+                    self._merge_index(index, pending.popleft().get())
+            for shard in shards:
+                if shard:
+                    pending.append(self._submit_shard(
+                        pool, shard, all_fields, separator))
+            del shards
+            while pending:
+                self._merge_index(index, pending.popleft().get())
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _submit_shard(self, pool, series, all_fields, separator):
+        return pool.apply_async(_parse_series_batch, ((
+            series, _get_series_fields(series, all_fields),
+            self.graphite_templates, separator),))
 
-    def _save_index_file(self, file_h):
+    def _merge_index(self, index, index_data):
+        """Merge index in binary index file format into index"""
+        if isinstance(index, NodeTreeIndex):
+            index.merge(index_file.load(BytesIO(index_data)))
+            return
+        merge_index_file(index, index_data)
+
+    def _can_update_index(self):
+        return not self.index_mmap and self.index_series is not None \
+            and self.index_series[0] is self.index
+
+    def _get_measurement_paths(self, measurement, series, all_fields,
+                               separator):
+        fields = {measurement: all_fields[measurement]} \
+            if all_fields and measurement in all_fields else {}
+        paths = set()
+        field_suffixes = {}
+        for serie in series:
+            paths.update(get_serie_paths(serie, fields,
+                                         self.graphite_templates,
+                                         separator=separator,
+                                         field_suffixes=field_suffixes))
+        return paths
+
+    def _update_index(self, index, measurements, all_fields, separator):
+        """Apply changes in series since previous index build to copy of
+        current index.
+
+        Only measurements whose series or field keys have changed are
+        re-parsed, deleting paths no longer produced by them and inserting
+        new ones."""
+        _, prev_measurements, prev_fields = self.index_series
+        deleted, inserted, changed = 0, 0, 0
+        for measurement in set(prev_measurements).union(measurements):
+            prev_series = prev_measurements.get(measurement, ())
+            series = measurements.get(measurement, ())
+            fields = all_fields.get(measurement) if all_fields else None
+            _prev_fields = prev_fields.get(measurement) \
+                if prev_fields else None
+            if series == prev_series and fields == _prev_fields:
+                continue
+            changed += 1
+            prev_paths = self._get_measurement_paths(
+                measurement, prev_series, prev_fields, separator)
+            paths = self._get_measurement_paths(
+                measurement, series, all_fields, separator)
+            for path in prev_paths.difference(paths):
+                if index.delete_split_path(path):
+                    deleted += 1
+            for path in paths.difference(prev_paths):
+                index.insert_split_path(list(path))
+                inserted += 1
+        logger.info("Updated index - %s changed measurements, "
+                    "%s paths inserted, %s paths deleted",
+                    changed, inserted, deleted)
+
+    def _save_index_file(self, file_h, index):
         """Dump tree contents to file handle"""
-        if self.index:
-            json.dump(self.index.to_array(), file_h)
+        if index:
+            index_file.dump(index, file_h)
+
+    def save_index(self, index=None):
+        """Save index to file.
 
-    def save_index(self):
-        """Save index to file"""
+        Index is written to a temporary file first and renamed to configured
+        index path once complete so that readers never see partially written
+        index files.
+
+        :param index: (Optional) Index to save. Defaults to current index
+        """
         if not self.index_path:
             return
-        if not (hasattr(self, 'index') and self.index
-                and hasattr(self.index, 'to_array')):
+        if index is None:
+            index = getattr(self, 'index', None)
+        if not index:
+            return
+        # Memory mapped index is already on disk
+        if isinstance(index, MMapIndex):
             return
         logger.info("Saving index to file %s", self.index_path,)
         start_time = datetime.datetime.now()
+        tmp_path = '%s.%s.tmp' % (self.index_path, os.getpid(),)
         try:
-            index_fh = open(self.index_path, 'wt')
-            self._save_index_file(index_fh)
-        except IOError as ex:
+            index_fh = open(tmp_path, 'wb')
+            try:
+                self._save_index_file(index_fh, index)
+            finally:
+                index_fh.close()
+            mtime = os.stat(tmp_path).st_mtime
+            os.rename(tmp_path, self.index_path)
+        except (IOError, OSError) as ex:
             logger.error("Error writing to index file %s - %s",
                          self.index_path, ex)
+            self._remove_tmp_index_file(tmp_path)
             return
         except Exception as ex:
             logger.error("Error saving index file %s - %s",
                          self.index_path, ex)
+            self._remove_tmp_index_file(tmp_path)
             raise
-        else:
-            index_fh.close()
+        self.index_file_mtime = mtime
         dt = datetime.datetime.now() - start_time
         logger.info("Wrote index file to %s in %s", self.index_path, dt)
 
+    def _remove_tmp_index_file(self, tmp_path):
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+    def _reload_fresh_index_file(self):
+        """Swap in index file as current index if it was written by
+        another process within the last re-index interval.
+
+        Returns True if fresh index file was swapped in"""
+        try:
+            mtime = os.stat(self.index_path).st_mtime
+        except OSError:
+            return False
+        if mtime < time.time() - self.reindex_interval:
+            return False
+        if self.index_mmap:
+            if isinstance(self.index, MMapIndex) and \
+               not self.index.is_stale():
+                return True
+        elif mtime == self.index_file_mtime:
+            # Written or already loaded by this process
+            return False
+        logger.info("Found index file %s written within last %ss, "
+                    "skipping index build", self.index_path,
+                    self.reindex_interval)
+        if self.index_mmap:
+            return self._open_mmap_index()
+        return self._load_index_file()
+
+    def _open_mmap_index(self):
+        """Memory map index file and swap it in as current index"""
+        try:
+            index = MMapIndex(self.index_path)
+        except (IOError, OSError, IndexFileError) as ex:
+            logger.error("Error opening index file %s - %s",
+                         self.index_path, ex)
+            return False
+        self._set_index(index)
+        self.index_file_mtime = index.file_id[3]
+        logger.info("Opened memory mapped index file %s", self.index_path)
+        return True
+
     def load_index(self):
         """Load index from file"""
         if not self.index_path:
             return
-        if not (self.index and hasattr(self.index, 'from_file')):
+        if self.index_mmap:
+            self._open_mmap_index()
             return
+        self._load_index_file()
+
+    def _load_index_file(self):
+        """Load index file into index of the implementation in use - compact
+        index if configured, C extension node trie if available - and swap it
+        in as current index.
+
+        Returns True if index file was loaded"""
+        if not os.path.isfile(self.index_path):
+            return False
         logger.info("Loading index from file %s", self.index_path,)
         try:
-            index_fh = open(self.index_path, 'rt')
+            index_fh = open(self.index_path, 'rb')
         except Exception as ex:
             logger.error("Error reading index file %s - %s",
                          self.index_path, ex)
-            return
+            return False
         try:
-            index = NodeTreeIndex.from_file(index_fh)
+            mtime = os.fstat(index_fh.fileno()).st_mtime
+            index = parse_series([], None, None)
+            if self.index_compact:
+                index = CompactIndex.from_file(index_fh)
+            elif isinstance(index, NodeTreeIndex):
+                index = index_file.load(index_fh)
+            else:
+                merge_index_file(index, index_fh.read())
         except Exception as ex:
             logger.error("Error loading index file - %s", ex)
-            return
+            return False
         finally:
             index_fh.close()
-        self.index = index
+        self._index_trigrams(index)
+        self._set_index(index)
+        self.index_file_mtime = mtime
         logger.info("Loaded index from disk")
+        return True
+
+    def index_stats(self):
+        """Return statistics of current index - representation, node, leaf
+        and stored node name counts, approximate size in bytes and number of
+        series pruned by series horizon on last build.
+
+        Name count and size are None for C extension node trie."""
+        index = self.index
+        if index is None:
+            return {}
+        if hasattr(index, 'stats'):
+            stats = index.stats()
+            stats['series_pruned'] = self.series_pruned
+            return stats
+        nodes, leaves = 1, 0
+        queue = deque([index])
+        while queue:
+            node = queue.popleft()
+            for child in node.children:
+                nodes += 1
+                if child.is_leaf():
+                    leaves += 1
+                queue.append(child)
+        return {'representation': 'nodetrie', 'nodes': nodes,
+                'leaves': leaves, 'strings': None, 'size': None,
+                'series_pruned': self.series_pruned}
 
     def get_field_keys(self):
         """Get field keys for all measurements"""
@@ -0,0 +1,627 @@
+# Copyright (C) [2015-2017] [Thomson Reuters LLC]
+# Copyright (C) [2015-2017] [Panos Kittenis]
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Binary on-disk format for metric path tree indexes.
+
+File layout, all integers little-endian:
+
+* Header - magic, format version, node and string counts, section offsets
+  and a CRC32 checksum of all data following the header
+* Node table - one ``(name id, first child, child count)`` record of
+  unsigned 32bit integers per node, breadth first starting with the root
+  node. Children of a node are stored contiguously, sorted by name. The
+  highest bit of name id is set for branch nodes whose own path was also
+  inserted as a leaf
+* Leaf counts - unsigned 32bit number of leaf nodes in each node's
+  sub-tree, in node table order
+* String offsets - ``string count + 1`` unsigned 32bit offsets into
+  string data
+* String data - de-duplicated, UTF-8 encoded node names
+
+Section offsets are fixed size so that the file can be memory mapped and
+read in place, see :mod:`MMapIndex`. The same layout is used in memory by
+:mod:`CompactIndex`.
+"""
+
+from __future__ import absolute_import, print_function
+import os
+import sys
+import mmap
+import struct
+import zlib
+from abc import ABCMeta, abstractmethod
+from array import array
+from collections import deque, namedtuple
+from io import BytesIO
+from operator import itemgetter
+
+from .tree import Node, NodeTreeIndex, _LeafBranchNode, _encode_bytes, \
+    _decode_str, _make_children
+from .matcher import compile_query, estimate_matches, search_many
+
+
+MAGIC = b'IGTI'
+FORMAT_VERSION = 3
+# Format versions that can be read. Version 2 has no leaf branch flag
+READ_FORMAT_VERSIONS = (2, 3)
+# magic, version, flags, node count, string count, node table offset,
+# leaf counts offset, string offsets offset, string data offset,
+# string data size, checksum
+_HEADER = struct.Struct('<4sHHIIQQQQQI4x')
+HEADER_SIZE = _HEADER.size
+_NODE_RECORD = struct.Struct('<III')
+_STRING_OFFSETS = struct.Struct('<II')
+_LEAF_COUNT = struct.Struct('<I')
+NODE_RECORD_SIZE = 12
+# Name id of root node
+NO_NAME = 0xFFFFFFFF
+# Name id flag of branch nodes also inserted as a leaf
+LEAF_BRANCH = 0x80000000
+_NAME_ID_MASK = 0x7FFFFFFF
+_MAX_UINT32 = 0xFFFFFFFF
+_UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+# Number of node table integers to buffer before writing
+_WRITE_CHUNK = 3 * 65536
+_CRC_CHUNK = 1024 * 1024
+
+IndexFileHeader = namedtuple(
+    'IndexFileHeader', ['version', 'flags', 'node_count', 'string_count',
+                        'nodes_offset', 'leaves_offset', 'offsets_offset',
+                        'data_offset',
+                        'data_size', 'checksum'])
+
+
+class IndexFileError(Exception):
+    """Raised on invalid, corrupt or unsupported index files"""
+    pass
+
+
+def _array_to_bytes(arr):
+    if sys.byteorder != 'little':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    try:
+        return arr.tobytes()
+    except AttributeError:
+        return arr.tostring()
+
+
+def _array_from_bytes(data):
+    arr = array(_UINT32)
+    try:
+        arr.frombytes(data)
+    except AttributeError:
+        arr.fromstring(data)
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    return arr
+
+
+def _get_leaf_counts(child_counts):
+    """Return leaf counts of sub-trees of nodes in breadth first order from
+    their child counts"""
+    leaf_counts = array(_UINT32, [0]) * len(child_counts)
+    # Children of nodes are contiguous and in the same order as their
+    # parents - walk backwards from the last node's children
+    end = len(child_counts)
+    for node_id in range(len(child_counts) - 1, 0, -1):
+        child_count = child_counts[node_id]
+        if not child_count:
+            leaf_counts[node_id] = 1
+            continue
+        start = end - child_count
+        leaf_counts[node_id] = sum(leaf_counts[start:end])
+        end = start
+    # Root node of empty index is not a leaf
+    leaf_counts[0] = sum(leaf_counts[1:end])
+    return leaf_counts
+
+
+def _get_root(index):
+    return index.index if isinstance(index, NodeTreeIndex) else index
+
+
+def _get_children(node):
+    """Return (name bytes, child node) list of Python or C index node"""
+    if isinstance(node, Node):
+        return list(node.child_items()) if node.children else []
+    return [(_encode_bytes(child.name), child) for child in node.children]
+
+
+class _Writer(object):
+    """Stream writer with running checksum of written data"""
+    __slots__ = ('file_h', 'checksum', 'size')
+
+    def __init__(self, file_h):
+        self.file_h = file_h
+        self.checksum = 0
+        self.size = 0
+
+    def write(self, data):
+        self.file_h.write(data)
+        self.checksum = zlib.crc32(data, self.checksum) & 0xFFFFFFFF
+        self.size += len(data)
+
+
+def dump(index, file_h):
+    """Write index to binary, seekable file handle.
+
+    Nodes are written as they are visited so that the complete index is never
+    copied in memory. Node names are interned in the file's string table.
+
+    :param index: Index to write
+    :type index: :mod:`influxgraph.classes.tree.NodeTreeIndex`,
+      :mod:`CompactIndex` or :mod:`influxgraph.ext.nodetrie.Node`
+    :param file_h: File handle opened in binary write mode
+    """
+    if isinstance(index, CompactIndex):
+        return _dump_compact(index, file_h)
+    start = file_h.tell()
+    file_h.write(b'\x00' * HEADER_SIZE)
+    writer = _Writer(file_h)
+    strings = {}
+    string_offsets = array(_UINT32, [0])
+    string_data = []
+    string_size = 0
+    records = array(_UINT32)
+    child_counts = array(_UINT32)
+    next_child = 1
+    queue = deque([(NO_NAME, _get_root(index))])
+    while queue:
+        name_id, node = queue.popleft()
+        children = _get_children(node)
+        if children:
+            children.sort(key=itemgetter(0))
+        records.extend((name_id, next_child if children else 0,
+                        len(children)))
+        child_counts.append(len(children))
+        next_child += len(children)
+        for name, child in children:
+            try:
+                child_name_id = strings[name]
+            except KeyError:
+                child_name_id = strings[name] = len(strings)
+                string_data.append(name)
+                string_size += len(name)
+                string_offsets.append(string_size)
+            if isinstance(child, _LeafBranchNode):
+                child_name_id |= LEAF_BRANCH
+            queue.append((child_name_id, child))
+        if len(records) >= _WRITE_CHUNK:
+            writer.write(_array_to_bytes(records))
+            records = array(_UINT32)
+    if next_child > _MAX_UINT32 or string_size > _MAX_UINT32 \
+       or len(strings) > _NAME_ID_MASK:
+        raise IndexFileError(
+            "Index too large for format version %s" % (FORMAT_VERSION,))
+    writer.write(_array_to_bytes(records))
+    del records
+    nodes_size = writer.size
+    writer.write(_array_to_bytes(_get_leaf_counts(child_counts)))
+    del child_counts
+    offsets_offset = HEADER_SIZE + writer.size
+    writer.write(_array_to_bytes(string_offsets))
+    data_offset = HEADER_SIZE + writer.size
+    for i in range(0, len(string_data), _WRITE_CHUNK):
+        writer.write(b''.join(string_data[i:i + _WRITE_CHUNK]))
+    end = file_h.tell()
+    file_h.seek(start)
+    file_h.write(_HEADER.pack(
+        MAGIC, FORMAT_VERSION, 0, next_child, len(strings),
+        HEADER_SIZE, HEADER_SIZE + nodes_size, offsets_offset, data_offset,
+        string_size, writer.checksum))
+    file_h.seek(end)
+
+
+def _dump_compact(index, file_h):
+    """Write compact index, already in index file layout, to file handle"""
+    start = file_h.tell()
+    file_h.write(b'\x00' * HEADER_SIZE)
+    writer = _Writer(file_h)
+    node_count = len(index.child_counts)
+    records = array(_UINT32, [0]) * (3 * node_count)
+    records[0::3] = index.name_ids
+    records[1::3] = index.first_children
+    records[2::3] = index.child_counts
+    writer.write(_array_to_bytes(records))
+    del records
+    nodes_size = writer.size
+    writer.write(_array_to_bytes(index.leaf_counts))
+    offsets_offset = HEADER_SIZE + writer.size
+    string_offsets = array(_UINT32, [0])
+    string_size = 0
+    for name in index.names:
+        string_size += len(name)
+        string_offsets.append(string_size)
+    writer.write(_array_to_bytes(string_offsets))
+    data_offset = HEADER_SIZE + writer.size
+    for i in range(0, len(index.names), _WRITE_CHUNK):
+        writer.write(b''.join(index.names[i:i + _WRITE_CHUNK]))
+    end = file_h.tell()
+    file_h.seek(start)
+    file_h.write(_HEADER.pack(
+        MAGIC, FORMAT_VERSION, 0, node_count, len(index.names),
+        HEADER_SIZE, HEADER_SIZE + nodes_size, offsets_offset, data_offset,
+        string_size, writer.checksum))
+    file_h.seek(end)
+
+
+def read_header(buf):
+    """Read and validate index file header from buffer
+
+    :param buf: Buffer with index file contents, eg :mod:`mmap.mmap`
+    :raises: :mod:`IndexFileError` on invalid header
+
+    :rtype: :mod:`IndexFileHeader`
+    """
+    if len(buf) < HEADER_SIZE:
+        raise IndexFileError("Index file too short for header")
+    fields = _HEADER.unpack_from(buf, 0)
+    if fields[0] != MAGIC:
+        raise IndexFileError("Not an index file - bad magic %r" % (
+            fields[0],))
+    header = IndexFileHeader(*fields[1:])
+    if header.version not in READ_FORMAT_VERSIONS:
+        raise IndexFileError("Unsupported index file version %s" % (
+            header.version,))
+    if header.node_count < 1 \
+       or header.leaves_offset != header.nodes_offset + \
+       header.node_count * NODE_RECORD_SIZE \
+       or header.offsets_offset != header.leaves_offset + \
+       header.node_count * 4 \
+       or header.data_offset != header.offsets_offset + \
+       (header.string_count + 1) * 4 \
+       or header.data_offset + header.data_size > len(buf):
+        raise IndexFileError("Index file sections are truncated or invalid")
+    return header
+
+
+def verify_checksum(buf, header):
+    """Check buffer contents against header checksum
+
+    :raises: :mod:`IndexFileError` on checksum mismatch"""
+    checksum = 0
+    end = header.data_offset + header.data_size
+    for offset in range(HEADER_SIZE, end, _CRC_CHUNK):
+        checksum = zlib.crc32(
+            buf[offset:min(offset + _CRC_CHUNK, end)], checksum)
+    if checksum & 0xFFFFFFFF != header.checksum:
+        raise IndexFileError("Index file checksum mismatch")
+
+
+def read_strings(buf, header):
+    """Return list of string table entries as bytes"""
+    offsets = _array_from_bytes(
+        buf[header.offsets_offset:header.data_offset])
+    data = buf[header.data_offset:header.data_offset + header.data_size]
+    return [data[offsets[i]:offsets[i+1]]
+            for i in range(header.string_count)]
+
+
+def load(file_h):
+    """Load index file into a new Python tree index
+
+    :param file_h: File handle opened in binary read mode
+    :raises: :mod:`IndexFileError` on invalid or corrupt index file
+
+    :rtype: :mod:`influxgraph.classes.tree.NodeTreeIndex`
+    """
+    buf = file_h.read()
+    header = read_header(buf)
+    verify_checksum(buf, header)
+    names = read_strings(buf, header)
+    records = _array_from_bytes(buf[header.nodes_offset:header.leaves_offset])
+    leaf_counts = _array_from_bytes(
+        buf[header.leaves_offset:header.offsets_offset])
+    del buf
+    nodes = [Node() for _ in range(header.node_count)]
+    for i, node in enumerate(nodes):
+        first_child, child_count = records[3*i+1], records[3*i+2]
+        if child_count:
+            node.children = _make_children(
+                [(names[records[3*child] & _NAME_ID_MASK], nodes[child])
+                 for child in range(first_child, first_child + child_count)])
+            node.leaves = leaf_counts[i]
+            if i and records[3*i] & LEAF_BRANCH:
+                node.__class__ = _LeafBranchNode
+    index = NodeTreeIndex()
+    index.index = nodes[0]
+    return index
+
+
+def read_paths(buf):
+    """Return generator of split leaf paths in index file buffer without
+    building index nodes. Paths of branches also inserted as leaves are
+    included
+
+    :param buf: Index file contents
+    :type buf: bytes
+    :raises: :mod:`IndexFileError` on invalid or corrupt index file
+
+    :rtype: generator of list(unicode str)
+    """
+    header = read_header(buf)
+    verify_checksum(buf, header)
+    names = [_decode_str(name) for name in read_strings(buf, header)]
+    records = _array_from_bytes(buf[header.nodes_offset:header.leaves_offset])
+    stack = [(0, [])]
+    while stack:
+        node_id, split_path = stack.pop()
+        first_child, child_count = records[3*node_id+1], records[3*node_id+2]
+        if node_id and (not child_count or records[3*node_id] & LEAF_BRANCH):
+            yield split_path
+        # Push in reverse so that paths are generated in sorted order
+        for child in range(first_child + child_count - 1, first_child - 1, -1):
+            stack.append((child, split_path + [
+                names[records[3*child] & _NAME_ID_MASK]]))
+
+
+class IndexFileNode(object):
+    """Node of a memory mapped index file"""
+    __slots__ = ('node_id', 'children_size')
+
+    def __init__(self, node_id, children_size):
+        self.node_id = node_id
+        self.children_size = children_size
+
+    def is_leaf(self):
+        """Returns True/False depending on whether node has children"""
+        return self.children_size == 0
+
+
+# Python 2 and 3 compatible abstract base class
+_ABC = ABCMeta('_ABC', (object,), {'__slots__': ()})
+
+
+class _PackedIndex(_ABC):
+    """Base class of read-only indexes in index file layout - interned node
+    names and a breadth first node table with each node's children stored
+    contiguously, sorted by name.
+
+    Sub-classes provide node records and names by node id."""
+    __slots__ = ()
+
+    @abstractmethod
+    def _record(self, node_id):
+        """Return (name id, first child, child count) record of node. Name id
+        includes :mod:`LEAF_BRANCH` flag"""
+
+    @abstractmethod
+    def _name(self, node_id):
+        """Return name of node as bytes"""
+
+    @abstractmethod
+    def _leaf_count(self, node_id):
+        """Return number of leaf nodes in sub-tree of node"""
+
+    def _lower_bound(self, name, first_child, end):
+        # Children are sorted by name - binary search for first child
+        # not less than name
+        low, high = first_child, end
+        while low < high:
+            mid = (low + high) // 2
+            if self._name(mid) < name:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _get_matched_children(self, matcher, node_id):
+        _, first_child, child_count = self._record(node_id)
+        if not child_count:
+            return []
+        end = first_child + child_count
+        if matcher.literals is not None:
+            matched = []
+            for literal in matcher.literals:
+                name = _encode_bytes(literal)
+                child = self._lower_bound(name, first_child, end)
+                if child < end and self._name(child) == name:
+                    matched.append((literal, child))
+            return matched
+        prefix = _encode_bytes(matcher.prefix)
+        if prefix:
+            first_child = self._lower_bound(prefix, first_child, end)
+        matched = []
+        for child in range(first_child, end):
+            name = self._name(child)
+            if prefix and not name.startswith(prefix):
+                break
+            name = _decode_str(name)
+            if matcher.match(name):
+                matched.append((name, child))
+        return matched
+
+    def query(self, query):
+        """Return nodes matching Graphite glob pattern query.
+
+        Children are stored sorted by name so results are generated in
+        sorted order without materialising them first."""
+        return (('.'.join(path), node,)
+                for path, node in self.search(0, compile_query(query), []))
+
+    def query_many(self, queries):
+        """Return nodes matching each of many Graphite glob pattern queries
+        with one walk of the index. See
+        :mod:`influxgraph.classes.matcher.search_many`
+
+        :rtype: dict of query to list of (path, node) tuples sorted by path
+        """
+        return search_many(0, queries, self._get_matched_children,
+                           make_node=self._make_node)
+
+    def _make_node(self, node_id):
+        return IndexFileNode(node_id, self._record(node_id)[2])
+
+    def estimate(self, query, limit=None):
+        """Return upper bound of number of nodes matching query from leaf
+        counts, exact if all levels of query are walked. See
+        :mod:`influxgraph.classes.matcher.estimate_matches`"""
+        return estimate_matches(0, compile_query(query),
+                                self._get_matched_children,
+                                self._leaf_count, limit=limit)
+
+    def search(self, node_id, split_query, split_path):
+        """Return matching children for each compiled query matcher in split
+        query starting from given node id"""
+        matcher = split_query[0]
+        child_query = split_query[1:]
+        for child_name, child_id in self._get_matched_children(
+                matcher, node_id):
+            child_path = split_path[:]
+            child_path.append(child_name)
+            if len(child_query) > 0:
+                for sub in self.search(child_id, child_query, child_path):
+                    yield sub
+            else:
+                yield (child_path, self._make_node(child_id))
+
+
+class MMapIndex(_PackedIndex):
+    """Read-only index that answers queries directly from a memory mapped
+    index file without de-serialising it.
+
+    Memory mapped pages are shared via the page cache by all processes
+    reading the same index file. Index files are replaced by renaming a new
+    file into place - an open index keeps reading the file it was opened with
+    until it is garbage collected.
+    """
+    __slots__ = ('path', 'buf', 'header', 'file_id')
+
+    def __init__(self, path, verify=False):
+        """
+        :param path: Path of index file to map
+        :param verify: Verify index file checksum on open. Requires reading
+          the whole file
+        :raises: :mod:`IndexFileError` on invalid index file
+        """
+        self.path = path
+        with open(path, 'rb') as file_h:
+            stat = os.fstat(file_h.fileno())
+            if stat.st_size < HEADER_SIZE:
+                raise IndexFileError("Index file too short for header")
+            self.buf = mmap.mmap(file_h.fileno(), 0, access=mmap.ACCESS_READ)
+        self.file_id = (stat.st_dev, stat.st_ino, stat.st_size,
+                        stat.st_mtime)
+        self.header = read_header(self.buf)
+        if verify:
+            verify_checksum(self.buf, self.header)
+
+    def is_stale(self):
+        """Check if index file on disk has been replaced since it was
+        opened"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_dev, stat.st_ino, stat.st_size,
+                stat.st_mtime) != self.file_id
+
+    def _record(self, node_id):
+        return _NODE_RECORD.unpack_from(
+            self.buf, self.header.nodes_offset + node_id * NODE_RECORD_SIZE)
+
+    def _name(self, node_id):
+        name_id = _NODE_RECORD.unpack_from(
+            self.buf,
+            self.header.nodes_offset + node_id * NODE_RECORD_SIZE)[0] \
+            & _NAME_ID_MASK
+        start, end = _STRING_OFFSETS.unpack_from(
+            self.buf, self.header.offsets_offset + name_id * 4)
+        data_offset = self.header.data_offset
+        return self.buf[data_offset + start:data_offset + end]
+
+    def _leaf_count(self, node_id):
+        return _LEAF_COUNT.unpack_from(
+            self.buf, self.header.leaves_offset + node_id * 4)[0]
+
+    def stats(self):
+        """Return index statistics - representation, node, leaf and
+        interned name counts and size of mapped file in bytes"""
+        return {'representation': 'mmap',
+                'nodes': self.header.node_count,
+                'leaves': self._leaf_count(0),
+                'strings': self.header.string_count,
+                'size': len(self.buf)}
+
+
+class CompactIndex(_PackedIndex):
+    """Read-only index with node names interned in a single string table and
+    nodes stored as parallel arrays of name id, first child and child count.
+
+    Uses a fraction of the memory of an index with a node object and name
+    per node, at the cost of not supporting updates - a new compact index is
+    made from each newly built index.
+    """
+    __slots__ = ('names', 'name_ids', 'first_children', 'child_counts',
+                 'leaf_counts')
+
+    def __init__(self, names, name_ids, first_children, child_counts,
+                 leaf_counts):
+        self.names = names
+        self.name_ids = name_ids
+        self.first_children = first_children
+        self.child_counts = child_counts
+        self.leaf_counts = leaf_counts
+
+    @staticmethod
+    def from_file(file_h):
+        """Load compact index from index file handle
+
+        :raises: :mod:`IndexFileError` on invalid or corrupt index file
+        """
+        buf = file_h.read()
+        header = read_header(buf)
+        verify_checksum(buf, header)
+        names = read_strings(buf, header)
+        records = _array_from_bytes(
+            buf[header.nodes_offset:header.leaves_offset])
+        leaf_counts = _array_from_bytes(
+            buf[header.leaves_offset:header.offsets_offset])
+        del buf
+        return CompactIndex(names, records[0::3], records[1::3],
+                            records[2::3], leaf_counts)
+
+    @staticmethod
+    def from_index(index):
+        """Make compact index from Python or C extension index"""
+        file_h = BytesIO()
+        dump(index, file_h)
+        file_h.seek(0)
+        return CompactIndex.from_file(file_h)
+
+    def _record(self, node_id):
+        return (self.name_ids[node_id], self.first_children[node_id],
+                self.child_counts[node_id])
+
+    def _name(self, node_id):
+        return self.names[self.name_ids[node_id] & _NAME_ID_MASK]
+
+    def _leaf_count(self, node_id):
+        return self.leaf_counts[node_id]
+
+    def stats(self):
+        """Return index statistics - representation, node, leaf and
+        interned name counts and approximate size in bytes"""
+        size = sys.getsizeof(self.names) + sum(
+            sys.getsizeof(name) for name in self.names) + sum(
+                arr.itemsize * len(arr) for arr in (
+                    self.name_ids, self.first_children, self.child_counts,
+                    self.leaf_counts))
+        return {'representation': 'compact',
+                'nodes': len(self.child_counts),
+                'leaves': self.leaf_counts[0],
+                'strings': len(self.names),
+                'size': size}
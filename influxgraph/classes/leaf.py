@@ -20,5 +20,15 @@ from graphite_api.node import LeafNode
 
 
 class InfluxDBLeafNode(LeafNode):
-    """Tell Graphite-Api that our leaf node supports multi-fetch"""
+    """Tell Graphite-Api that our leaf node supports multi-fetch.
+
+    Leaf nodes keep the InfluxDB series they resolve to via graphite
+    templates - template index, measurement, tags and field - once resolved,
+    so that fetching data for the same node objects again, as returned from
+    find cache, does not require template matching."""
+    __slots__ = ('series',)
     __fetch_multi__ = 'influxdb'
+
+    def __init__(self, path, reader):
+        super(InfluxDBLeafNode, self).__init__(path, reader)
+        self.series = None
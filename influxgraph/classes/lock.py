@@ -1,3 +1,4 @@
+import errno
 import fcntl
 import logging
 
@@ -16,8 +17,22 @@ class FileLock(object):
                             self.filename,)
             raise
 
-    def acquire(self):
-        fcntl.flock(self.handle, fcntl.LOCK_EX)
+    def acquire(self, blocking=True):
+        """Acquire lock, waiting for it to be released by other processes
+        if blocking.
+
+        Returns True if lock was acquired, False if not blocking and lock
+        is held by another process"""
+        if blocking:
+            fcntl.flock(self.handle, fcntl.LOCK_EX)
+            return True
+        try:
+            fcntl.flock(self.handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as ex:
+            if ex.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
 
     def release(self):
         fcntl.flock(self.handle, fcntl.LOCK_UN)
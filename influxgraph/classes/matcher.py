@@ -0,0 +1,345 @@
+# Copyright (C) [2015-2017] [Thomson Reuters LLC]
+# Copyright (C) [2015-2017] [Panos Kittenis]
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compiled Graphite glob pattern matchers for index queries.
+
+Queries are split on path separator and each sub-part compiled once into a
+matcher with the same semantics as graphite-api's `match_entries`. Compiled
+queries are kept in a bounded LRU cache so that frequently repeated queries
+are not re-parsed.
+
+Matchers provide the literal values they match, if any, the literal prefix
+of names they can match and literal sub-strings all names they match must
+contain, for indexes to narrow down candidate names before matching.
+"""
+
+from __future__ import absolute_import, print_function
+import re
+import fnmatch
+from operator import attrgetter
+from os.path import commonprefix
+
+from .cache import LRUCache
+
+# Number of compiled queries to keep
+QUERY_CACHE_SIZE = 1024
+_WILDCARDS = '*?['
+
+
+class LiteralMatcher(object):
+    """Matches a literal path sub-part"""
+    __slots__ = ('literals', 'prefix', 'substrings')
+
+    def __init__(self, value):
+        self.literals = (value,)
+        self.prefix = value
+        self.substrings = (value,)
+
+    def match(self, name):
+        return name == self.prefix
+
+
+class AnyMatcher(object):
+    """Matches any path sub-part - '*'"""
+    __slots__ = ('literals', 'prefix', 'substrings')
+
+    def __init__(self):
+        self.literals = None
+        self.prefix = ''
+        self.substrings = ()
+
+    def match(self, name):
+        return True
+
+
+class PrefixMatcher(object):
+    """Matches path sub-parts starting with literal prefix - 'prefix*'"""
+    __slots__ = ('literals', 'prefix', 'substrings')
+
+    def __init__(self, prefix):
+        self.literals = None
+        self.prefix = prefix
+        self.substrings = (prefix,)
+
+    def match(self, name):
+        return name.startswith(self.prefix)
+
+
+class SuffixMatcher(object):
+    """Matches path sub-parts ending with literal suffix - '*suffix'"""
+    __slots__ = ('literals', 'prefix', 'substrings', 'suffix')
+
+    def __init__(self, suffix):
+        self.literals = None
+        self.prefix = ''
+        self.substrings = (suffix,)
+        self.suffix = suffix
+
+    def match(self, name):
+        return name.endswith(self.suffix)
+
+
+class AlternationMatcher(object):
+    """Matches any one of literal alternatives - '{a,b}'"""
+    __slots__ = ('literals', 'prefix', 'substrings', 'values')
+
+    def __init__(self, values):
+        self.values = frozenset(values)
+        self.literals = tuple(sorted(self.values))
+        self.prefix = commonprefix(self.literals)
+        self.substrings = (self.prefix,) if self.prefix else ()
+
+    def match(self, name):
+        return name in self.values
+
+
+class PatternMatcher(object):
+    """Matches path sub-parts with compiled regular expression of glob
+    pattern - character classes, '?' and other combinations of wildcards"""
+    __slots__ = ('literals', 'prefix', 'substrings', 'regex')
+
+    def __init__(self, patterns):
+        self.literals = None
+        self.prefix = commonprefix([_get_literal_prefix(pattern)
+                                    for pattern in patterns])
+        # Only sub-strings required by all alternatives can be used
+        self.substrings = _get_literal_runs(patterns[0]) \
+            if len(patterns) == 1 else \
+            ((self.prefix,) if self.prefix else ())
+        self.regex = re.compile('|'.join(
+            fnmatch.translate(pattern) for pattern in patterns))
+
+    def match(self, name):
+        return self.regex.match(name) is not None
+
+
+def _has_wildcard(pattern):
+    for char in _WILDCARDS:
+        if char in pattern:
+            return True
+    return False
+
+
+def _get_literal_prefix(pattern):
+    """Return part of glob pattern before its first wildcard"""
+    for i, char in enumerate(pattern):
+        if char in _WILDCARDS:
+            return pattern[:i]
+    return pattern
+
+
+def _get_literal_runs(pattern):
+    """Return literal sub-strings of glob pattern between its wildcards"""
+    runs = []
+    run = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        end = -1
+        if char == '[':
+            # Same character class scan as fnmatch.translate - a leading
+            # ']', after optional '!', is part of the class
+            end = i + 1
+            if end < len(pattern) and pattern[end] == '!':
+                end += 1
+            if end < len(pattern) and pattern[end] == ']':
+                end += 1
+            end = pattern.find(']', end)
+        if char in '*?' or end > -1:
+            if run:
+                runs.append(''.join(run))
+                run = []
+            i = end + 1 if end > -1 else i + 1
+            continue
+        run.append(char)
+        i += 1
+    if run:
+        runs.append(''.join(run))
+    return tuple(runs)
+
+
+def compile_sub_query(sub_query):
+    """Compile a single sub-part of a query into a matcher"""
+    # Same variant expansion as graphite-api's match_entries -
+    # first brace group only
+    v1, v2 = sub_query.find('{'), sub_query.find('}')
+    if v1 > -1 and v2 > v1:
+        variants = [sub_query[:v1] + variant + sub_query[v2+1:]
+                    for variant in sub_query[v1+1:v2].split(',')]
+        if not any(_has_wildcard(variant) for variant in variants):
+            return AlternationMatcher(variants)
+        return PatternMatcher(variants)
+    if not _has_wildcard(sub_query):
+        return LiteralMatcher(sub_query)
+    if sub_query == '*':
+        return AnyMatcher()
+    if '?' not in sub_query and '[' not in sub_query \
+       and sub_query.count('*') == 1:
+        if sub_query.endswith('*'):
+            return PrefixMatcher(sub_query[:-1])
+        if sub_query.startswith('*'):
+            return SuffixMatcher(sub_query[1:])
+    return PatternMatcher([sub_query])
+
+
+_QUERY_CACHE = LRUCache(QUERY_CACHE_SIZE)
+
+
+def compile_query(query):
+    """Return tuple of compiled matchers, one per sub-part of query.
+
+    Compiled queries are cached."""
+    matchers = _QUERY_CACHE.get(query)
+    if matchers is None:
+        matchers = tuple(compile_sub_query(sub_query)
+                         for sub_query in query.split('.'))
+        _QUERY_CACHE.set(query, matchers)
+    return matchers
+
+
+def estimate_matches(root, matchers, get_matched_children, leaf_count,
+                     limit=None):
+    """Return upper bound of number of nodes matching compiled query from
+    leaf counts of nodes matched at each level of the query.
+
+    Matched nodes are walked level by level. Walking stops as soon as the
+    bound is within limit or more than limit nodes are matched at a level.
+    The number of matched nodes is exact if the last level is reached.
+
+    :param get_matched_children: Function returning matched (name, child)
+      items of node for a matcher
+    :param leaf_count: Function returning number of leaves under node
+    """
+    nodes = [root]
+    bound = leaf_count(root)
+    for matcher in matchers:
+        if limit is not None and (bound <= limit or len(nodes) > limit):
+            return bound
+        nodes = [child for node in nodes
+                 for (_, child) in get_matched_children(matcher, node)]
+        bound = sum(leaf_count(node) for node in nodes)
+    return len(nodes)
+
+
+class _QueryTreeNode(object):
+    """Node of prefix tree of sub-queries of many queries"""
+    __slots__ = ('matcher', 'children', 'queries')
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.children = {}
+        self.queries = []
+
+
+def _make_query_tree(queries):
+    """Merge queries into prefix tree of their sub-queries, so that queries
+    sharing leading sub-queries share their tree nodes.
+
+    Each tree node keeps the queries that end at it. Queries should be
+    unique."""
+    root = _QueryTreeNode(None)
+    for query in queries:
+        node = root
+        for sub_query, matcher in zip(query.split('.'), compile_query(query)):
+            child = node.children.get(sub_query)
+            if child is None:
+                child = node.children[sub_query] = _QueryTreeNode(matcher)
+            node = child
+        node.queries.append(query)
+    return root
+
+
+def _search_query_tree(node, query_node, split_path, results,
+                       get_matched_children, make_node):
+    for query_child in query_node.children.values():
+        for (name, child) in get_matched_children(query_child.matcher, node):
+            child_path = split_path[:]
+            child_path.append(name)
+            if query_child.queries:
+                result = ('.'.join(child_path),
+                          make_node(child) if make_node else child)
+                for query in query_child.queries:
+                    results[query].append(result)
+            if query_child.children:
+                _search_query_tree(child, query_child, child_path, results,
+                                   get_matched_children, make_node)
+
+
+def search_many(root, queries, get_matched_children, make_node=None):
+    """Return nodes matching each of many queries with one walk of the
+    index.
+
+    Queries are merged into a prefix tree of their sub-queries so that index
+    nodes matched by sub-queries common to several queries, like the shared
+    prefixes of a dashboard's targets, are only matched once.
+
+    :param get_matched_children: Function returning matched (name, child)
+      items of node for a matcher, sorted by name
+    :param make_node: (Optional) Function returning result node for a
+      matched child
+    :rtype: dict of query to list of (path, node) tuples sorted by path
+    """
+    results = dict((query, []) for query in queries)
+    _search_query_tree(root, _make_query_tree(results), [], results,
+                       get_matched_children, make_node)
+    return results
+
+
+def _get_matched_node_children(matcher, node):
+    return [(child.name, child)
+            for child in sorted(node.children, key=attrgetter('name'))
+            if matcher.match(child.name)]
+
+
+def _search_nodes(node, matchers, split_path):
+    matcher = matchers[0]
+    child_matchers = matchers[1:]
+    for child in sorted(node.children, key=attrgetter('name')):
+        name = child.name
+        if not matcher.match(name):
+            continue
+        child_path = split_path[:]
+        child_path.append(name)
+        if len(child_matchers) > 0:
+            for sub in _search_nodes(child, child_matchers, child_path):
+                yield sub
+        else:
+            yield (child_path, child)
+
+
+def query_nodes(node, query):
+    """Return nodes matching Graphite glob pattern query for index nodes
+    providing `children` list of child nodes with `name` attribute, like
+    the C extension's node trie, using compiled query matchers.
+
+    Children are searched in name order so that results are generated
+    sorted by path without materialising them first.
+
+    :rtype: generator of (path, node) tuples sorted by path
+    """
+    return (('.'.join(path), _node,)
+            for path, _node in _search_nodes(node, compile_query(query), []))
+
+
+def query_many_nodes(node, queries):
+    """Return nodes matching each of many Graphite glob pattern queries for
+    index nodes providing `children` list of child nodes with `name`
+    attribute, like the C extension's node trie.
+
+    See :mod:`search_many`
+
+    :rtype: dict of query to list of (path, node) tuples sorted by path
+    """
+    return search_many(node, queries, _get_matched_node_children)
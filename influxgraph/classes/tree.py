@@ -16,11 +16,13 @@
 """Tree representation of Graphite metrics"""
 
 from __future__ import absolute_import, print_function
+import sys
 import json
+from bisect import bisect_left
 from collections import deque
+from operator import itemgetter
 
-from graphite_api.utils import is_pattern
-from graphite_api.finders import match_entries
+from .matcher import compile_query, estimate_matches, search_many
 
 
 def _encode_bytes(_str):
@@ -37,39 +39,298 @@ def _decode_str(_str):
     return _str
 
 
+# Number of children above which a node's children are kept in a hash map
+# instead of a tuple of (name, node) pairs sorted by name
+CHILD_MAP_SIZE = 32
+
+
+def _get_trigrams(name):
+    return set(name[i:i+3] for i in range(len(name) - 2))
+
+
+class _ChildMap(dict):
+    """Hash map of child name to child node for nodes with many children.
+
+    Keeps a lazily built, sorted view of decoded child names for glob
+    matching that is discarded on modification and, optionally, a trigram
+    index of decoded child names that is kept up to date on modification."""
+    __slots__ = ('_sorted_keys', '_trigrams')
+
+    def __init__(self, items=()):
+        dict.__init__(self, items)
+        self._sorted_keys = None
+        self._trigrams = None
+
+    def __setitem__(self, key, value):
+        self._sorted_keys = None
+        if self._trigrams is not None and key not in self:
+            self._add_trigrams(_decode_str(key))
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._sorted_keys = None
+        dict.__delitem__(self, key)
+        if self._trigrams is not None:
+            name = _decode_str(key)
+            for trigram in _get_trigrams(name):
+                names = self._trigrams[trigram]
+                names.discard(name)
+                if not names:
+                    del self._trigrams[trigram]
+
+    def _add_trigrams(self, name):
+        for trigram in _get_trigrams(name):
+            self._trigrams.setdefault(trigram, set()).add(name)
+
+    def index_trigrams(self):
+        """Build trigram index of child names, if not already built.
+
+        Index is built privately and set once complete, for concurrent
+        readers of the map"""
+        if self._trigrams is not None:
+            return
+        trigrams = {}
+        for key in self.keys():
+            for trigram in _get_trigrams(_decode_str(key)):
+                trigrams.setdefault(trigram, set()).add(_decode_str(key))
+        self._trigrams = trigrams
+
+    def copy(self):
+        """Return copy of child map and its trigram index"""
+        child_map = _ChildMap(self.items())
+        child_map._sorted_keys = self._sorted_keys
+        if self._trigrams is not None:
+            child_map._trigrams = dict(
+                (trigram, set(names))
+                for (trigram, names) in self._trigrams.items())
+        return child_map
+
+    def _get_trigram_candidates(self, substrings):
+        """Return set of child names containing all trigrams of literal
+        sub-strings or None if no sub-string is long enough to have any"""
+        trigrams = set()
+        for substring in substrings:
+            trigrams.update(_get_trigrams(substring))
+        if not trigrams:
+            return
+        try:
+            sets = sorted((self._trigrams[trigram] for trigram in trigrams),
+                          key=len)
+        except KeyError:
+            return set()
+        return sets[0].intersection(*sets[1:])
+
+    def sorted_keys(self):
+        """Return sorted tuple of decoded child names"""
+        if self._sorted_keys is None:
+            self._sorted_keys = tuple(sorted(
+                _decode_str(key) for key in self.keys()))
+        return self._sorted_keys
+
+    def match(self, matcher):
+        """Return child names matching compiled query matcher"""
+        if self._trigrams is not None and not matcher.prefix:
+            # Names must contain all trigrams of the matcher's literal
+            # sub-strings - narrows down infix and suffix patterns
+            candidates = self._get_trigram_candidates(matcher.substrings)
+            if candidates is not None:
+                return [key for key in sorted(candidates)
+                        if matcher.match(key)]
+        keys = self.sorted_keys()
+        prefix = matcher.prefix
+        if prefix:
+            # Only names starting with the matcher's literal prefix can match
+            start = bisect_left(keys, prefix)
+            end = start
+            while end < len(keys) and keys[end].startswith(prefix):
+                end += 1
+            keys = keys[start:end]
+        return [key for key in keys if matcher.match(key)]
+
+
+def _make_children(items):
+    """Return children container for list of (name, node) items"""
+    if len(items) > CHILD_MAP_SIZE:
+        return _ChildMap(items)
+    return tuple(sorted(items, key=itemgetter(0)))
+
+
 class Node(object):
-    """Node class of a graphite metric"""
-    __slots__ = ('children')
+    """Node class of a graphite metric.
+
+    Branch nodes keep count of leaf nodes in their sub-tree"""
+    __slots__ = ('children', 'leaves')
 
     def __init__(self):
         self.children = None
+        self.leaves = 0
 
     def is_leaf(self):
         """Returns True/False depending on whether self is a LeafNode or not"""
         return self.children is None
 
+    def leaf_count(self):
+        """Return number of leaf nodes in this node's sub-tree, one for a
+        leaf node"""
+        return 1 if self.children is None else self.leaves
+
+    def child_items(self):
+        """Return (name, node) items of this node's children"""
+        if self.children is None:
+            return ()
+        if isinstance(self.children, _ChildMap):
+            return self.children.items()
+        return self.children
+
+    def get_child(self, name):
+        """Return child node with name or None"""
+        if self.children is None:
+            return
+        if isinstance(self.children, _ChildMap):
+            return self.children.get(name)
+        for (_child_name, node) in self.children:
+            if name == _child_name:
+                return node
+
+    def _add_child(self, name, node):
+        if isinstance(self.children, _ChildMap):
+            self.children[name] = node
+        elif len(self.children) >= CHILD_MAP_SIZE:
+            self.children = _ChildMap(self.children + ((name, node),))
+        else:
+            # Keep children sorted by name, searching from the end as
+            # names are commonly inserted in order
+            children = self.children
+            i = len(children)
+            if not i or children[-1][0] < name:
+                self.children = children + ((name, node),)
+                return
+            while i and children[i-1][0] > name:
+                i -= 1
+            self.children = children[:i] + ((name, node),) + children[i:]
+
+    def _replace_child(self, name, node):
+        if isinstance(self.children, _ChildMap):
+            # Same names - sorted names and trigrams are unchanged
+            dict.__setitem__(self.children, name, node)
+            return
+        self.children = tuple(
+            (_child_name, node if _child_name == name else child)
+            for (_child_name, child) in self.children)
+
+    def copy(self):
+        """Return copy of node sharing its children's nodes"""
+        node = Node()
+        node.__class__ = self.__class__
+        node.leaves = self.leaves
+        node.children = self.children.copy() \
+            if isinstance(self.children, _ChildMap) else self.children
+        return node
+
+    def _remove_child(self, name):
+        if isinstance(self.children, _ChildMap):
+            del self.children[name]
+            return
+        self.children = tuple((_child_name, node)
+                              for (_child_name, node) in self.children
+                              if _child_name != name)
+
     def insert(self, paths):
-        """Insert path in this node's children"""
+        """Insert path in this node's children.
+
+        Returns number of leaf nodes added to this node's sub-tree"""
         if len(paths) == 0:
-            return
+            return 0
         if self.children is None:
             self.children = ()
+            self.leaves = 0
         child_name = paths.popleft()
-        for (_child_name, node) in self.children:
-            # Fast path for end of recursion - avoids extra recursion
-            # for empty paths list
-            if len(paths) == 0 and child_name == _child_name:
-                return
-            elif child_name == _child_name:
-                return node.insert(paths)
-        node = Node()
-        self.children += ((child_name, node),)
-        return node.insert(paths)
+        node = self.get_child(child_name)
+        if node is None:
+            node = Node()
+            self._add_child(child_name, node)
+            node.insert(paths)
+            self.leaves += 1
+            return 1
+        # Fast path for end of recursion - avoids extra recursion
+        # for empty paths list
+        if len(paths) == 0:
+            if node.children is not None:
+                node.__class__ = _LeafBranchNode
+            return 0
+        if node.children is None:
+            # Leaf becomes branch with a single leaf
+            node.__class__ = _LeafBranchNode
+            node.insert(paths)
+            return 0
+        added = node.insert(paths)
+        self.leaves += added
+        return added
+
+    def delete(self, paths):
+        """Delete leaf path from this node's children. Branches left without
+        children by the deletion are removed as well.
+
+        Returns True if path was found and deleted"""
+        if len(paths) == 0:
+            return False
+        child_name = paths.popleft()
+        node = self.get_child(child_name)
+        if node is None:
+            return False
+        leaves = node.leaf_count()
+        if len(paths) > 0:
+            if not node.delete(paths):
+                return False
+            if node.children:
+                self.leaves += node.leaves - leaves
+                return True
+            # Branch was also inserted as a leaf - becomes leaf again
+            if isinstance(node, _LeafBranchNode):
+                node.children = None
+                node.__class__ = Node
+                self.leaves += 1 - leaves
+                return True
+        elif node.children is not None:
+            if not isinstance(node, _LeafBranchNode):
+                return False
+            # Keep branch, drop its leaf path
+            node.__class__ = Node
+            return True
+        self._remove_child(child_name)
+        self.leaves -= leaves
+        return True
+
+    def merge(self, other):
+        """Merge children of other node into this node's children.
+
+        Children not in this node are grafted from other node as they are,
+        without copying."""
+        if other.children is None:
+            return
+        if self.children is None:
+            self.children = ()
+            self.leaves = 0
+        for (name, other_child) in other.child_items():
+            child = self.get_child(name)
+            if child is None:
+                self._add_child(name, other_child)
+                self.leaves += other_child.leaf_count()
+            elif other_child.children is None:
+                if child.children is not None:
+                    child.__class__ = _LeafBranchNode
+            else:
+                if child.children is None or isinstance(
+                        other_child, _LeafBranchNode):
+                    child.__class__ = _LeafBranchNode
+                leaves = child.leaf_count()
+                child.merge(other_child)
+                self.leaves += child.leaf_count() - leaves
 
     def to_array(self):
         """Return list of (name, children) items for this node's children"""
         return [(_decode_str(name), node.to_array(),)
-                for (name, node,) in self.children] \
+                for (name, node,) in self.child_items()] \
             if self.children is not None else None
 
     @staticmethod
@@ -78,19 +339,28 @@ class Node(object):
         metric = Node()
         if array is None:
             return metric
-        else:
-            metric.children = ()
-        for child_name, child_array in array:
-            child = Node.from_array(child_array)
-            metric.children += ((_encode_bytes(child_name), child),)
+        children = [(_encode_bytes(child_name), Node.from_array(child_array))
+                    for child_name, child_array in array]
+        metric.children = _make_children(children)
+        metric.leaves = sum(child.leaf_count() for (_, child) in children)
         return metric
 
 
+class _LeafBranchNode(Node):
+    """Branch node whose own path has also been inserted as a leaf.
+
+    Only a branch is visible to queries - the leaf path is kept track of so
+    that the node can become a leaf again when its children are deleted.
+    Having the same slots as :mod:`Node`, nodes can switch class in place.
+    """
+    __slots__ = ()
+
+
 class NodeTreeIndex(object):
     """Node tree index class with graphite glob searches per sub-part of a
     query
     """
-    __slots__ = ('index')
+    __slots__ = ('index', '_owned')
 
     @property
     def children(self):
@@ -98,57 +368,178 @@ class NodeTreeIndex(object):
 
     def __init__(self):
         self.index = Node()
+        self._owned = None
+
+    def copy(self):
+        """Return copy of tree index that can be modified while this index
+        is being queried.
+
+        Nodes are shared between the two indexes - nodes on a path are only
+        copied when the path is inserted into or deleted from the copy. This
+        index should not be modified after copying."""
+        index = NodeTreeIndex()
+        index.index = self.index.copy()
+        index._owned = set()
+        return index
+
+    def _path_nodes(self, paths):
+        node = self.index
+        for name in paths:
+            node = node.get_child(name)
+            if node is None:
+                return
+            yield node
+
+    def _own_path(self, paths):
+        """Copy nodes on path shared with the index this index was copied
+        from, if any"""
+        if self._owned is None:
+            return
+        node = self.index
+        for name in paths:
+            child = node.get_child(name)
+            if child is None:
+                return
+            if child not in self._owned:
+                child = child.copy()
+                node._replace_child(name, child)
+                self._owned.add(child)
+            node = child
+
+    def _insert(self, paths):
+        self._own_path(paths)
+        self.index.insert(deque(paths))
+        if self._owned is not None:
+            self._owned.update(self._path_nodes(paths))
+
+    def _delete(self, paths):
+        self._own_path(paths)
+        return self.index.delete(deque(paths))
 
     def insert(self, metric_path):
         """Insert metric path into tree index"""
-        paths = deque([_encode_bytes(s) for s in metric_path.split('.')])
-        self.index.insert(paths)
+        self._insert([_encode_bytes(s) for s in metric_path.split('.')])
 
     def insert_split_path(self, paths):
         """Insert already split path into tree index"""
-        self.index.insert(deque([_encode_bytes(s) for s in paths]))
+        self._insert([_encode_bytes(s) for s in paths])
+
+    def delete(self, metric_path):
+        """Delete metric path from tree index"""
+        return self._delete(
+            [_encode_bytes(s) for s in metric_path.split('.')])
+
+    def delete_split_path(self, paths):
+        """Delete already split path from tree index"""
+        return self._delete([_encode_bytes(s) for s in paths])
+
+    def merge(self, other):
+        """Merge other tree index into this one. Other index should not be
+        used after merging as branches are shared between the two."""
+        self.index.merge(other.index)
+
+    def index_trigrams(self, min_children):
+        """Build trigram index of child names of nodes with at least
+        `min_children` children, for infix and suffix glob patterns to be
+        matched against candidate names only.
+
+        Trigram indexes are kept up to date on insertion and deletion.
+        Nodes growing past `min_children` afterwards are only indexed on
+        the next call."""
+        queue = deque([self.index])
+        while queue:
+            node = queue.popleft()
+            if not node.children:
+                continue
+            if isinstance(node.children, _ChildMap) \
+               and len(node.children) >= min_children:
+                node.children.index_trigrams()
+            queue.extend(child for (_, child) in node.child_items()
+                         if child.children)
 
     def clear(self):
         """Clear tree index"""
         self.index.children = None
+        self.index.leaves = 0
+
+    def stats(self):
+        """Return index statistics - representation, node, leaf and node
+        name counts and approximate size in bytes"""
+        nodes, size = 1, 0
+        queue = deque([self.index])
+        while queue:
+            node = queue.popleft()
+            size += sys.getsizeof(node)
+            if not node.children:
+                continue
+            size += sys.getsizeof(node.children)
+            # (name, node) pair per child unless in child map
+            pairs = not isinstance(node.children, _ChildMap)
+            for (name, child) in node.child_items():
+                nodes += 1
+                size += sys.getsizeof(name)
+                if pairs:
+                    size += sys.getsizeof((name, child))
+                queue.append(child)
+        return {'representation': 'tree',
+                'nodes': nodes,
+                'leaves': self.index.leaves if self.index.children else 0,
+                'strings': nodes - 1,
+                'size': size}
 
     def query(self, query):
-        """Return nodes matching Graphite glob pattern query"""
-        nodes = sorted(self.search(self.index, query.split('.'), []))
+        """Return lazy generator of nodes matching Graphite glob pattern
+        query.
+
+        Children are kept in sorted order so that results are generated
+        sorted by path without materialising them first."""
         return (('.'.join(path), node,)
-                for path, node in nodes)
+                for path, node in self.search(
+                    self.index, compile_query(query), []))
+
+    def query_many(self, queries):
+        """Return nodes matching each of many Graphite glob pattern queries
+        with one walk of the index. See
+        :mod:`influxgraph.classes.matcher.search_many`
+
+        :rtype: dict of query to list of (path, node) tuples sorted by path
+        """
+        return search_many(self.index, queries, self._get_matched_children)
+
+    def estimate(self, query, limit=None):
+        """Return upper bound of number of nodes matching query from leaf
+        counts, exact if all levels of query are walked. See
+        :mod:`influxgraph.classes.matcher.estimate_matches`"""
+        return estimate_matches(self.index, compile_query(query),
+                                self._get_matched_children,
+                                Node.leaf_count, limit=limit)
 
     def _get_children_from_matched_paths(self, matched_paths, node):
-        for (path, _node) in node.children:
-            _path = _decode_str(path)
-            if _path in matched_paths:
-                yield (_path, _node)
-
-    def _get_child_from_string_query(self, sub_query, node):
-        for (path, _node) in node.children:
-            if _decode_str(path) == sub_query:
-                return _node
-
-    def _get_matched_children(self, sub_query, node):
-        keys = [_decode_str(key) for (key, _) in node.children] \
-          if node.children is not None else []
-        matched_paths = match_entries(keys, sub_query)
-        if node.children is not None and is_pattern(sub_query):
-            matched_children = self._get_children_from_matched_paths(
-                matched_paths, node)
-        else:
-            matched_children = [(sub_query,
-                                 self._get_child_from_string_query(
-                                     sub_query, node))] \
-                                     if node.children is not None \
-                                     and sub_query in keys else []
-        return matched_children
+        for path in matched_paths:
+            yield (path, node.get_child(_encode_bytes(path)))
+
+    def _get_matched_children(self, matcher, node):
+        if node.children is None:
+            return []
+        if matcher.literals is not None:
+            children = ((name, node.get_child(_encode_bytes(name)))
+                        for name in matcher.literals)
+            return [(name, child) for (name, child) in children
+                    if child is not None]
+        if isinstance(node.children, _ChildMap):
+            return self._get_children_from_matched_paths(
+                node.children.match(matcher), node)
+        # Children are kept sorted by name
+        children = ((_decode_str(name), child)
+                    for (name, child) in node.children)
+        return [(name, child) for (name, child) in children
+                if matcher.match(name)]
 
     def search(self, node, split_query, split_path):
-        """Return matching children for each query part in split query starting
-        from given node"""
-        sub_query = split_query[0]
-        matched_children = self._get_matched_children(sub_query, node)
+        """Return matching children for each compiled query matcher in split
+        query starting from given node"""
+        matcher = split_query[0]
+        matched_children = self._get_matched_children(matcher, node)
         for child_name, child_node in matched_children:
             child_path = split_path[:]
             child_path.append(child_name)
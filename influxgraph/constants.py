@@ -46,3 +46,13 @@ FILL_PARAMS = ['previous', 'linear', 'null']
 _MEMCACHE_FIELDS_KEY = 'infl_fields_key'
 FILE_LOCK = '/tmp/influxgraph_index.lock'
 ENCODING = 'utf-8'
+# Number of find query results to cache and maximum number of
+# nodes in all cached results
+FIND_CACHE_SIZE = 1000
+FIND_CACHE_MAX_NODES = 100000
+# Minimum number of values of a tag to select with a regular expression
+# in queries, maximum number of index nodes to read all values of a tag
+# from and number of index patterns to cache tag values of
+TAG_REGEX_MIN_VALUES = 20
+TAG_VALUES_MAX_NODES = 100000
+TAG_VALUES_CACHE_SIZE = 1000
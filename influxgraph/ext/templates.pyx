@@ -15,21 +15,108 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Cython Extension of performance critical templates modules functions"""
+"""Cython Extension of performance critical templates modules functions
+and index search"""
 
 from heapq import heappush, heappop
+from array import array
 import logging
 
-from libc.string cimport strndup, strsep, strdup, strncmp, strcmp, strchr
-from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport strndup, strsep, strdup, strcmp, strchr, strcpy, \
+    strlen, memcpy, strncmp, memcmp, memset
+from libc.stdlib cimport malloc, calloc, realloc, free, qsort
 
-from influxgraph.ext.nodetrie cimport Node, to_cstring_array, _encode_bytes
+from influxgraph.ext cimport cnode
+from influxgraph.ext.nodetrie cimport Node, to_cstring_array, \
+    _encode_bytes, PyNode_Init
 from influxgraph.constants import ENCODING
+from influxgraph.templates import get_template_candidates, TemplateTagIndex
+from influxgraph.classes import matcher as _matcher
+from influxgraph.classes.index_file import read_header, verify_checksum, \
+    _array_from_bytes, _get_leaf_counts, IndexFileError, CompactIndex, \
+    NO_NAME, _UINT32, _MAX_UINT32
+from influxgraph.classes.matcher import compile_query, LiteralMatcher, \
+    AnyMatcher, PrefixMatcher, SuffixMatcher, AlternationMatcher
 
 
 logger = logging.getLogger('influxgraph')
 
 
+cdef extern from "pthread.h" nogil:
+    ctypedef struct pthread_rwlock_t:
+        pass
+    int pthread_rwlock_init(pthread_rwlock_t *rwlock, const void *attr)
+    int pthread_rwlock_rdlock(pthread_rwlock_t *rwlock)
+    int pthread_rwlock_wrlock(pthread_rwlock_t *rwlock)
+    int pthread_rwlock_unlock(pthread_rwlock_t *rwlock)
+
+
+# Index insertions and searches run without the GIL. Readers and writers of
+# the same index are synchronised with a readers-writer lock picked by index
+# object address from a fixed set of locks
+cdef enum:
+    INDEX_LOCKS = 64
+
+cdef pthread_rwlock_t _index_locks[INDEX_LOCKS]
+cdef size_t _lock_i
+for _lock_i in range(INDEX_LOCKS):
+    pthread_rwlock_init(&_index_locks[_lock_i], NULL)
+
+
+cdef inline pthread_rwlock_t * _index_lock(Node index) nogil:
+    return &_index_locks[(<size_t><void *>index >> 4) % INDEX_LOCKS]
+
+
+cdef inline void _insert_split_path(Node index, const char **paths) nogil:
+    cdef pthread_rwlock_t *lock = _index_lock(index)
+    pthread_rwlock_wrlock(lock)
+    index._insert_split_path(paths)
+    pthread_rwlock_unlock(lock)
+
+
+cdef struct _CTemplate:
+    # Template compiled for bulk parsing. Tag key per template position,
+    # NULL for empty positions
+    size_t size
+    char **keys
+    bint *measurement_keys
+    size_t measurement_idx
+    bint wildcard
+    Py_ssize_t min_items
+    bint fields
+    size_t filter_size
+    char **filter
+
+
+cdef struct _CFields:
+    # Field keys of a measurement split on separator
+    char *measurement
+    char **tokens
+    size_t *sizes
+    size_t size
+    bint missing
+
+
+cdef struct _CFieldsTable:
+    # Open addressing table of measurement to its fields entry
+    _CFields *entries
+    size_t size
+    size_t capacity
+    Py_ssize_t *buckets
+    size_t n_buckets
+
+
+cdef struct _CSeries:
+    # Template match of series in bulk parsing.
+    # template_i is -1 for no match and -2 for series that need to be parsed
+    # one by one
+    Py_ssize_t template_i
+    char *measurement
+    size_t path_start
+    size_t path_len
+    Py_ssize_t fields_i
+
+
 cdef char ** _parse_serie_no_templates(char **c_paths,
                                        Py_ssize_t *_series_len,
                                        Node index,
@@ -60,7 +147,7 @@ cdef char ** _parse_serie_no_templates(char **c_paths,
                 path_i += 1
                 token = strsep(&temp, c_sep)
             c_paths[path_i] = NULL
-            index._insert_split_path(<const char **>c_paths)
+            _insert_split_path(index, <const char **>c_paths)
             return c_paths
         finally:
             for i in range(path_i):
@@ -72,8 +159,9 @@ cdef char ** _parse_serie_no_templates(char **c_paths,
 cdef char ** _parse_serie_with_tags(char **c_split_tags,
                                     size_t *_split_tags_size,
                                     Node index, unicode serie, dict fields,
-                                    list graphite_templates,
-                                    char *c_sep) except NULL:
+                                    graphite_templates,
+                                    char *c_sep,
+                                    dict field_suffixes) except NULL:
     cdef bytes b_path, b_measurement
     cdef list split_paths
     cdef char *token, *to_free, *c_measurement, *temp
@@ -111,13 +199,13 @@ cdef char ** _parse_serie_with_tags(char **c_split_tags,
             # Series with no tags and template configured, ignore
             split_paths = c_get_series_with_tags(
                 b_measurement, c_split_tags, fields, graphite_templates,
-                tags_i, c_sep)
+                tags_i, c_sep, field_suffixes)
             split_path_size = len(split_paths)
             for split_path in split_paths[:split_path_size]:
                 c_paths = to_cstring_array(split_path)
                 try:
                     with nogil:
-                        index._insert_split_path(<const char **>c_paths)
+                        _insert_split_path(index, <const char **>c_paths)
                 finally:
                     free(c_paths)
         else:
@@ -146,14 +234,15 @@ cdef int _parse_serie_no_tags(char *measurement,
                     raise MemoryError
             c_paths[0] = measurement
             c_paths[1] = NULL
-            index._insert_split_path(<const char **>c_paths)
+            _insert_split_path(index, <const char **>c_paths)
         return 0
     finally:
         free(c_paths)
 
 
 def parse_series(list series, dict fields,
-                 list graphite_templates, bytes separator=b'.'):
+                 graphite_templates, bytes separator=b'.',
+                 Node index=None, dict field_suffixes=None):
     """Parses series and fields with/without graphite templates
     and returns built Index
 
@@ -165,6 +254,12 @@ def parse_series(list series, dict fields,
     and fields.
     :type graphite_templates: list(tuple) as returned by
       :mod:`influxgraph.templates.parse_influxdb_graphite_templates`
+    :param index: (Optional) Existing index to insert series into, for
+      parsing series incrementally. New index is created if not provided
+    :type index: :mod:`influxgraph.ext.nodetrie.Node`
+    :param field_suffixes: (Optional) Cache of per measurement field keys
+      split on separator to share between calls of same index build
+    :type field_suffixes: dict
 
     :rtype: :mod:`influxgraph.ext.nodetrie.Node`
     """
@@ -175,7 +270,10 @@ def parse_series(list series, dict fields,
     cdef Py_ssize_t series_size = len(series)
     cdef Py_ssize_t series_len = series_size + 1
     cdef char *c_sep = separator
-    cdef Node index = Node()
+    if index is None:
+        index = Node()
+    if field_suffixes is None:
+        field_suffixes = {}
     # Allocate and use single array for paths once
     c_paths = <char **>malloc(series_len * sizeof(char *))
     if c_paths is NULL:
@@ -187,6 +285,13 @@ def parse_series(list series, dict fields,
         free(c_paths)
         raise MemoryError
     try:
+        if series_size > 0 and graphite_templates and \
+           _can_parse_bulk(graphite_templates, fields):
+            # Series the bulk parser cannot parse exactly are parsed one
+            # by one below
+            series = _parse_series_bulk(series, fields, graphite_templates,
+                                        separator, index, field_suffixes)
+            series_size = len(series)
         for serie in series[:series_size]:
             # If we have metrics with tags in them split them out and
             # pre-generate a correctly ordered split path for that metric
@@ -194,7 +299,7 @@ def parse_series(list series, dict fields,
             if graphite_templates is not None or ',' in serie:
                 c_split_tags = _parse_serie_with_tags(
                     c_split_tags, &split_tags_size, index, serie, fields,
-                    graphite_templates, c_sep)
+                    graphite_templates, c_sep, field_suffixes)
             # No tags, no template
             else:
                 c_paths = _parse_serie_no_templates(
@@ -205,6 +310,1155 @@ def parse_series(list series, dict fields,
         free(c_split_tags)
 
 
+cdef bint _can_parse_bulk(graphite_templates, dict fields):
+    cdef list values
+    for (_, template, _, _) in graphite_templates:
+        if not isinstance(template, TemplateTagIndex) \
+           or template.measurement_idx is None:
+            return 0
+        values = list(template.values())
+        if fields is None and ('field' in values or 'field*' in values):
+            return 0
+    return 1
+
+
+cdef _CTemplate * _compile_templates(graphite_templates,
+                                     list refs) except NULL:
+    """Compile templates to C structures for bulk parsing. Encoded strings
+    are kept referenced in `refs` for as long as templates are in use"""
+    cdef size_t n_templates = len(graphite_templates)
+    cdef _CTemplate *c_templates = <_CTemplate *>calloc(
+        n_templates + 1, sizeof(_CTemplate))
+    cdef _CTemplate *c_template
+    cdef bytes b_tag
+    cdef list values
+    cdef size_t t_i = 0
+    if c_templates is NULL:
+        raise MemoryError
+    try:
+        for (_filter, template, _, _) in graphite_templates:
+            c_template = &c_templates[t_i]
+            t_i += 1
+            c_template.size = len(template)
+            c_template.keys = <char **>calloc(
+                c_template.size + 1, sizeof(char *))
+            c_template.measurement_keys = <bint *>calloc(
+                c_template.size + 1, sizeof(bint))
+            if c_template.keys is NULL or c_template.measurement_keys is NULL:
+                raise MemoryError
+            for i, tag in template.items():
+                if not tag:
+                    continue
+                b_tag = _encode_bytes(tag)
+                refs.append(b_tag)
+                c_template.keys[<size_t>i] = b_tag
+                c_template.measurement_keys[<size_t>i] = 'measurement' in tag
+            c_template.measurement_idx = template.measurement_idx
+            c_template.wildcard = template.measurement_wildcard
+            c_template.min_items = template.num_items - template.field_inds
+            values = list(template.values())
+            c_template.fields = 'field' in values or 'field*' in values
+            if not _filter:
+                continue
+            c_template.filter_size = len(_filter.pattern)
+            c_template.filter = <char **>calloc(
+                c_template.filter_size + 1, sizeof(char *))
+            if c_template.filter is NULL:
+                raise MemoryError
+            for i, pattern in enumerate(_filter.pattern):
+                if pattern == '*':
+                    continue
+                b_tag = _encode_bytes(pattern)
+                refs.append(b_tag)
+                c_template.filter[<size_t>i] = b_tag
+        return c_templates
+    except BaseException:
+        _free_templates(c_templates, n_templates)
+        raise
+
+
+cdef void _free_templates(_CTemplate *c_templates, size_t n_templates) nogil:
+    cdef size_t t_i
+    for t_i in range(n_templates):
+        free(c_templates[t_i].keys)
+        free(c_templates[t_i].measurement_keys)
+        free(c_templates[t_i].filter)
+    free(c_templates)
+
+
+cdef char ** _grow_array(char **array, size_t *_capacity,
+                         size_t size) nogil except NULL:
+    """Grow array to at least size entries"""
+    cdef size_t capacity = _capacity[0]
+    cdef char **new_array
+    if size <= capacity:
+        return array
+    while capacity < size:
+        capacity *= 2
+    new_array = <char **>realloc(array, capacity * sizeof(char *))
+    if new_array is NULL:
+        with gil:
+            raise MemoryError
+    _capacity[0] = capacity
+    return new_array
+
+
+cdef Py_ssize_t _c_template_path(_CTemplate *c_template, char *measurement,
+                                 char **tag_keys, char **tag_values,
+                                 size_t tags_i, char **slots, char **path,
+                                 char *scratch, char *c_sep) nogil:
+    """Fill path of series for template in template order and return path
+    size. Returns -1 if tags need to be matched one by one"""
+    cdef size_t i, j, path_len = 0
+    cdef char *token, *temp
+    if c_template.wildcard:
+        strcpy(scratch, measurement)
+        temp = scratch
+        token = strsep(&temp, c_sep)
+        while token is not NULL:
+            path[path_len] = token
+            path_len += 1
+            token = strsep(&temp, c_sep)
+        return path_len
+    # Measurement without tags
+    elif tags_i == 0:
+        path[0] = measurement
+        return 1
+    for j in range(c_template.size):
+        slots[j] = NULL
+    for i in range(tags_i):
+        for j in range(c_template.size):
+            if c_template.keys[j] is NULL \
+               or strcmp(tag_keys[i], c_template.keys[j]) != 0:
+                continue
+            if c_template.measurement_keys[j] or slots[j] is not NULL:
+                return -1
+            slots[j] = tag_values[i]
+    slots[c_template.measurement_idx] = measurement
+    for j in range(c_template.size):
+        if slots[j] is not NULL:
+            path[path_len] = slots[j]
+            path_len += 1
+    return path_len
+
+
+cdef bint _c_filter_match(_CTemplate *c_template, char **path,
+                          size_t path_len) nogil:
+    cdef size_t i
+    for i in range(c_template.filter_size):
+        if c_template.filter[i] is NULL:
+            continue
+        if i >= path_len or strcmp(c_template.filter[i], path[i]) != 0:
+            return 0
+    return 1
+
+
+cdef size_t _hash_string(char *string) nogil:
+    cdef size_t _hash = 5381
+    while string[0] != 0:
+        _hash = (_hash * 33) ^ <unsigned char>string[0]
+        string += 1
+    return _hash
+
+
+cdef int _init_fields_table(_CFieldsTable *table) nogil except -1:
+    cdef size_t i
+    table.size = 0
+    table.capacity = 16
+    table.n_buckets = 32
+    table.entries = <_CFields *>malloc(table.capacity * sizeof(_CFields))
+    table.buckets = <Py_ssize_t *>malloc(
+        table.n_buckets * sizeof(Py_ssize_t))
+    if table.entries is NULL or table.buckets is NULL:
+        with gil:
+            raise MemoryError
+    for i in range(table.n_buckets):
+        table.buckets[i] = -1
+    return 0
+
+
+cdef void _free_fields_table(_CFieldsTable *table) nogil:
+    cdef size_t i
+    if table.entries is not NULL:
+        for i in range(table.size):
+            free(table.entries[i].tokens)
+            free(table.entries[i].sizes)
+    free(table.entries)
+    free(table.buckets)
+
+
+cdef int _rehash_fields_table(_CFieldsTable *table) nogil except -1:
+    cdef size_t i, bucket, n_buckets = table.n_buckets * 2
+    cdef Py_ssize_t *buckets = <Py_ssize_t *>malloc(
+        n_buckets * sizeof(Py_ssize_t))
+    if buckets is NULL:
+        with gil:
+            raise MemoryError
+    for i in range(n_buckets):
+        buckets[i] = -1
+    for i in range(table.size):
+        bucket = _hash_string(table.entries[i].measurement) & (n_buckets - 1)
+        while buckets[bucket] != -1:
+            bucket = (bucket + 1) & (n_buckets - 1)
+        buckets[bucket] = i
+    free(table.buckets)
+    table.buckets = buckets
+    table.n_buckets = n_buckets
+    return 0
+
+
+cdef Py_ssize_t _fields_entry(_CFieldsTable *table,
+                              char *measurement) nogil except -1:
+    """Get index of fields entry of measurement, adding new entry for new
+    measurements"""
+    cdef size_t bucket = _hash_string(measurement) & (table.n_buckets - 1)
+    cdef _CFields *entries
+    cdef Py_ssize_t entry_i
+    while table.buckets[bucket] != -1:
+        entry_i = table.buckets[bucket]
+        if strcmp(table.entries[entry_i].measurement, measurement) == 0:
+            return entry_i
+        bucket = (bucket + 1) & (table.n_buckets - 1)
+    if table.size >= table.capacity:
+        entries = <_CFields *>realloc(
+            table.entries, table.capacity * 2 * sizeof(_CFields))
+        if entries is NULL:
+            with gil:
+                raise MemoryError
+        table.entries = entries
+        table.capacity *= 2
+    entry_i = table.size
+    table.entries[entry_i].measurement = measurement
+    table.entries[entry_i].tokens = NULL
+    table.entries[entry_i].sizes = NULL
+    table.entries[entry_i].size = 0
+    table.entries[entry_i].missing = 0
+    table.buckets[bucket] = entry_i
+    table.size += 1
+    if table.size * 2 > table.n_buckets:
+        _rehash_fields_table(table)
+    return entry_i
+
+
+cdef int _set_field_suffixes(_CFields *entry, dict fields, bytes separator,
+                             dict field_suffixes, list refs) except -1:
+    cdef bytes measurement = entry.measurement
+    cdef list suffixes, field_keys
+    cdef bytes b_field_key
+    cdef size_t i = 0, k = 0
+    try:
+        suffixes = _get_field_suffixes(
+            fields, measurement.decode(ENCODING), separator, field_suffixes)
+    except KeyError:
+        logger.warning("Measurement %s not in field list", measurement)
+        entry.missing = 1
+        return 0
+    entry.tokens = <char **>malloc(
+        (sum([len(field_keys) for field_keys in suffixes]) + 1)
+        * sizeof(char *))
+    entry.sizes = <size_t *>malloc((len(suffixes) + 1) * sizeof(size_t))
+    if entry.tokens is NULL or entry.sizes is NULL:
+        raise MemoryError
+    for field_keys in suffixes:
+        entry.sizes[k] = len(field_keys)
+        k += 1
+        for field_key in field_keys:
+            b_field_key = _encode_bytes(field_key)
+            refs.append(b_field_key)
+            entry.tokens[i] = b_field_key
+            i += 1
+    entry.size = k
+    return 0
+
+
+cdef list _parse_series_bulk(list series, dict fields, graphite_templates,
+                             bytes separator, Node index,
+                             dict field_suffixes):
+    """Parse series into index in bulk with compiled templates.
+
+    Series are encoded into a single buffer that is tokenized in place.
+    Templates are matched and paths inserted into index with the GIL
+    released. Field keys are split once per measurement.
+
+    Returns series that cannot be parsed in bulk and need to be parsed one
+    by one, such as series with repeated tag keys"""
+    cdef Py_ssize_t series_size = len(series)
+    cdef bytes buf = u'\n'.join(series).encode(ENCODING)
+    if b'\0' in buf or buf.count(b'\n') != series_size - 1:
+        return series
+    cdef list refs = []
+    cdef size_t n_templates = len(graphite_templates)
+    cdef size_t buf_len = len(buf)
+    cdef char *c_sep = separator
+    cdef char *c_buf = NULL, *scratch = NULL
+    cdef char **slots = NULL, **path = NULL, **pool = NULL
+    cdef char **tag_keys = NULL, **tag_values = NULL, **insert_path = NULL
+    cdef char **record_path, **suffix
+    cdef char *line, *next_line, *temp, *token, *value
+    cdef size_t path_capacity, pool_capacity = 16, tags_capacity = 16
+    cdef size_t values_capacity = 16, insert_capacity = 16
+    cdef size_t pool_size = 0, tags_i, max_size = 1, t_i, k
+    cdef Py_ssize_t s_i, path_len
+    cdef _CTemplate *c_templates = NULL
+    cdef _CTemplate *c_template
+    cdef _CSeries *records = NULL
+    cdef _CSeries *record
+    cdef _CFields *entry
+    cdef _CFieldsTable table
+    table.entries = NULL
+    table.buckets = NULL
+    table.size = 0
+    try:
+        c_templates = _compile_templates(graphite_templates, refs)
+        for t_i in range(n_templates):
+            if c_templates[t_i].size > max_size:
+                max_size = c_templates[t_i].size
+        path_capacity = max_size + 1
+        c_buf = <char *>malloc(buf_len + 1)
+        scratch = <char *>malloc(buf_len + 1)
+        records = <_CSeries *>malloc(series_size * sizeof(_CSeries))
+        slots = <char **>malloc((max_size + 1) * sizeof(char *))
+        path = <char **>malloc(path_capacity * sizeof(char *))
+        pool = <char **>malloc(pool_capacity * sizeof(char *))
+        tag_keys = <char **>malloc(tags_capacity * sizeof(char *))
+        tag_values = <char **>malloc(values_capacity * sizeof(char *))
+        insert_path = <char **>malloc(insert_capacity * sizeof(char *))
+        if c_buf is NULL or scratch is NULL or records is NULL \
+           or slots is NULL or path is NULL or pool is NULL \
+           or tag_keys is NULL or tag_values is NULL or insert_path is NULL:
+            raise MemoryError
+        memcpy(c_buf, <char *>buf, buf_len)
+        c_buf[buf_len] = 0
+        _init_fields_table(&table)
+        with nogil:
+            line = c_buf
+            for s_i in range(series_size):
+                next_line = strchr(line, '\n')
+                if next_line is not NULL:
+                    next_line[0] = 0
+                record = &records[s_i]
+                record.template_i = -1
+                record.fields_i = -1
+                record.path_start = 0
+                record.path_len = 0
+                path = _grow_array(path, &path_capacity,
+                                   strlen(line) + max_size + 1)
+                temp = line
+                record.measurement = strsep(&temp, ',')
+                tags_i = 0
+                token = strsep(&temp, ',')
+                while token is not NULL:
+                    value = strchr(token, '=')
+                    if value is not NULL and strchr(token, '\\') is NULL:
+                        # Tags with more than one separator are split
+                        # differently by one by one parsing
+                        if strchr(value + 1, '=') is not NULL:
+                            record.template_i = -2
+                            break
+                        value[0] = 0
+                        tag_keys = _grow_array(
+                            tag_keys, &tags_capacity, tags_i + 1)
+                        tag_values = _grow_array(
+                            tag_values, &values_capacity, tags_i + 1)
+                        tag_keys[tags_i] = token
+                        tag_values[tags_i] = value + 1
+                        tags_i += 1
+                    token = strsep(&temp, ',')
+                if record.template_i == -1:
+                    for t_i in range(n_templates):
+                        c_template = &c_templates[t_i]
+                        path_len = _c_template_path(
+                            c_template, record.measurement, tag_keys,
+                            tag_values, tags_i, slots, path, scratch, c_sep)
+                        if path_len < 0:
+                            record.template_i = -2
+                            break
+                        # Path should be at least as large as number of
+                        # wanted template tags taking into account
+                        # measurement and number of fields in template
+                        if path_len < c_template.min_items or \
+                           not _c_filter_match(c_template, path, path_len):
+                            continue
+                        record.template_i = t_i
+                        # Greedy measurement paths are split again on insert
+                        if not c_template.wildcard:
+                            pool = _grow_array(pool, &pool_capacity,
+                                               pool_size + path_len)
+                            memcpy(&pool[pool_size], path,
+                                   path_len * sizeof(char *))
+                            record.path_start = pool_size
+                            record.path_len = path_len
+                            pool_size += path_len
+                        if c_template.fields:
+                            record.fields_i = _fields_entry(
+                                &table, record.measurement)
+                        break
+                if next_line is NULL:
+                    break
+                line = next_line + 1
+        for t_i in range(table.size):
+            _set_field_suffixes(&table.entries[t_i], fields, separator,
+                                field_suffixes, refs)
+        with nogil:
+            for s_i in range(series_size):
+                record = &records[s_i]
+                if record.template_i < 0:
+                    continue
+                c_template = &c_templates[record.template_i]
+                if c_template.wildcard:
+                    path_len = _c_template_path(
+                        c_template, record.measurement, NULL, NULL, 0,
+                        slots, path, scratch, c_sep)
+                    record_path = path
+                else:
+                    path_len = record.path_len
+                    record_path = &pool[record.path_start]
+                if record.fields_i < 0:
+                    insert_path = _grow_array(
+                        insert_path, &insert_capacity, path_len + 1)
+                    memcpy(insert_path, record_path,
+                           path_len * sizeof(char *))
+                    insert_path[path_len] = NULL
+                    _insert_split_path(index, <const char **>insert_path)
+                    continue
+                entry = &table.entries[record.fields_i]
+                if entry.missing:
+                    continue
+                suffix = entry.tokens
+                for k in range(entry.size):
+                    insert_path = _grow_array(
+                        insert_path, &insert_capacity,
+                        path_len + entry.sizes[k] + 1)
+                    memcpy(insert_path, record_path,
+                           path_len * sizeof(char *))
+                    memcpy(&insert_path[path_len], suffix,
+                           entry.sizes[k] * sizeof(char *))
+                    insert_path[path_len + entry.sizes[k]] = NULL
+                    _insert_split_path(index, <const char **>insert_path)
+                    suffix += entry.sizes[k]
+        return [series[s_i] for s_i in range(series_size)
+                if records[s_i].template_i == -2]
+    finally:
+        if c_templates is not NULL:
+            _free_templates(c_templates, n_templates)
+        _free_fields_table(&table)
+        free(c_buf)
+        free(scratch)
+        free(records)
+        free(slots)
+        free(path)
+        free(pool)
+        free(tag_keys)
+        free(tag_values)
+        free(insert_path)
+
+
+cdef enum:
+    _MATCH_ANY = 0
+    _MATCH_LITERALS = 1
+    _MATCH_PREFIX = 2
+    _MATCH_SUFFIX = 3
+
+
+cdef struct _CMatcher:
+    int kind
+    char **values
+    size_t *sizes
+    size_t size
+
+
+cdef struct _CMatches:
+    cnode.Node **nodes
+    # Matched node names, depth per match
+    char **names
+    size_t size
+    size_t capacity
+    size_t depth
+
+
+cdef int _compile_matchers(tuple matchers, _CMatcher *c_matchers,
+                           list refs) except -1:
+    """Compile query matchers to C matchers.
+
+    Returns 0 if query has matchers that can only be matched by Python"""
+    cdef _CMatcher *c_matcher
+    cdef size_t i, j
+    cdef bytes value
+    cdef list values
+    for i in range(len(matchers)):
+        sub_matcher = matchers[i]
+        c_matcher = &c_matchers[i]
+        if isinstance(sub_matcher, AnyMatcher):
+            c_matcher.kind = _MATCH_ANY
+            continue
+        if isinstance(sub_matcher, (LiteralMatcher, AlternationMatcher)):
+            c_matcher.kind = _MATCH_LITERALS
+            values = list(sub_matcher.literals)
+        elif isinstance(sub_matcher, PrefixMatcher):
+            c_matcher.kind = _MATCH_PREFIX
+            values = [sub_matcher.prefix]
+        elif isinstance(sub_matcher, SuffixMatcher):
+            c_matcher.kind = _MATCH_SUFFIX
+            values = [sub_matcher.suffix]
+        else:
+            return 0
+        c_matcher.values = <char **>malloc(len(values) * sizeof(char *))
+        c_matcher.sizes = <size_t *>malloc(len(values) * sizeof(size_t))
+        if c_matcher.values is NULL or c_matcher.sizes is NULL:
+            raise MemoryError
+        for j in range(len(values)):
+            value = _encode_bytes(values[j])
+            refs.append(value)
+            c_matcher.values[j] = value
+            c_matcher.sizes[j] = len(value)
+        c_matcher.size = len(values)
+    return 1
+
+
+cdef void _free_matchers(_CMatcher *c_matchers, size_t size) nogil:
+    cdef size_t i
+    for i in range(size):
+        free(c_matchers[i].values)
+        free(c_matchers[i].sizes)
+    free(c_matchers)
+
+
+cdef bint _c_match(_CMatcher *c_matcher, const char *name) nogil:
+    cdef size_t i, name_len
+    if c_matcher.kind == _MATCH_ANY:
+        return True
+    if c_matcher.kind == _MATCH_LITERALS:
+        for i in range(c_matcher.size):
+            if strcmp(name, c_matcher.values[i]) == 0:
+                return True
+        return False
+    if c_matcher.kind == _MATCH_PREFIX:
+        return strncmp(name, c_matcher.values[0], c_matcher.sizes[0]) == 0
+    name_len = strlen(name)
+    return name_len >= c_matcher.sizes[0] and memcmp(
+        name + name_len - c_matcher.sizes[0], c_matcher.values[0],
+        c_matcher.sizes[0]) == 0
+
+
+cdef int _compare_nodes(const void *node1, const void *node2) nogil:
+    return strcmp((<cnode.Node **>node1)[0].name,
+                  (<cnode.Node **>node2)[0].name)
+
+
+cdef int _add_match(_CMatches *matches, cnode.Node *node,
+                    char **names) nogil except -1:
+    cdef size_t capacity
+    cdef cnode.Node **new_nodes
+    cdef char **new_names
+    if matches.size >= matches.capacity:
+        capacity = matches.capacity * 2 if matches.capacity else 64
+        new_nodes = <cnode.Node **>realloc(
+            matches.nodes, capacity * sizeof(cnode.Node *))
+        if new_nodes is NULL:
+            with gil:
+                raise MemoryError
+        matches.nodes = new_nodes
+        new_names = <char **>realloc(
+            matches.names, capacity * matches.depth * sizeof(char *))
+        if new_names is NULL:
+            with gil:
+                raise MemoryError
+        matches.names = new_names
+        matches.capacity = capacity
+    matches.nodes[matches.size] = node
+    memcpy(&matches.names[matches.size * matches.depth], names,
+           matches.depth * sizeof(char *))
+    matches.size += 1
+    return 0
+
+
+cdef int _c_search_nodes(cnode.Node *node, _CMatcher *c_matchers,
+                         size_t depth, char **names, char **after,
+                         _CMatches *matches, size_t limit) nogil except -1:
+    """Add nodes matching C matchers to matches in name order, up to limit
+    matches. With `after` names of a path, only nodes whose path sorts after
+    it are added.
+
+    Returns 1 if limit was reached"""
+    cdef cnode.Node **children
+    cdef cnode.Node *child
+    cdef char **child_after
+    cdef size_t i, size = 0
+    cdef int cmp
+    if node.children_i == 0:
+        return 0
+    children = <cnode.Node **>malloc(
+        node.children_i * sizeof(cnode.Node *))
+    if children is NULL:
+        with gil:
+            raise MemoryError
+    try:
+        for i in range(node.children_i):
+            child = &node.children[i]
+            if _c_match(&c_matchers[depth], child.name):
+                children[size] = child
+                size += 1
+        if size > 1:
+            qsort(children, size, sizeof(cnode.Node *), _compare_nodes)
+        for i in range(size):
+            child_after = NULL
+            if after is not NULL:
+                cmp = strcmp(children[i].name, after[depth])
+                if cmp < 0:
+                    continue
+                if cmp == 0:
+                    if depth + 1 == matches.depth:
+                        continue
+                    child_after = after
+            names[depth] = children[i].name
+            if depth + 1 < matches.depth:
+                if _c_search_nodes(children[i], c_matchers, depth + 1, names,
+                                   child_after, matches, limit):
+                    return 1
+            else:
+                _add_match(matches, children[i], names)
+                if matches.size >= limit:
+                    return 1
+    finally:
+        free(children)
+    return 0
+
+
+cdef list _make_matched_nodes(_CMatches *matches):
+    cdef list results = []
+    cdef char *path = NULL
+    cdef char *new_path
+    cdef char **names
+    cdef size_t i, k, path_len, name_len, capacity = 0
+    try:
+        for i in range(matches.size):
+            names = &matches.names[i * matches.depth]
+            path_len = 0
+            for k in range(matches.depth):
+                path_len += strlen(names[k]) + 1
+            if path_len > capacity:
+                new_path = <char *>realloc(path, path_len)
+                if new_path is NULL:
+                    raise MemoryError
+                path = new_path
+                capacity = path_len
+            path_len = 0
+            for k in range(matches.depth):
+                if k > 0:
+                    path[path_len] = 46  # '.'
+                    path_len += 1
+                name_len = strlen(names[k])
+                memcpy(&path[path_len], names[k], name_len)
+                path_len += name_len
+            results.append((path[:path_len].decode(ENCODING),
+                            PyNode_Init(matches.nodes[i])))
+            if i % 1024 == 1023:
+                # Let other threads run while many results are made
+                with nogil:
+                    pass
+        return results
+    finally:
+        free(path)
+
+
+# Number of matches searched for at a time by lazy searches - doubled on
+# each search up to maximum
+cdef enum:
+    _SEARCH_CHUNK = 16
+    _MAX_SEARCH_CHUNK = 16384
+
+
+cdef class _NodeSearch:
+    """Lazy search of node trie index with C matchers.
+
+    Matches are searched for in chunks, each continuing after the last
+    path of the previous one, so that only about as many nodes are matched
+    as are consumed. The index lock is not held between chunks."""
+    cdef Node index
+    cdef _CMatcher *c_matchers
+    cdef size_t depth
+    cdef size_t chunk_size
+    cdef list refs
+    cdef list results
+    cdef size_t pos
+    cdef list after
+    cdef bint done
+    # Number of matches searched for so far
+    cdef readonly size_t matched
+
+    def __cinit__(self, Node index, size_t depth):
+        self.index = index
+        self.depth = depth
+        self.c_matchers = <_CMatcher *>calloc(depth, sizeof(_CMatcher))
+        if self.c_matchers is NULL:
+            raise MemoryError
+        self.chunk_size = _SEARCH_CHUNK
+        self.refs = []
+        self.results = []
+        self.pos = 0
+        self.after = None
+        self.done = False
+        self.matched = 0
+
+    def __dealloc__(self):
+        if self.c_matchers is not NULL:
+            _free_matchers(self.c_matchers, self.depth)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.pos >= len(self.results):
+            if self.done:
+                raise StopIteration
+            self._search()
+            if not self.results:
+                raise StopIteration
+        result = self.results[self.pos]
+        self.pos += 1
+        if self.pos == len(self.results):
+            # Release nodes of consumed chunk
+            self.results = []
+        return result
+
+    cdef _search(self):
+        cdef _CMatches matches
+        cdef pthread_rwlock_t *lock
+        cdef char **names = NULL
+        cdef char **after = NULL
+        cdef size_t k
+        cdef int reached = 0
+        memset(&matches, 0, sizeof(_CMatches))
+        matches.depth = self.depth
+        try:
+            names = <char **>malloc(self.depth * sizeof(char *))
+            if names is NULL:
+                raise MemoryError
+            if self.after is not None:
+                after = <char **>malloc(self.depth * sizeof(char *))
+                if after is NULL:
+                    raise MemoryError
+                for k in range(self.depth):
+                    after[k] = self.after[k]
+            lock = _index_lock(self.index)
+            with nogil:
+                pthread_rwlock_rdlock(lock)
+                try:
+                    if self.index._node is not NULL:
+                        reached = _c_search_nodes(
+                            self.index._node, self.c_matchers, 0, names,
+                            after, &matches, self.chunk_size)
+                finally:
+                    pthread_rwlock_unlock(lock)
+            self.results = _make_matched_nodes(&matches)
+            self.pos = 0
+            self.matched += matches.size
+            if not reached:
+                self.done = True
+                return
+            self.after = [
+                <bytes>matches.names[(matches.size - 1) * self.depth + k]
+                for k in range(self.depth)]
+            if self.chunk_size < _MAX_SEARCH_CHUNK:
+                self.chunk_size *= 2
+        finally:
+            free(names)
+            free(after)
+            free(matches.nodes)
+            free(matches.names)
+
+
+def query_nodes(Node node, query):
+    """Return nodes of node trie index matching Graphite glob pattern query.
+
+    Matching runs without the GIL so that other threads can make progress
+    while large indexes are searched. Nodes are matched lazily, in
+    chunks, as results are consumed. Queries with character classes,
+    '?' or several wildcards in a sub-part are matched by
+    :mod:`influxgraph.classes.matcher.query_nodes` instead.
+
+    :param node: Index to query
+    :type node: :mod:`influxgraph.ext.nodetrie.Node`
+    :param query: Graphite glob pattern query
+    :type query: str
+
+    :rtype: iterator of (path, node) tuples sorted by path
+    """
+    cdef tuple matchers = compile_query(query)
+    cdef _NodeSearch search = _NodeSearch(node, len(matchers))
+    if not _compile_matchers(matchers, search.c_matchers, search.refs):
+        return _matcher.query_nodes(node, query)
+    return search
+
+
+cdef class _ChildMatcher:
+    """C matcher of a sub-query for children of node trie index nodes"""
+    cdef _CMatcher *c_matcher
+    cdef object matcher
+    cdef list refs
+    cdef bint compiled
+    cdef Node index
+
+    def __cinit__(self, matcher, Node index):
+        self.c_matcher = <_CMatcher *>calloc(1, sizeof(_CMatcher))
+        if self.c_matcher is NULL:
+            raise MemoryError
+        self.matcher = matcher
+        self.index = index
+        self.refs = []
+        self.compiled = _compile_matchers(
+            (matcher,), self.c_matcher, self.refs)
+
+    def __dealloc__(self):
+        if self.c_matcher is not NULL:
+            _free_matchers(self.c_matcher, 1)
+
+    cdef list match_children(self, Node node):
+        """Return (name, child) items of children of node matching
+        sub-query, sorted by name"""
+        cdef cnode.Node **children = NULL
+        cdef cnode.Node *c_node = node._node
+        cdef pthread_rwlock_t *lock
+        cdef size_t i, size = 0
+        if not self.compiled:
+            return _matcher._get_matched_node_children(self.matcher, node)
+        if c_node is NULL:
+            return []
+        lock = _index_lock(self.index)
+        try:
+            with nogil:
+                pthread_rwlock_rdlock(lock)
+                try:
+                    if c_node.children_i:
+                        children = <cnode.Node **>malloc(
+                            c_node.children_i * sizeof(cnode.Node *))
+                    if children is not NULL:
+                        for i in range(c_node.children_i):
+                            if _c_match(self.c_matcher,
+                                        c_node.children[i].name):
+                                children[size] = &c_node.children[i]
+                                size += 1
+                        if size > 1:
+                            qsort(children, size, sizeof(cnode.Node *),
+                                  _compare_nodes)
+                finally:
+                    pthread_rwlock_unlock(lock)
+            if c_node.children_i and children is NULL:
+                raise MemoryError
+            return [((<bytes>children[i].name).decode(ENCODING),
+                     PyNode_Init(children[i])) for i in range(size)]
+        finally:
+            free(children)
+
+
+def query_many_nodes(Node node, queries):
+    """Return nodes of node trie index matching each of many Graphite glob
+    pattern queries with one walk of the index.
+
+    Queries are merged into a prefix tree of their sub-queries, see
+    :mod:`influxgraph.classes.matcher.search_many`. Children of each node
+    are matched by each sub-query without the GIL, see :mod:`query_nodes`
+
+    :rtype: dict of query to list of (path, node) tuples sorted by path
+    """
+    child_matchers = {}
+
+    def get_matched_children(matcher, Node child):
+        # Sub-query matchers are kept alive by the query tree for the
+        # duration of the search
+        child_matcher = child_matchers.get(id(matcher))
+        if child_matcher is None:
+            child_matcher = child_matchers[id(matcher)] = _ChildMatcher(
+                matcher, node)
+        return (<_ChildMatcher>child_matcher).match_children(child)
+    return _matcher.search_many(node, queries, get_matched_children)
+
+
+cdef enum:
+    # Index file name id bits, without leaf branch flag
+    _NAME_ID_MASK = 0x7FFFFFFF
+
+
+cdef struct _CIndexFile:
+    # Node table and string table of index file
+    unsigned int *records
+    unsigned int *offsets
+    const char *data
+
+
+cdef bint _is_valid_index_file(_CIndexFile *index_file, size_t node_count,
+                               size_t string_count, size_t data_size) nogil:
+    """Check node table and string table references are in range, and that
+    children come after their parents so that merging terminates"""
+    cdef size_t i
+    cdef unsigned int first_child, child_count
+    for i in range(string_count):
+        if index_file.offsets[i] > index_file.offsets[i + 1] \
+           or index_file.offsets[i + 1] > data_size:
+            return False
+    for i in range(node_count):
+        first_child = index_file.records[3*i + 1]
+        child_count = index_file.records[3*i + 2]
+        # Root node has no name
+        if i and (index_file.records[3*i] & _NAME_ID_MASK) >= string_count:
+            return False
+        if child_count and (first_child <= i or
+                            first_child + child_count > node_count):
+            return False
+    return True
+
+
+cdef int _set_node_name(cnode.Node *node, _CIndexFile *index_file,
+                        size_t node_id) nogil except -1:
+    cdef unsigned int name_id = index_file.records[3*node_id] & _NAME_ID_MASK
+    node.name = strndup(
+        index_file.data + index_file.offsets[name_id],
+        index_file.offsets[name_id + 1] - index_file.offsets[name_id])
+    if node.name is NULL:
+        with gil:
+            raise MemoryError
+    node.children_i = 0
+    node.children_size = 1
+    node.children = NULL
+    return 0
+
+
+cdef int _build_nodes(cnode.Node *node, _CIndexFile *index_file,
+                      size_t node_id) nogil except -1:
+    """Build children of new node from index file node's sub-tree"""
+    cdef size_t i
+    cdef unsigned int first_child = index_file.records[3*node_id + 1]
+    cdef unsigned int child_count = index_file.records[3*node_id + 2]
+    if not child_count:
+        return 0
+    node.children = <cnode.Node *>calloc(child_count, sizeof(cnode.Node))
+    if node.children is NULL:
+        with gil:
+            raise MemoryError
+    node.children_size = child_count
+    for i in range(child_count):
+        _set_node_name(&node.children[i], index_file, first_child + i)
+        node.children_i += 1
+        _build_nodes(&node.children[i], index_file, first_child + i)
+    return 0
+
+
+cdef int _compare_child_names(const void *child1, const void *child2) nogil:
+    return strcmp((<cnode.Node **>child1)[0].name,
+                  (<cnode.Node **>child2)[0].name)
+
+
+cdef cnode.Node * _find_child(cnode.Node **children, size_t size,
+                              const char *name, size_t name_len) nogil:
+    """Binary search children sorted by name for name of given length, not
+    NUL terminated"""
+    cdef size_t low = 0, high = size, mid
+    cdef int cmp
+    while low < high:
+        mid = (low + high) // 2
+        cmp = strncmp(children[mid].name, name, name_len)
+        if cmp == 0 and children[mid].name[name_len] != 0:
+            cmp = 1
+        if cmp < 0:
+            low = mid + 1
+        elif cmp > 0:
+            high = mid
+        else:
+            return children[mid]
+    return NULL
+
+
+cdef int _merge_nodes(cnode.Node *node, _CIndexFile *index_file,
+                      size_t node_id) nogil except -1:
+    """Merge index file node's sub-tree into node. Sub-trees of children not
+    in node are built as they are, without looking up their paths"""
+    cdef size_t i, existing = node.children_i
+    cdef unsigned int first_child = index_file.records[3*node_id + 1]
+    cdef unsigned int child_count = index_file.records[3*node_id + 2]
+    cdef unsigned int name_id
+    cdef cnode.Node *child
+    cdef cnode.Node *new_children
+    # Existing children, sorted by name for look up
+    cdef cnode.Node **children = NULL
+    if not child_count:
+        return 0
+    if not existing:
+        free(node.children)
+        node.children = NULL
+        node.children_size = 1
+        return _build_nodes(node, index_file, node_id)
+    # Make room for all children up front so that children do not move
+    # while merging
+    if node.children_size < existing + child_count:
+        new_children = <cnode.Node *>realloc(
+            node.children, (existing + child_count) * sizeof(cnode.Node))
+        if new_children is NULL:
+            with gil:
+                raise MemoryError
+        node.children = new_children
+        node.children_size = existing + child_count
+    memset(&node.children[existing], 0,
+           (node.children_size - existing) * sizeof(cnode.Node))
+    children = <cnode.Node **>malloc(existing * sizeof(cnode.Node *))
+    if children is NULL:
+        with gil:
+            raise MemoryError
+    try:
+        for i in range(existing):
+            children[i] = &node.children[i]
+        qsort(children, existing, sizeof(cnode.Node *), _compare_child_names)
+        for i in range(first_child, first_child + child_count):
+            name_id = index_file.records[3*i] & _NAME_ID_MASK
+            child = _find_child(
+                children, existing, index_file.data + index_file.offsets[name_id],
+                index_file.offsets[name_id + 1] - index_file.offsets[name_id])
+            if child is NULL:
+                child = &node.children[node.children_i]
+                _set_node_name(child, index_file, i)
+                node.children_i += 1
+                _build_nodes(child, index_file, i)
+            else:
+                _merge_nodes(child, index_file, i)
+    finally:
+        free(children)
+    return 0
+
+
+cdef int _init_root(Node index) nogil except -1:
+    # Same as nodetrie's init_node, which this extension is not linked with
+    index._node = <cnode.Node *>malloc(sizeof(cnode.Node))
+    if index._node is NULL:
+        with gil:
+            raise MemoryError
+    index._node.name = NULL
+    index._node.children_i = 0
+    index._node.children_size = 1
+    index._node.children = NULL
+    return 0
+
+
+def merge_index_file(Node index, bytes data):
+    """Merge index in binary index file format into node trie index.
+
+    Index nodes are built directly from the file's node table without the
+    GIL - sub-trees not already in the index are built as they are and
+    others merged level by level.
+
+    :param index: Index to merge into
+    :type index: :mod:`influxgraph.ext.nodetrie.Node`
+    :param data: Index file contents
+    :raises: :mod:`influxgraph.classes.index_file.IndexFileError` on invalid
+      index file
+    """
+    cdef _CIndexFile index_file
+    cdef pthread_rwlock_t *lock = _index_lock(index)
+    cdef unsigned int[::1] records, offsets
+    cdef const char *c_data = data
+    header = read_header(data)
+    verify_checksum(data, header)
+    records = _array_from_bytes(
+        data[header.nodes_offset:header.leaves_offset])
+    offsets = _array_from_bytes(
+        data[header.offsets_offset:header.data_offset])
+    index_file.records = &records[0]
+    index_file.offsets = &offsets[0]
+    index_file.data = c_data + <size_t>header.data_offset
+    if not _is_valid_index_file(&index_file, header.node_count,
+                                header.string_count, header.data_size):
+        raise IndexFileError("Index file node or string table is invalid")
+    with nogil:
+        pthread_rwlock_wrlock(lock)
+        try:
+            if index._node is NULL:
+                _init_root(index)
+            _merge_nodes(index._node, &index_file, 0)
+        finally:
+            pthread_rwlock_unlock(lock)
+
+
+cdef int _compare_node_names(const void *node1, const void *node2) nogil:
+    return strcmp((<cnode.Node **>node1)[0].name,
+                  (<cnode.Node **>node2)[0].name)
+
+
+def compact_index(Node index):
+    """Make compact index from node trie index.
+
+    Same as :mod:`influxgraph.classes.index_file.CompactIndex.from_index`
+    without a node object per node of the index - nodes are walked breadth
+    first with children sorted by name, as in index files.
+
+    :rtype: :mod:`influxgraph.classes.index_file.CompactIndex`
+    """
+    cdef pthread_rwlock_t *lock = _index_lock(index)
+    # Breadth first node table - node pointer and (name id, first child,
+    # child count) record per node
+    cdef cnode.Node **nodes = NULL
+    cdef unsigned int *records = NULL
+    cdef void *new_table
+    cdef cnode.Node *node
+    cdef size_t node_id = 0, node_count = 1, nodes_size = 1024, i
+    cdef dict name_ids = {}
+    cdef list names = []
+    cdef bytes name
+    cdef object name_id
+    with nogil:
+        pthread_rwlock_rdlock(lock)
+    try:
+        nodes = <cnode.Node **>malloc(nodes_size * sizeof(cnode.Node *))
+        records = <unsigned int *>malloc(
+            3 * nodes_size * sizeof(unsigned int))
+        if nodes is NULL or records is NULL:
+            raise MemoryError
+        nodes[0] = index._node
+        records[0] = NO_NAME
+        while node_id < node_count:
+            node = nodes[node_id]
+            if node is NULL or node.children_i == 0:
+                records[3*node_id + 1] = records[3*node_id + 2] = 0
+                node_id += 1
+                continue
+            if node_count + node.children_i > _MAX_UINT32:
+                raise IndexFileError("Index too large for compact index")
+            records[3*node_id + 1] = node_count
+            records[3*node_id + 2] = node.children_i
+            node_id += 1
+            if node_count + node.children_i > nodes_size:
+                nodes_size = 2 * (node_count + node.children_i)
+                new_table = realloc(nodes, nodes_size * sizeof(cnode.Node *))
+                if new_table is NULL:
+                    raise MemoryError
+                nodes = <cnode.Node **>new_table
+                new_table = realloc(
+                    records, 3 * nodes_size * sizeof(unsigned int))
+                if new_table is NULL:
+                    raise MemoryError
+                records = <unsigned int *>new_table
+            for i in range(node.children_i):
+                nodes[node_count + i] = &node.children[i]
+            qsort(&nodes[node_count], node.children_i,
+                  sizeof(cnode.Node *), _compare_node_names)
+            for i in range(node_count, node_count + node.children_i):
+                name = nodes[i].name
+                name_id = name_ids.get(name)
+                if name_id is None:
+                    name_id = name_ids[name] = len(names)
+                    names.append(name)
+                records[3*i] = name_id
+            node_count += node.children_i
+        table = array(_UINT32, (<char *>records)[
+            :3 * node_count * sizeof(unsigned int)])
+    finally:
+        pthread_rwlock_unlock(lock)
+        free(nodes)
+        free(records)
+    if len(names) > _NAME_ID_MASK:
+        raise IndexFileError("Index too large for compact index")
+    child_counts = table[2::3]
+    return CompactIndex(names, table[0::3], table[1::3], child_counts,
+                        _get_leaf_counts(child_counts))
+
+
 cpdef list heapsort(list iterable):
     cdef list h = []
     cdef tuple value
@@ -215,12 +1469,12 @@ cpdef list heapsort(list iterable):
 
 cdef list c_get_series_with_tags(bytes measurement, char **tags_values,
                                  dict all_fields,
-                                 list graphite_templates,
+                                 graphite_templates,
                                  size_t tags_size,
-                                 char *c_sep):
+                                 char *c_sep,
+                                 dict field_suffixes):
     cdef list series = []
     cdef list split_path
-    cdef dict template
     split_path, template = c_split_series_with_tags(
         measurement, tags_values, tags_size, graphite_templates, c_sep)
     if len(split_path) == 0:
@@ -230,8 +1484,9 @@ cdef list c_get_series_with_tags(bytes measurement, char **tags_values,
     if 'field' in values or 'field*' in values:
         try:
             _add_fields_to_paths(
-                all_fields[measurement.decode(ENCODING)],
-                split_path, series, c_sep)
+                _get_field_suffixes(all_fields, measurement.decode(ENCODING),
+                                    c_sep, field_suffixes),
+                split_path, series)
             # _c_add_fields_to_paths(
             #     all_fields[measurement], split_path, series, c_sep)
         except KeyError:
@@ -242,11 +1497,11 @@ cdef list c_get_series_with_tags(bytes measurement, char **tags_values,
 
 
 cpdef list get_series_with_tags(list paths, dict all_fields,
-                                list graphite_templates,
-                                bytes separator=b'.'):
+                                graphite_templates,
+                                bytes separator=b'.',
+                                dict field_suffixes=None):
     cdef list series = []
     cdef list split_path
-    cdef dict template
     split_path, template = _split_series_with_tags(paths, graphite_templates,
                                                    separator)
     if len(split_path) == 0:
@@ -256,7 +1511,9 @@ cpdef list get_series_with_tags(list paths, dict all_fields,
     if 'field' in values or 'field*' in values:
         try:
             _add_fields_to_paths(
-                all_fields[paths[0]], split_path, series, separator)
+                _get_field_suffixes(all_fields, paths[0], separator,
+                                    field_suffixes),
+                split_path, series)
         except KeyError:
             logger.warning("Measurement %s not in field list", paths[0])
         return series
@@ -274,9 +1531,8 @@ cdef inline char * _copy_token(char *_copy_to, char *token) nogil except NULL:
 
 cdef tuple c_split_series_with_tags(bytes measurement, char **tags_values,
                                     size_t tags_size,
-                                    list graphite_templates,
+                                    graphite_templates,
                                     char *c_sep):
-    cdef dict template = None
     cdef char *token, *to_free, *temp
     cdef size_t tags_i = 0
     cdef char ***split_tags_values = <char ***>malloc(
@@ -331,75 +1587,96 @@ cdef tuple c_split_series_with_tags(bytes measurement, char **tags_values,
 cdef tuple c_make_path_with_tags(bytes measurement,
                                  char ***split_tags_values,
                                  size_t tags_i,
-                                 list graphite_templates,
+                                 graphite_templates,
                                  char *c_sep):
     """Make path from split tags and template"""
-    cdef list split_path = []
+    cdef list split_path
     cdef Py_ssize_t field_inds
     cdef Py_ssize_t num_tmpl_items
-    for (_filter, template, _, separator) in graphite_templates:
-        _c_make_path_from_template(
-            split_path, measurement, template, split_tags_values, tags_i, c_sep)
-        # Split path should be at least as large as number of wanted
+    candidates = graphite_templates
+    if len(graphite_templates) > 1:
+        candidates = get_template_candidates(
+            graphite_templates, tuple([
+                (<bytes>split_tags_values[i][0]).decode(ENCODING)
+                for i in range(tags_i)]))
+    cdef list path
+    template = None
+    for (_filter, template, _, separator) in candidates:
+        path = None
+        if isinstance(template, TemplateTagIndex):
+            path = _c_make_path_from_positions(
+                measurement, template, split_tags_values, tags_i, c_sep)
+            num_tmpl_items = template.num_items
+            field_inds = template.field_inds
+        if path is None:
+            split_path = []
+            _c_make_path_from_template(
+                split_path, measurement, template, split_tags_values, tags_i,
+                c_sep)
+            path = [p[1].decode(ENCODING) for p in heapsort(split_path)]
+            num_tmpl_items = len([k for k, v in template.items() if v])
+            field_inds = len([v for v in template.values()
+                              if v and 'field' in v])
+        # Path should be at least as large as number of wanted
         # template tags taking into account measurement and number of fields
         # in template
-        num_tmpl_items = len([k for k, v in template.items() if v])
-        field_inds = len([v for v in template.values()
-                          if v and 'field' in v])
-        if (len(split_path) + field_inds) >= num_tmpl_items:
-            path = [p[1].decode(ENCODING) for p in heapsort(split_path)]
+        if (len(path) + field_inds) >= num_tmpl_items:
             if _filter:
                 if _filter.match_split_path(path):
                     return path, template
             else:
                 return path, template
-            split_path = []
-            continue
-        # Reset path if template does not match
-        split_path = []
     return [], template
 
 
-cdef tuple _split_series_with_tags(list paths, list graphite_templates,
+cdef tuple _split_series_with_tags(list paths, graphite_templates,
                                    bytes separator):
-    cdef list split_path = []
-    cdef dict template = None
+    cdef list split_path
     cdef list tags_values = [p.split('=') for p in paths[1:]]
+    cdef unicode u_separator = separator.decode(ENCODING)
     cdef Py_ssize_t field_inds
     cdef Py_ssize_t num_tmpl_items
     cdef list path
+    template = None
+    candidates = graphite_templates
+    if len(graphite_templates) > 1:
+        candidates = get_template_candidates(
+            graphite_templates, tuple([tag_val[0] for tag_val in tags_values]))
     # TODO - Configurable separator
-    for (_filter, template, _, _) in graphite_templates:
-        _make_path_from_template(
-            split_path, paths[0], template, tags_values, separator)
-        # Split path should be at least as large as number of wanted
+    for (_filter, template, _, _) in candidates:
+        path = None
+        if isinstance(template, TemplateTagIndex):
+            path = _make_path_from_positions(
+                paths[0], template, tags_values, u_separator)
+            num_tmpl_items = template.num_items
+            field_inds = template.field_inds
+        if path is None:
+            split_path = []
+            _make_path_from_template(
+                split_path, paths[0], template, tags_values, separator)
+            path = [p[1] for p in heapsort(split_path)]
+            num_tmpl_items = len([k for k, v in template.items() if v])
+            field_inds = len([v for v in template.values()
+                              if v and 'field' in v])
+        # Path should be at least as large as number of wanted
         # template tags taking into account measurement and number of fields
         # in template
-        num_tmpl_items = len([k for k, v in template.items() if v])
-        field_inds = len([v for v in template.values()
-                          if v and 'field' in v])
-        if (len(split_path) + field_inds) >= num_tmpl_items:
-            path = [p[1] for p in heapsort(split_path)]
+        if (len(path) + field_inds) >= num_tmpl_items:
             if _filter:
                 if _filter.match_split_path(path):
                     return path, template
             else:
                 return path, template
-            split_path = []
-            continue
-        # Reset path if template does not match
-        else:
-            split_path = []
     return [], template
 
 
-cdef _get_first_not_none_tmpl_val(dict template):
+cdef _get_first_not_none_tmpl_val(template):
     for t in template.values():
         if t:
             return t
 
 
-cdef _get_measurement_idx(dict template):
+cdef _get_measurement_idx(template):
     for key in template:
         if template[key] == 'measurement':
             return key
@@ -429,7 +1706,7 @@ cdef int _split_measurement(list split_path,
 
 cdef int _c_make_path_from_template(list split_path,
                                     bytes measurement,
-                                    dict template, char ***tags_values,
+                                    template, char ***tags_values,
                                     size_t tags_i,
                                     char *c_sep) except -1:
     cdef bint measurement_found = 0
@@ -450,7 +1727,7 @@ cdef int _c_make_path_from_template(list split_path,
                 continue
             b_tmpl_tag_key = _encode_bytes(tmpl_tag_key)
             c_tmpl_tag_key = b_tmpl_tag_key
-            if strncmp(tag_key, c_tmpl_tag_key, len(b_tmpl_tag_key)) == 0:
+            if strcmp(tag_key, c_tmpl_tag_key) == 0:
                 # Take copy of tag value so the array can be freed
                 b_tag_val = tag_val
                 split_path.append((i, b_tag_val))
@@ -460,14 +1737,77 @@ cdef int _c_make_path_from_template(list split_path,
     return 0
 
 
+cdef list _c_make_path_from_positions(bytes measurement, template,
+                                     char ***tags_values, size_t tags_i,
+                                     char *c_sep):
+    """Make path in template order from template tag positions. Returns
+    `None` if tags need to be matched one by one with
+    :mod:`_c_make_path_from_template`"""
+    cdef list split_path
+    cdef list slots
+    cdef dict positions
+    cdef frozenset measurement_keys
+    cdef bytes tag_key
+    cdef Py_ssize_t i
+    if template.measurement_wildcard:
+        split_path = []
+        _split_measurement(split_path, measurement, c_sep)
+        return [p[1].decode(ENCODING) for p in split_path]
+    # Measurement without tags
+    elif tags_i == 0:
+        return [measurement.decode(ENCODING)]
+    positions = template.encoded_positions
+    measurement_keys = template.encoded_measurement_keys
+    slots = [None] * len(template)
+    for tag in tags_values[:tags_i]:
+        tag_key = tag[0]
+        if tag_key in measurement_keys:
+            return
+        for i in positions.get(tag_key, ()):
+            if slots[i] is not None:
+                return
+            slots[i] = (<bytes>tag[1]).decode(ENCODING)
+    slots[<Py_ssize_t>template.measurement_idx] = measurement.decode(ENCODING)
+    return [value for value in slots if value is not None]
+
+
+cdef list _make_path_from_positions(unicode measurement, template,
+                                    list tags_values, unicode separator):
+    """Make path in template order from template tag positions. Returns
+    `None` if tags need to be matched one by one with
+    :mod:`_make_path_from_template`"""
+    cdef list slots
+    cdef list tag_value
+    cdef dict positions
+    cdef frozenset measurement_keys
+    cdef Py_ssize_t i
+    if not tags_values:
+        if template.measurement_wildcard and separator in measurement:
+            return measurement.split(separator)
+        return [measurement]
+    positions = template.positions
+    measurement_keys = template.measurement_keys
+    slots = [None] * len(template)
+    for tag_value in tags_values:
+        if len(tag_value) != 2 or tag_value[0] in measurement_keys:
+            return
+        for i in positions.get(tag_value[0], ()):
+            if slots[i] is not None:
+                return
+            slots[i] = tag_value[1]
+    slots[<Py_ssize_t>template.measurement_idx] = measurement
+    return [value for value in slots if value is not None]
+
+
 cpdef int _make_path_from_template(list split_path, unicode measurement,
-                                   dict template, list tags_values,
+                                   template, list tags_values,
                                    bytes separator) except -1:
     cdef bint measurement_found = 0
     cdef Py_ssize_t i
-    if not tags_values and separator.decode(ENCODING) in measurement and \
+    cdef unicode u_separator = separator.decode(ENCODING)
+    if not tags_values and u_separator in measurement and \
       _get_first_not_none_tmpl_val(template) == 'measurement*':
-        for i, measurement in enumerate(measurement.split(separator)):
+        for i, measurement in enumerate(measurement.split(u_separator)):
             split_path.append((i, measurement))
         return 0
     # Measurement without tags
@@ -548,53 +1888,62 @@ cpdef int _make_path_from_template(list split_path, unicode measurement,
 #         free(field_keys)
 
 
-cdef int _add_fields_to_paths(list fields, list split_path, list series,
-                              bytes separator) except -1:
+cdef list _split_field_keys(list fields, bytes separator):
     cdef unicode field_key
+    cdef unicode u_separator = separator.decode(ENCODING)
+    cdef list field_suffixes = []
     cdef list field_keys
     cdef unicode f
     for field_key in fields:
-        field_keys = [f for f in field_key.split(separator.decode(ENCODING))
+        field_keys = [f for f in field_key.split(u_separator)
                       if f != 'value']
         if len(field_keys) > 0:
-            series.append(split_path + field_keys)
+            field_suffixes.append(field_keys)
+    return field_suffixes
+
+
+cdef list _get_field_suffixes(dict all_fields, unicode measurement,
+                              bytes separator, dict field_suffixes):
+    """Get field keys of measurement split on separator, from cache of
+    field suffixes if provided. Raises `KeyError` if measurement is not in
+    field keys"""
+    cdef list suffixes
+    if field_suffixes is None:
+        return _split_field_keys(all_fields[measurement], separator)
+    try:
+        return field_suffixes[measurement]
+    except KeyError:
+        suffixes = _split_field_keys(all_fields[measurement], separator)
+        field_suffixes[measurement] = suffixes
+        return suffixes
+
+
+cdef int _add_fields_to_paths(list field_suffixes, list split_path,
+                              list series) except -1:
+    cdef list field_keys
+    for field_keys in field_suffixes:
+        series.append(split_path + field_keys)
     return 0
 
 #
 ### Data parsing
 #
-def _retrieve_named_field_data(infl_data, measurement_data, measurement,
-                               tags, _data, bytes separator=b'.'):
-    measurement_paths = measurement_data[measurement]['paths'][:]
-    for field in measurement_data[measurement]['fields']:
-        split_path = []
-        _make_path_from_template(
-            split_path, measurement,
-            measurement_data[measurement]['template'], list(tags.items()),
-            separator=separator)
-        split_path = [p[1] for p in heapsort(split_path)]
-        split_path.append(field)
-        metric = separator.decode(ENCODING).join(split_path)
-        if metric not in measurement_paths:
+def _retrieve_series_data(infl_data, dict measurement_data, measurement,
+                          dict tags, dict _data):
+    cdef dict series_data = measurement_data[measurement]
+    cdef list points = None
+    # Series are mapped to paths on their tags in paths' templates
+    cdef set tag_keys = series_data['tag_keys']
+    series_key = frozenset([(tag, value) for (tag, value) in tags.items()
+                            if value and tag in tag_keys])
+    for field in series_data['fields']:
+        metric = series_data['series'].get((series_key, field))
+        if metric is None or metric in _data:
             continue
-        del measurement_paths[measurement_paths.index(metric)]
-        _data[metric] = [d[field]
-                         for d in infl_data.get_points(
-                                 measurement=measurement, tags=tags)]
-    measurement_data[measurement]['paths'] = measurement_paths
-
-
-def _retrieve_field_data(infl_data, dict measurement_data, measurement,
-                         metric, tags, _data):
-    # Retrieve value field data
-    if 'value' in measurement_data[measurement]['fields']:
-        _data[metric] = [d['value']
-                         for d in infl_data.get_points(
-                                 measurement=measurement, tags=tags)]
-        return
-    # Retrieve non value named field data with fields from measurement_data
-    _retrieve_named_field_data(infl_data, measurement_data,
-                               measurement, tags, _data)
+        if points is None:
+            points = list(infl_data.get_points(
+                measurement=measurement, tags=tags))
+        _data[metric] = [d[field] for d in points]
 
 
 def _read_measurement_metric_values(infl_data, measurement,
@@ -607,12 +1956,13 @@ def _read_measurement_metric_values(infl_data, measurement,
 
 
 def read_influxdb_values(influxdb_data, list paths, dict measurement_data):
-    """Return metric path -> datapoints dict for values from InfluxDB data"""
+    """Return metric path -> datapoints dict for values from InfluxDB data.
+
+    Returned series are mapped to metric paths via the (tag set, field) to
+    path mapping of their measurement in measurement data, if any"""
     _data = {}
     if not isinstance(influxdb_data, list):
         influxdb_data = [influxdb_data]
-    cdef size_t m_path_ind = 0
-    seen_measurements = set()
     for infl_data in influxdb_data:
         for infl_keys in infl_data.keys():
             measurement = infl_keys[0]
@@ -623,17 +1973,6 @@ def read_influxdb_values(influxdb_data, list paths, dict measurement_data):
                 continue
             elif measurement not in measurement_data:
                 continue
-            if measurement not in seen_measurements:
-                seen_measurements = set(
-                    tuple(seen_measurements) + (measurement,))
-                m_path_ind = 0
-            elif len(measurement_data[measurement]['paths']) == 0:
-                # No paths left for measurement
-                continue
-            elif m_path_ind >= len(measurement_data[measurement]['paths']):
-                m_path_ind = 0
-            metric = measurement_data[measurement]['paths'][m_path_ind]
-            m_path_ind += 1
-            _retrieve_field_data(infl_data, measurement_data,
-                                 measurement, metric, tags, _data)
+            _retrieve_series_data(infl_data, measurement_data,
+                                  measurement, tags, _data)
     return _data
@@ -26,6 +26,9 @@ from .constants import ENCODING
 
 
 logger = logging.getLogger('influxgraph')
+# Maximum number of distinct series tag key signatures to cache
+# candidate templates for
+MAX_TEMPLATE_SIGNATURES = 1024
 
 
 class TemplateFilter(object):
@@ -61,6 +64,102 @@ class TemplateFilter(object):
         return True
 
 
+class TemplateTagIndex(dict):
+    """Tag name per path position of a parsed template.
+
+    Positions of each tag name in template are computed once at parse time
+    so that paths of series are assembled directly in template order."""
+
+    def __init__(self, tags):
+        dict.__init__(self, tags)
+        self.positions = {}
+        self.measurement_idx = None
+        self.num_items, self.field_inds = 0, 0
+        for i, tag in self.items():
+            if not tag:
+                continue
+            self.num_items += 1
+            if 'field' in tag:
+                self.field_inds += 1
+            if 'measurement' in tag and self.measurement_idx is None:
+                self.measurement_idx = i
+            self.positions.setdefault(tag, []).append(i)
+        self.measurement_keys = frozenset(
+            [tag for tag in self.positions if 'measurement' in tag])
+        self.measurement_wildcard = _get_first_not_none_tmpl_val(
+            self) == 'measurement*'
+        self.encoded_positions = dict(
+            [(tag.encode(ENCODING), positions)
+             for (tag, positions) in self.positions.items()])
+        self.encoded_measurement_keys = frozenset(
+            [tag.encode(ENCODING) for tag in self.measurement_keys])
+
+    def make_path(self, measurement, tags_values, separator='.'):
+        """Make path of series from its measurement and tag key/values
+        in template order.
+
+        :returns: Path values or `None` if tag keys are repeated, name
+          a measurement position or are not key/value pairs, in which case
+          path needs to be made with :mod:`_make_path_from_template`
+        :rtype: list(str)"""
+        if not tags_values:
+            if self.measurement_wildcard and separator in measurement:
+                return measurement.split(separator)
+            return [measurement]
+        slots = [None] * len(self)
+        for tag_value in tags_values:
+            if len(tag_value) != 2 or tag_value[0] in self.measurement_keys:
+                return
+            for i in self.positions.get(tag_value[0], ()):
+                if slots[i] is not None:
+                    return
+                slots[i] = tag_value[1]
+        slots[self.measurement_idx] = measurement
+        return [value for value in slots if value is not None]
+
+
+class GraphiteTemplates(list):
+    """Parsed graphite templates in configured order, as returned by
+    :mod:`parse_influxdb_graphite_templates`.
+
+    Templates that can possibly match a series are compiled per template
+    from their tag keys so that series only try candidate templates.
+    Candidates are cached per tag key signature of series and keep
+    configured order, so first matching template is unchanged."""
+
+    def __init__(self, templates=()):
+        list.__init__(self, templates)
+        self._dispatch = []
+        self._candidates = {}
+
+    def _compile(self):
+        self._dispatch = [_compile_template_dispatch(template)
+                          for (_, template, _, _) in self]
+        self._candidates = {}
+
+    def candidates(self, tag_keys):
+        """Get templates that can match series with given tag keys
+
+        :param tag_keys: Tag keys of series in series order
+        :type tag_keys: tuple(str)
+
+        :rtype: list(tuple)"""
+        if len(self._dispatch) != len(self):
+            self._compile()
+        try:
+            return self._candidates[tag_keys]
+        except KeyError:
+            pass
+        candidates = [parsed for (parsed, (wildcard, key_counts, min_keys))
+                      in zip(self, self._dispatch)
+                      if wildcard or min_keys <= 0 or sum(
+                          [key_counts.get(key, 0) for key in tag_keys])
+                      >= min_keys]
+        if len(self._candidates) < MAX_TEMPLATE_SIGNATURES:
+            self._candidates[tag_keys] = candidates
+        return candidates
+
+
 class InvalidTemplateError(Exception):
     """Raised on Graphite template configuration validation errors"""
     pass
@@ -99,7 +198,7 @@ def parse_influxdb_graphite_templates(templates, separator='.'):
     """
     # Logic converted to Python from InfluxDB's Golang Graphite template parsing
     # Format is [filter] <template> [tag1=value1,tag2=value2]
-    parsed_templates = []
+    parsed_templates = GraphiteTemplates()
     for pattern in templates:
         template = pattern
         _filter = ""
@@ -128,6 +227,38 @@ def parse_influxdb_graphite_templates(templates, separator='.'):
     return parsed_templates
 
 
+def _compile_template_dispatch(template):
+    # A template matches when its built path has at least as many items as
+    # non-field template items. Each series tag key adds one path item per
+    # template item with same key and the measurement adds at most one, so
+    # templates needing more than that can never match. Greedy measurement
+    # templates build their path from the measurement itself.
+    wildcard = _get_first_not_none_tmpl_val(template) == 'measurement*'
+    key_counts = {}
+    num_items, field_inds = 0, 0
+    for tag in template.values():
+        if not tag:
+            continue
+        num_items += 1
+        if 'field' in tag:
+            field_inds += 1
+        key_counts[tag] = key_counts.get(tag, 0) + 1
+    return wildcard, key_counts, num_items - field_inds - 1
+
+
+def get_template_candidates(graphite_templates, tag_keys):
+    """Get templates from parsed graphite templates that can match series
+    with given tag keys, in configured order
+
+    :param graphite_templates: Parsed graphite templates
+    :param tag_keys: Tag keys of series
+    :type tag_keys: tuple(str)"""
+    try:
+        return graphite_templates.candidates(tag_keys)
+    except AttributeError:
+        return graphite_templates
+
+
 def _template_sanity_check(template):
     field = ""
     measurement_wildcard, field_wildcard = False, False
@@ -191,16 +322,19 @@ def _generate_template_tag_index(template):
         if not tag:
             tag = None
         tags[i] = tag
-    return tags
+    return TemplateTagIndex(tags)
 
 
 def get_series_with_tags(paths, all_fields, graphite_templates,
-                         separator='.'):
+                         separator='.', field_suffixes=None):
     """Get list of metric paths from list of InfluxDB series with tags and
    configured graphite templates if any.
 
     Without graphite template configuration tags are dropped and only the
-    series name is used."""
+    series name is used.
+
+    :param field_suffixes: (Optional) Cache of per measurement field keys
+      split on separator, shared by series parsed in same index build"""
     if not graphite_templates:
         return [paths[0:1]]
     series = deque()
@@ -211,7 +345,9 @@ def get_series_with_tags(paths, all_fields, graphite_templates,
     if 'field' in template.values() or 'field*' in template.values():
         try:
             _add_fields_to_paths(
-                all_fields[paths[0]], split_path, series, separator=separator)
+                _get_field_suffixes(all_fields, paths[0], separator,
+                                    field_suffixes),
+                split_path, series)
         except KeyError:
             logger.warning("Measurement %s not in field list", paths[0])
     else:
@@ -220,30 +356,38 @@ def get_series_with_tags(paths, all_fields, graphite_templates,
 
 
 def _split_series_with_tags(paths, graphite_templates):
-    split_path, template = deque(), None
+    template = None
     tags_values = [p.split('=') for p in paths[1:]
                    if '=' in p and '\\' not in p]
-    for (_filter, template, _, separator) in graphite_templates:
-        _make_path_from_template(
-            split_path, paths[0], template, tags_values, separator=separator)
-        # Split path should be at least as large as number of wanted
+    candidates = graphite_templates
+    if len(graphite_templates) > 1:
+        candidates = get_template_candidates(
+            graphite_templates, tuple([tag_val[0] for tag_val in tags_values]))
+    for (_filter, template, _, separator) in candidates:
+        path = None
+        if isinstance(template, TemplateTagIndex):
+            path = template.make_path(paths[0], tags_values,
+                                      separator=separator)
+            num_tmpl_items, field_inds = template.num_items, \
+                template.field_inds
+        if path is None:
+            split_path = deque()
+            _make_path_from_template(
+                split_path, paths[0], template, tags_values,
+                separator=separator)
+            path = [p[1] for p in heapsort(split_path)]
+            num_tmpl_items = len([k for k, v in template.items() if v])
+            field_inds = len([v for v in template.values()
+                              if v and 'field' in v])
+        # Path should be at least as large as number of wanted
         # template tags taking into account measurement and number of fields
         # in template
-        field_inds = len([v for v in template.values()
-                          if v and 'field' in v])
-        if (len(split_path) + field_inds) >= len(
-                [k for k, v in template.items() if v]):
-            path = [p[1] for p in heapsort(split_path)]
+        if (len(path) + field_inds) >= num_tmpl_items:
             if _filter:
                 if _filter.match_split_path(path):
                     return path, template
             else:
                 return path, template
-            split_path = []
-            continue
-        # Reset path if template does not match
-        else:
-            split_path = []
     return [], template
 
 
@@ -285,10 +429,33 @@ def _make_path_from_template(split_path, measurement, template, tags_values,
         return
 
 
-def _add_fields_to_paths(fields, split_path, series,
-                         separator='.'):
+def _split_field_keys(fields, separator):
+    if isinstance(separator, bytes):
+        separator = separator.decode(ENCODING)
+    field_suffixes = []
     for field_key in fields:
-        field_keys = [f for f in field_key.split(separator.decode(ENCODING))
-                      if f != 'value']
+        field_keys = [f for f in field_key.split(separator) if f != 'value']
         if len(field_keys) > 0:
-            series.append(split_path + field_keys)
+            field_suffixes.append(field_keys)
+    return field_suffixes
+
+
+def _get_field_suffixes(all_fields, measurement, separator,
+                        field_suffixes=None):
+    """Get field keys of measurement split on separator, from cache of
+    field suffixes if provided.
+
+    :raises: :mod:`KeyError` if measurement is not in field keys"""
+    if field_suffixes is None:
+        return _split_field_keys(all_fields[measurement], separator)
+    try:
+        return field_suffixes[measurement]
+    except KeyError:
+        suffixes = _split_field_keys(all_fields[measurement], separator)
+        field_suffixes[measurement] = suffixes
+        return suffixes
+
+
+def _add_fields_to_paths(field_suffixes, split_path, series):
+    for field_keys in field_suffixes:
+        series.append(split_path + field_keys)
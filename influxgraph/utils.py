@@ -21,6 +21,11 @@ import datetime
 import sys
 import re
 import hashlib
+import threading
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
 
 import memcache
 from .constants import INFLUXDB_AGGREGATIONS
@@ -31,11 +36,12 @@ except ImportError:
     from .classes.tree import NodeTreeIndex as Node
 
 try:
-    from .ext.templates import get_series_with_tags, heapsort, \
-        _make_path_from_template
+    from .ext.templates import get_series_with_tags
 except ImportError:
-    from .templates import get_series_with_tags, heapsort, \
-        _make_path_from_template
+    from .templates import get_series_with_tags
+
+# Characters with special meaning in InfluxQL regular expressions
+_REGEX_SPECIAL_CHARS = frozenset('\\/.^$|?*+()[]{}')
 
 
 def calculate_interval(start_time, end_time, deltas=None):
@@ -154,38 +160,22 @@ def get_aggregation_func(path, aggregation_functions):
     return 'mean'
 
 
-def _retrieve_named_field_data(infl_data, measurement_data, measurement,
-                               tags, _data, separator='.'):
-    measurement_paths = measurement_data[measurement]['paths'][:]
-    for field in measurement_data[measurement]['fields']:
-        split_path = []
-        _make_path_from_template(
-            split_path, measurement,
-            measurement_data[measurement]['template'], list(tags.items()),
-            separator=separator)
-        split_path = [p[1] for p in heapsort(split_path)]
-        split_path.append(field)
-        metric = '.'.join(split_path)
-        if metric not in measurement_paths:
+def _retrieve_series_data(infl_data, measurement_data, measurement, tags,
+                          _data):
+    series_data = measurement_data[measurement]
+    # Series are mapped to paths on their tags in paths' templates
+    tag_keys = series_data['tag_keys']
+    series_key = frozenset((tag, value) for (tag, value) in tags.items()
+                           if value and tag in tag_keys)
+    points = None
+    for field in series_data['fields']:
+        metric = series_data['series'].get((series_key, field))
+        if metric is None or metric in _data:
             continue
-        del measurement_paths[measurement_paths.index(metric)]
-        _data[metric] = [d[field]
-                         for d in infl_data.get_points(
-                                 measurement=measurement, tags=tags)]
-    measurement_data[measurement]['paths'] = measurement_paths
-
-
-def _retrieve_field_data(infl_data, measurement_data, measurement,
-                         metric, tags, _data):
-    # Retrieve value field data
-    if 'value' in measurement_data[measurement]['fields']:
-        _data[metric] = [d['value']
-                         for d in infl_data.get_points(
-                                 measurement=measurement, tags=tags)]
-        return
-    # Retrieve non value named field data with fields from measurement_data
-    _retrieve_named_field_data(infl_data, measurement_data,
-                               measurement, tags, _data)
+        if points is None:
+            points = list(infl_data.get_points(
+                measurement=measurement, tags=tags))
+        _data[metric] = [d[field] for d in points]
 
 
 def _read_measurement_metric_values(infl_data, measurement, paths, _data):
@@ -197,12 +187,13 @@ def _read_measurement_metric_values(infl_data, measurement, paths, _data):
 
 
 def read_influxdb_values(influxdb_data, paths, measurement_data):
-    """Return metric path -> datapoints dict for values from InfluxDB data"""
+    """Return metric path -> datapoints dict for values from InfluxDB data.
+
+    Returned series are mapped to metric paths via the (tag set, field) to
+    path mapping of their measurement in measurement data, if any"""
     _data = {}
     if not isinstance(influxdb_data, list):
         influxdb_data = [influxdb_data]
-    m_path_ind = 0
-    seen_measurements = set()
     for infl_data in influxdb_data:
         for infl_keys in infl_data.keys():
             measurement = infl_keys[0]
@@ -213,22 +204,157 @@ def read_influxdb_values(influxdb_data, paths, measurement_data):
                 continue
             elif measurement not in measurement_data:
                 continue
-            if measurement not in seen_measurements:
-                seen_measurements = set(
-                    tuple(seen_measurements) + (measurement,))
-                m_path_ind = 0
-            elif len(measurement_data[measurement]['paths']) == 0:
-                # No paths left for measurement
-                continue
-            elif m_path_ind >= len(measurement_data[measurement]['paths']):
-                m_path_ind = 0
-            metric = measurement_data[measurement]['paths'][m_path_ind]
-            m_path_ind += 1
-            _retrieve_field_data(infl_data, measurement_data,
-                                 measurement, metric, tags, _data)
+            _retrieve_series_data(infl_data, measurement_data,
+                                  measurement, tags, _data)
     return _data
 
 
+def _unique(iterable):
+    seen = set()
+    for item in iterable:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+
+def _escape_regex(value):
+    return ''.join('\\' + char if char in _REGEX_SPECIAL_CHARS else char
+                   for char in value)
+
+
+def _gen_tag_values_clause(tag, values, regex_min_values, known_values,
+                           context):
+    """Return condition selecting any of values of tag, or `None` if values
+    include all known values of tag"""
+    if known_values is not None:
+        known = known_values(tag, context)
+        # No known values means tag values are not known, not that any
+        # value is selected
+        if known and known.issubset(values):
+            return
+    if regex_min_values and len(values) >= regex_min_values:
+        return """("%s" =~ /^(%s)$/)""" % (
+            tag, '|'.join(_escape_regex(value) for value in values),)
+    return '(%s)' % (' OR '.join(
+        """"%s" = '%s'""" % (tag, value,) for value in values),)
+
+
+def _or_conditions(conditions):
+    """Return conditions OR'ed, or `None` if any of them is always true"""
+    if None in conditions:
+        return
+    if len(conditions) == 1:
+        return conditions[0]
+    return ' OR '.join('(%s)' % (condition,) for condition in conditions)
+
+
+def _group_values(tag_values):
+    """Group values of first tag on the set of other tag value tuples that
+    follow them.
+
+    :rtype: list of (values, rest tuples) in order of values"""
+    rest_values = {}
+    for values in tag_values:
+        rest_values.setdefault(values[0], []).append(values[1:])
+    groups = {}
+    groups_order = []
+    for value in _unique(values[0] for values in tag_values):
+        rest = rest_values[value]
+        key = frozenset(rest)
+        if key not in groups:
+            groups[key] = ([], rest)
+            groups_order.append(key)
+        groups[key][0].append(value)
+    return [groups[key] for key in groups_order]
+
+
+def _factor_tag_values(tags, tag_values, regex_min_values, known_values,
+                       context=()):
+    """Return conditions, to be OR'ed, selecting exactly the tag value
+    tuples of tags. Conditions that are always true are `None`.
+
+    Values of first tag that are followed by the same set of other tag value
+    tuples are grouped into one condition, so a complete cross product of
+    tag values is a single condition. Groups whose conditions on other tags
+    are the same are then merged"""
+    if len(tags) == 1:
+        return [_gen_tag_values_clause(
+            tags[0], [values[0] for values in tag_values], regex_min_values,
+            known_values, context)]
+    merged = {}
+    merged_order = []
+    for values, rest in _group_values(tag_values):
+        rest_conditions = _factor_tag_values(
+            tags[1:], rest, regex_min_values, known_values,
+            context + ((tags[0], tuple(values)),))
+        rest_condition = _or_conditions(rest_conditions)
+        if rest_condition is not None and len(rest_conditions) > 1:
+            rest_condition = '(%s)' % (rest_condition,)
+        if rest_condition not in merged:
+            merged[rest_condition] = []
+            merged_order.append(rest_condition)
+        merged[rest_condition].extend(values)
+    conditions = []
+    for rest_condition in merged_order:
+        tag_condition = _gen_tag_values_clause(
+            tags[0], merged[rest_condition], regex_min_values, known_values,
+            context)
+        if tag_condition is None or rest_condition is None:
+            conditions.append(rest_condition if tag_condition is None
+                              else tag_condition)
+            continue
+        conditions.append('%s AND %s' % (tag_condition, rest_condition))
+    return list(_unique(conditions))
+
+
+def gen_tag_sets_clause(tag_sets, regex_min_values=0, known_values=None,
+                        tag_order=None):
+    """Return InfluxQL condition selecting series with exactly the given
+    tag sets, not the cross product of their tag values.
+
+    Tag sets are grouped on their tag keys and each group factored on tags
+    with fewest distinct values first, or in given tag order, without
+    selecting other tag value combinations.
+
+    :param tag_sets: Tag sets of series to select
+    :type tag_sets: list(tuple((tag, value), ..))
+    :param regex_min_values: (Optional) Minimum number of values of a tag
+      to select with a regular expression alternation instead of one
+      equality condition per value. Defaults to 0 - disabled
+    :type regex_min_values: int
+    :param known_values: (Optional) Function returning all known values of
+      a tag of series with one of the given values of other tags, or `None`
+      if not known. Tags are not conditioned on where all their known values
+      are selected
+    :type known_values: function(tag, ((other tag, (values, ..)), ..))
+    :param tag_order: (Optional) Function returning sort key of tag to
+      order tags to factor on with
+    :type tag_order: function(tag)
+
+    :rtype: str or `None` if no condition is needed
+    """
+    groups = {}
+    for tag_set in _unique(tag_sets):
+        if not tag_set:
+            continue
+        tags = tuple(tag for (tag, _) in tag_set)
+        groups.setdefault(tags, []).append(
+            tuple(value for (_, value) in tag_set))
+    conditions = []
+    for tags in sorted(groups):
+        tag_values = groups[tags]
+        order = sorted(range(len(tags)), key=lambda i: (
+            tag_order(tags[i]) if tag_order is not None else len(
+                set(values[i] for values in tag_values))))
+        conditions.extend(_factor_tag_values(
+            [tags[i] for i in order],
+            [tuple(values[i] for i in order) for values in tag_values],
+            regex_min_values, known_values))
+    if not conditions:
+        return
+    return _or_conditions(conditions)
+
+
 def gen_memcache_pattern_key(pattern):
     """Generate memcache key from pattern"""
     return hashlib.md5(pattern.encode('utf8')).hexdigest()
@@ -254,7 +380,8 @@ def make_memcache_client(memcache_host, memcache_max_value=1):
         server_max_value_length=1024**2*memcache_max_value)
 
 
-def parse_series(series, fields, graphite_templates, separator=b'.'):
+def parse_series(series, fields, graphite_templates, separator=b'.',
+                 index=None, field_suffixes=None):
     """Parses series and fields with/without graphite templates
     and returns built Index
 
@@ -266,10 +393,18 @@ def parse_series(series, fields, graphite_templates, separator=b'.'):
     and fields.
     :type graphite_templates: list(tuple) as returned by \
     :mod:`influxgraph.templates.parse_influxdb_graphite_templates`
+    :param index: (Optional) Existing index to insert series into, for
+      parsing series incrementally. New index is created if not provided
+    :param field_suffixes: (Optional) Cache of per measurement field keys
+      split on separator to share between calls of same index build
+    :type field_suffixes: dict
 
     :rtype: :mod:`influxgraph.classes.tree.NodeTreeIndex`
     """
-    index = Node()
+    if index is None:
+        index = Node()
+    if field_suffixes is None:
+        field_suffixes = {}
     for serie in series:
         # If we have metrics with tags in them split them out and
         # pre-generate a correctly ordered split path for that metric
@@ -279,7 +414,7 @@ def parse_series(series, fields, graphite_templates, separator=b'.'):
             if graphite_templates:
                 for split_path in get_series_with_tags(
                         serie_with_tags, fields, graphite_templates,
-                        separator=separator):
+                        separator=separator, field_suffixes=field_suffixes):
                     index.insert_split_path(split_path)
             # Series with tags and no templates,
             # add only measurement to index
@@ -289,3 +424,93 @@ def parse_series(series, fields, graphite_templates, separator=b'.'):
         else:
             index.insert(serie)
     return index
+
+
+def get_serie_paths(serie, fields, graphite_templates, separator=b'.',
+                    field_suffixes=None):
+    """Return split paths that :mod:`parse_series` inserts into index for
+    a single serie
+
+    :param serie: Serie to parse
+    :type serie: unicode str
+    :param fields: Per measurement field keys from InfluxDB. May be `None`
+    :type fields: dict(measurement: [field1, field2, ..])
+    :param graphite_templates: Graphite templates to use to parse serie
+    :param field_suffixes: (Optional) Cache of per measurement field keys
+      split on separator, as in :mod:`parse_series`
+
+    :rtype: list(tuple(unicode str))
+    """
+    if graphite_templates or ',' in serie:
+        serie_with_tags = serie.split(',')
+        if graphite_templates:
+            return [tuple(split_path) for split_path in get_series_with_tags(
+                serie_with_tags, fields, graphite_templates,
+                separator=separator, field_suffixes=field_suffixes)]
+        return [tuple(serie_with_tags[0].split('.'))]
+    return [tuple(serie.split('.'))]
+
+
+def group_series_by_measurement(series, measurements=None):
+    """Group series on measurement name
+
+    :param measurements: (Optional) Existing groups to add series to
+    :type measurements: dict(measurement: set(serie))
+
+    :rtype: dict(measurement: set(serie))
+    """
+    if measurements is None:
+        measurements = {}
+    for serie in series:
+        measurements.setdefault(serie.split(',', 1)[0], set()).add(serie)
+    return measurements
+
+
+_PREFETCH_END = object()
+
+
+def prefetch(iterable, size=1):
+    """Generate items of iterable, retrieving up to `size` items ahead of
+    the consumer in a background thread.
+
+    Exceptions raised while iterating are re-raised to the consumer.
+    Retrieval stops when the consumer stops iterating.
+
+    :param iterable: Iterable to retrieve items from
+    :param size: Number of items to retrieve ahead
+    """
+    queue = Queue(maxsize=size)
+    stop = threading.Event()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+            except Full:
+                continue
+            return True
+        return False
+
+    def _retrieve():
+        try:
+            for item in iterable:
+                if not _put((item, None)):
+                    return
+        except Exception as ex:
+            _put((None, ex))
+            return
+        _put((_PREFETCH_END, None))
+
+    thread = threading.Thread(target=_retrieve)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, ex = queue.get()
+            if ex is not None:
+                raise ex
+            if item is _PREFETCH_END:
+                return
+            yield item
+    finally:
+        stop.set()
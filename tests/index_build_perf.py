@@ -0,0 +1,93 @@
+from __future__ import print_function
+import os
+import unittest
+from timeit import default_timer
+from pprint import pprint
+
+from influxgraph.classes import finder
+from influxgraph.classes.finder import InfluxDBFinder
+from influxgraph.templates import parse_influxdb_graphite_templates
+from influxgraph.utils import parse_series as py_parse_series
+try:
+    from influxgraph.ext.templates import parse_series  # noqa: F401
+except ImportError:
+    C_EXT = False
+else:
+    C_EXT = True
+
+LOADER_LIMIT = 10000
+PROCESSES = int(os.environ.get('INDEX_BUILD_PROCESSES', 4))
+
+
+def _gen_series():
+    measurements = [u'measurement%s' % (i,) for i in range(200)]
+    series = [u'%s,dc=dc%s,host=host%s' % (m, i % 10, i)
+              for m in measurements for i in range(1000)]
+    fields = dict((m, [u'load', u'idle']) for m in measurements)
+    return series, fields
+
+
+class _Finder(InfluxDBFinder):
+    """Finder with only index build configuration, timing merges of
+    process indexes"""
+
+    def __init__(self, processes):
+        self.index_build_processes = processes
+        self.loader_limit = LOADER_LIMIT
+        self.graphite_templates = parse_influxdb_graphite_templates(
+            ['measurement.dc.host.field*'])
+        self.index_incremental = False
+        self.index_mmap = False
+        self.index_compact = False
+        self.merge_time = 0
+
+    def _merge_index(self, index, index_data):
+        # CPU time of finder process, not counting time other processes
+        # are scheduled in on machines with fewer cores than processes
+        start = sum(os.times()[:2])
+        super(_Finder, self)._merge_index(index, index_data)
+        self.merge_time += sum(os.times()[:2]) - start
+
+
+class IndexBuildPerfTestCase(unittest.TestCase):
+    """Compare index build time in the finder process against building in
+    `INDEX_BUILD_PROCESSES` processes. Time spent merging process indexes
+    is serial and bounds the speed up of the parallel build."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.series, cls.fields = _gen_series()
+
+    def _pages(self):
+        return (self.series[i:i + LOADER_LIMIT]
+                for i in range(0, len(self.series), LOADER_LIMIT))
+
+    def _build(self, name):
+        serial = _Finder(1)
+        start = default_timer()
+        index, _ = serial._parse_series(self._pages(), self.fields, b'.')
+        serial_time = default_timer() - start
+        parallel = _Finder(PROCESSES)
+        start = default_timer()
+        parallel_index, _ = parallel._parse_series(
+            self._pages(), self.fields, b'.')
+        parallel_time = default_timer() - start
+        self.assertEqual(
+            [path for (path, _) in index.query('*.*.*.*')],
+            [path for (path, _) in parallel_index.query('*.*.*.*')])
+        pprint("%s index of %s series build time is %s in one process, %s "
+               "in %s processes of which %s CPU seconds merging" % (
+                   name, len(self.series), serial_time, parallel_time,
+                   PROCESSES, parallel.merge_time))
+
+    @unittest.skipUnless(C_EXT, "C extensions not enabled")
+    def test_c_index(self):
+        self._build("C")
+
+    def test_python_index(self):
+        c_parse_series = finder.parse_series
+        finder.parse_series = py_parse_series
+        try:
+            self._build("Python")
+        finally:
+            finder.parse_series = c_parse_series
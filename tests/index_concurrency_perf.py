@@ -0,0 +1,92 @@
+from __future__ import print_function
+import unittest
+import threading
+from timeit import default_timer
+from pprint import pprint
+
+from influxgraph.classes import matcher
+from influxgraph.classes.tree import NodeTreeIndex
+try:
+    from influxgraph.ext.templates import parse_series, query_nodes
+    from influxgraph.ext.nodetrie import Node
+except ImportError:
+    C_EXT = False
+else:
+    C_EXT = True
+
+
+def _gen_series():
+    return [u'.'.join([u'dc', u'host%s' % (i,), u'cpu%s' % (j,),
+                       u'metric%s' % (k,), u'value'])
+            for i in range(100) for j in range(50) for k in range(50)]
+
+
+def _percentile(latencies, percentile):
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1,
+                         int(len(latencies) * percentile / 100.0))]
+
+
+class IndexConcurrencyPerfTestCase(unittest.TestCase):
+    """Measure latency of small index queries made by request threads while
+    another thread of the same process re-builds the index or runs a large
+    wildcard query"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.series = _gen_series()
+        cls.query = 'dc.host1.cpu1.metric*.value'
+
+    def _request_latencies(self, query_func, index, background):
+        """Run queries in a loop until background thread is done and return
+        their latencies"""
+        latencies = []
+        thread = threading.Thread(target=background)
+        thread.start()
+        while thread.is_alive():
+            start = default_timer()
+            list(query_func(index, self.query))
+            latencies.append(default_timer() - start)
+        thread.join()
+        return latencies
+
+    def _report(self, name, latencies):
+        pprint("%s - %s queries, median latency %.6fs, 99th percentile "
+               "%.6fs, max %.6fs" % (
+                   name, len(latencies), _percentile(latencies, 50),
+                   _percentile(latencies, 99), max(latencies)))
+
+    def test_python_index_during_build(self):
+        index = NodeTreeIndex()
+        for serie in self.series:
+            index.insert(serie)
+
+        def build():
+            new_index = NodeTreeIndex()
+            for serie in self.series:
+                new_index.insert(serie)
+        self._report("Python index during re-index", self._request_latencies(
+            lambda _index, query: _index.query(query), index, build))
+
+    @unittest.skipUnless(C_EXT, "C extensions not enabled")
+    def test_c_index_during_build(self):
+        index = parse_series(self.series, None, None)
+        self._report("C index during re-index", self._request_latencies(
+            query_nodes, index,
+            lambda: parse_series(self.series, None, None)))
+
+    @unittest.skipUnless(C_EXT, "C extensions not enabled")
+    def test_c_index_during_wildcard_query(self):
+        index = parse_series(self.series, None, None)
+
+        def wildcard_query(query_func):
+            for _ in range(3):
+                list(query_func(index, 'dc.*.*.*.*'))
+        self._report("C index during wildcard query, compiled matchers",
+                     self._request_latencies(
+                         matcher.query_nodes, index,
+                         lambda: wildcard_query(matcher.query_nodes)))
+        self._report("C index during wildcard query, without GIL",
+                     self._request_latencies(
+                         query_nodes, index,
+                         lambda: wildcard_query(query_nodes)))
@@ -0,0 +1,111 @@
+from __future__ import print_function
+import os
+import unittest
+import tempfile
+import resource
+from multiprocessing import Pool
+from string import ascii_letters
+from random import choice
+from timeit import default_timer
+from pprint import pprint
+
+from influxgraph.classes.tree import NodeTreeIndex
+from influxgraph.classes import index_file
+from influxgraph.classes.index_file import CompactIndex
+try:
+    from influxgraph.ext.templates import parse_series, merge_index_file
+    from influxgraph.ext.nodetrie import Node
+except ImportError:
+    C_EXT = False
+else:
+    C_EXT = True
+
+
+def _gen_series():
+    branches = [[u''.join([choice(ascii_letters) for _ in range(8)])
+                 for _ in range(50)] for _ in range(3)]
+    return [u'.'.join([u'dc', b1, b2, b3, u'cpu'])
+            for b1 in branches[0] for b2 in branches[1]
+            for b3 in branches[2]]
+
+
+def _max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _build(args):
+    series, c_ext = args
+    rss = _max_rss()
+    start = default_timer()
+    if c_ext:
+        index = parse_series(series, None, None)
+    else:
+        index = NodeTreeIndex()
+        for serie in series:
+            index.insert(serie)
+    return default_timer() - start, _max_rss() - rss
+
+
+def _load(args):
+    index_path, c_ext = args
+    rss = _max_rss()
+    start = default_timer()
+    with open(index_path, 'rb') as index_fh:
+        if c_ext is None:
+            index = CompactIndex.from_file(index_fh)
+        elif c_ext:
+            index = Node()
+            merge_index_file(index, index_fh.read())
+        else:
+            index = index_file.load(index_fh)
+    return default_timer() - start, _max_rss() - rss
+
+
+class IndexLoadPerfTestCase(unittest.TestCase):
+    """Compare startup time and memory of building index from series
+    against loading saved index file. Each measurement runs in a new
+    process so that peak memory of one does not affect the others."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.series = _gen_series()
+        index = NodeTreeIndex()
+        for serie in cls.series:
+            index.insert(serie)
+        _, cls.index_path = tempfile.mkstemp()
+        with open(cls.index_path, 'wb') as index_fh:
+            index_file.dump(index, index_fh)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink(cls.index_path)
+
+    def _measure(self, func, args):
+        pool = Pool(processes=1)
+        try:
+            return pool.apply(func, (args,))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def test_python_index(self):
+        build_time, build_rss = self._measure(_build, (self.series, False))
+        load_time, load_rss = self._measure(_load, (self.index_path, False))
+        pprint("Python index of %s series build time is %s, max RSS "
+               "increase %sKB" % (len(self.series), build_time, build_rss))
+        pprint("Python index load from file time is %s, max RSS "
+               "increase %sKB" % (load_time, load_rss))
+
+    @unittest.skipUnless(C_EXT, "C extensions not enabled")
+    def test_c_index(self):
+        build_time, build_rss = self._measure(_build, (self.series, True))
+        load_time, load_rss = self._measure(_load, (self.index_path, True))
+        pprint("C index of %s series build time is %s, max RSS "
+               "increase %sKB" % (len(self.series), build_time, build_rss))
+        pprint("C index load from file time is %s, max RSS "
+               "increase %sKB" % (load_time, load_rss))
+
+    def test_compact_index(self):
+        load_time, load_rss = self._measure(_load, (self.index_path, None))
+        pprint("Compact index load from file time is %s, max RSS "
+               "increase %sKB" % (load_time, load_rss))
@@ -28,6 +28,10 @@ fields = {m: [u''.join([choice(ascii_letters) for _ in range(8)])
 series = [u'.'.join([u''.join([choice(ascii_letters) for _ in range(8)])
                                      for _ in range(28)])
                           for _ in range(5, 500)]"""
+    wide_series = """
+series = [u'.'.join([u'dc', u''.join([choice(ascii_letters) for _ in range(8)]),
+                     u'cpu'])
+          for _ in range(20000)]"""
     timeit_setup = """from string import ascii_letters
 from random import randint, choice
 from influxgraph.templates import parse_influxdb_graphite_templates
@@ -77,6 +81,40 @@ from influxgraph.utils import parse_series as py_parse_series"""
         pprint("Python index template load time is %s" % (reload_time,))
         pprint("Python index query time is %s" % (query_time,))
 
+    def test_python_index_wide_branch(self):
+        index_import = """
+from influxgraph.classes.tree import NodeTreeIndex as Node"""
+        setup = self.timeit_setup % (self.wide_series, index_import)
+        load_time = timeit(stmt=self.py_timeit_insert_stmt,
+                           setup=setup, number=1)
+        query_time = timeit(
+            stmt="""
+for query in ['dc.a*', 'dc.*.cpu', 'dc.abcdefgh.cpu', 'dc.{a,b}*']:
+    list(index.query(query))""",
+            setup="\n".join([setup, self.py_timeit_insert_stmt]),
+            number=10)
+        pprint("Python index wide branch load time is %s" % (load_time,))
+        pprint("Python index wide branch query time is %s" % (query_time,))
+
+    def test_python_index_query_many(self):
+        index_import = """
+from influxgraph.classes.tree import NodeTreeIndex as Node"""
+        setup = "\n".join([
+            self.timeit_setup % (self.wide_series, index_import),
+            self.py_timeit_insert_stmt, """
+queries = [query % (prefix,) for prefix in ascii_letters[:10]
+           for query in ['dc.%s*.cpu', 'dc.%s*.{cpu,mem}', 'dc.%s*.*',
+                         'dc.%s*.c?u']]"""])
+        sequential_time = timeit(stmt="""
+for query in queries:
+    list(index.query(query))""", setup=setup, number=10)
+        batch_time = timeit(stmt="index.query_many(queries)",
+                            setup=setup, number=10)
+        pprint("Python index sequential query time of shared prefix "
+               "queries is %s" % (sequential_time,))
+        pprint("Python index batch query time of shared prefix queries "
+               "is %s" % (batch_time,))
+
     def test_c_index(self):
         c_node_import = """
 from influxgraph.ext.templates import parse_series
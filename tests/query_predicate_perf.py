@@ -0,0 +1,106 @@
+from __future__ import print_function
+import re
+import unittest
+from random import Random
+from timeit import default_timer
+from pprint import pprint
+
+from influxgraph.templates import parse_influxdb_graphite_templates, \
+    apply_template
+from influxgraph.utils import gen_tag_sets_clause
+
+
+def _gen_cross_product_clause(tag_sets):
+    """Tag condition as generated before exact tag set conditions - AND of
+    OR of all requested values of each tag"""
+    tags = {}
+    for tag_set in tag_sets:
+        for tag, value in tag_set:
+            if value not in tags.setdefault(tag, []):
+                tags[tag].append(value)
+    return ' AND '.join(['(%s)' % ' OR '.join([
+        """"%s" = '%s'""" % (tag, value,) for value in tags[tag]])
+                         for tag in tags])
+
+
+def _select(clause, all_tag_sets):
+    expr = re.sub(r""""(\w+)" = '([\w\-]*)'""",
+                  r"tags.get('\1', '') == '\2'", clause)
+    expr = compile(expr.replace(' AND ', ' and ').replace(' OR ', ' or '),
+                   '<clause>', 'eval')
+    return [tag_set for tag_set in all_tag_sets
+            if eval(expr, {'tags': dict(tag_set)})]
+
+
+class QueryPredicatePerfTestCase(unittest.TestCase):
+    """Compare number of series selected by tag conditions of queries for
+    a dashboard's targets with cross product of tag values against exact
+    tag set conditions"""
+
+    @classmethod
+    def setUpClass(cls):
+        random = Random(1)
+        cls.template = parse_influxdb_graphite_templates(
+            ['region.dc.host.measurement.cpu'])[0][1]
+        cls.paths = [
+            '.'.join([region, 'dc%s' % (dc,), 'host%02d' % (host,), 'cpu',
+                      'cpu%s' % (cpu,)])
+            for region in ['eu', 'us', 'ap'] for dc in range(3)
+            for host in range(20) for cpu in range(8)]
+        cls.all_tag_sets = [cls._tag_set(path) for path in cls.paths]
+        by_host = {}
+        for path in cls.paths:
+            by_host.setdefault(path.rsplit('.', 2)[0], []).append(path)
+        hosts = sorted(by_host)
+        # Dashboard panels - all CPUs of a host in each region, first CPU of
+        # a sample of hosts across data centres and first CPUs of a few hosts.
+        # Host names are re-used across data centres
+        cls.dashboard = [
+            [path for region in ['eu', 'us', 'ap']
+             for path in by_host['%s.dc0.host00' % (region,)]],
+            [by_host[host][0] for host in random.sample(hosts, 30)],
+            [path for host in random.sample(hosts, 5)
+             for path in by_host[host][:4]],
+            ]
+
+    @classmethod
+    def _tag_set(cls, path):
+        _, tags, _ = apply_template(path.split('.'), cls.template, {})
+        return tuple(sorted(tags.items()))
+
+    def test_dashboard_series(self):
+        for i, paths in enumerate(self.dashboard):
+            tag_sets = [self._tag_set(path) for path in paths]
+            start = default_timer()
+            exact_clause = gen_tag_sets_clause(tag_sets)
+            gen_time = default_timer() - start
+            exact = _select(exact_clause, self.all_tag_sets)
+            cross_product = _select(_gen_cross_product_clause(tag_sets),
+                                    self.all_tag_sets)
+            self.assertEqual(len(exact), len(set(tag_sets)))
+            pprint("Panel %s - %s requested series, cross product of tag "
+                   "values selects %s series, exact tag sets select %s in "
+                   "%.6fs, condition length %s" % (
+                       i, len(paths), len(cross_product), len(exact),
+                       gen_time, len(exact_clause)))
+
+    def test_wildcard_condition(self):
+        """Condition length for all hosts of a data centre, with one
+        condition per value, regular expression and known tag values"""
+        tag_sets = [(('dc', 'dc1'), ('host', 'host%03d' % (host,)))
+                    for host in range(500)]
+        all_hosts = frozenset(value for (_, value) in
+                              (tag_set[1] for tag_set in tag_sets))
+
+        def known_values(tag, context):
+            return all_hosts if tag == 'host' else None
+        for name, kwargs in [
+                ('equality conditions', {}),
+                ('regular expression', {'regex_min_values': 20}),
+                ('known tag values', {'regex_min_values': 20,
+                                      'known_values': known_values})]:
+            start = default_timer()
+            clause = gen_tag_sets_clause(tag_sets, **kwargs)
+            pprint("500 host wildcard with %s - condition length %s, "
+                   "generated in %.6fs" % (
+                       name, len(clause), default_timer() - start))
@@ -16,6 +16,27 @@ series = [u'%s,a=1,b=2,c=3,d=4,e=6,f=7,g=8,m=9,n=10,j=11' % (m,) for m in measur
 fields = {m: [u'f1', u'f2', u'f3', u'f4', u'f5', u'f6', u'f7', u'f8', u'f9', u'f10'] for m in measurements}
 templates = parse_influxdb_graphite_templates(["a.b.c.d.e.f.g.m.n.j.measurement.field* env=int,region=the_west"])
     """
+    many_fields_stmt = """
+field_suffixes = {}
+for serie in series:
+    for split_path in get_series_with_tags(serie.split(','), fields, templates,
+                                           separator=b'.',
+                                           field_suffixes=field_suffixes):
+        pass
+    """
+    many_fields_setup = """from string import ascii_letters
+from random import choice
+from influxgraph.templates import parse_influxdb_graphite_templates
+measurements = [u''.join([choice(ascii_letters) for _ in range(10)]) for _ in range(20)]
+series = [u'%s,host=h%s' % (m, i) for m in measurements for i in range(50)]
+fields = {m: [u'f%s.value' % (i,) for i in range(300)] for m in measurements}
+templates = parse_influxdb_graphite_templates(["host.measurement.field*"])
+    """
+    many_templates_setup = """
+templates = parse_influxdb_graphite_templates(
+    ["%s.b.c.d.e.f.g.m.n.j.measurement.field*" % (''.join([choice(ascii_letters) for _ in range(5)]),)
+     for _ in range(60)] + ["a.b.c.d.e.f.g.m.n.j.measurement.field* env=int,region=the_west"])
+    """
 
     def test_python_template(self):
         setup = '\n'.join(["from influxgraph.templates import get_series_with_tags",
@@ -24,6 +45,14 @@ templates = parse_influxdb_graphite_templates(["a.b.c.d.e.f.g.m.n.j.measurement.
             stmt=self.template_stmt, setup=setup, number=100)
         pprint("Python template parse time is %s" % (parse_time,))
 
+    def test_python_many_templates(self):
+        setup = '\n'.join(["from influxgraph.templates import get_series_with_tags",
+                           self.timeit_setup, self.many_templates_setup])
+        parse_time = timeit(
+            stmt=self.template_stmt, setup=setup, number=100)
+        pprint("Python template parse time with %s templates is %s" % (
+            61, parse_time,))
+
     def test_cython_template(self):
         setup = '\n'.join(["""
 try:
@@ -35,3 +64,50 @@ except ImportError:
         parse_time = timeit(
             stmt=self.template_stmt, setup=setup, number=100)
         pprint("Cython template parse time is %s" % (parse_time,))
+
+    def test_cython_many_templates(self):
+        setup = '\n'.join(["""
+try:
+    from influxgraph.ext.templates import get_series_with_tags
+except ImportError:
+    from influxgraph.templates import get_series_with_tags
+""",
+                           self.timeit_setup, self.many_templates_setup])
+        parse_time = timeit(
+            stmt=self.template_stmt, setup=setup, number=100)
+        pprint("Cython template parse time with %s templates is %s" % (
+            61, parse_time,))
+
+    def test_python_many_fields(self):
+        setup = '\n'.join(["from influxgraph.templates import get_series_with_tags",
+                           self.many_fields_setup])
+        parse_time = timeit(
+            stmt=self.many_fields_stmt, setup=setup, number=10)
+        pprint("Python template parse time with %s fields is %s" % (
+            300, parse_time,))
+
+    def test_cython_many_fields(self):
+        setup = '\n'.join(["""
+try:
+    from influxgraph.ext.templates import get_series_with_tags
+except ImportError:
+    from influxgraph.templates import get_series_with_tags
+""",
+                           self.many_fields_setup])
+        parse_time = timeit(
+            stmt=self.many_fields_stmt, setup=setup, number=10)
+        pprint("Cython template parse time with %s fields is %s" % (
+            300, parse_time,))
+
+    def test_cython_parse_series(self):
+        setup = '\n'.join(["""
+try:
+    from influxgraph.ext.templates import parse_series
+except ImportError:
+    from influxgraph.utils import parse_series
+""",
+                           self.timeit_setup])
+        parse_time = timeit(
+            stmt="parse_series(series, fields, templates)", setup=setup,
+            number=100)
+        pprint("Cython series parse time is %s" % (parse_time,))
@@ -1,7 +1,14 @@
 import sys
 import unittest
+import threading
+from io import BytesIO
+from itertools import islice
 
 from influxgraph.ext.nodetrie import Node as NodeTreeIndex
+from influxgraph.ext.templates import query_nodes, query_many_nodes, \
+    parse_series, merge_index_file, compact_index
+from influxgraph.classes import matcher, index_file
+from influxgraph.classes.index_file import IndexFileError, CompactIndex
 from influxgraph.utils import Query
 
 
@@ -61,3 +68,98 @@ class CIndexTreeTestCase(unittest.TestCase):
         self.assertTrue(result[0][0] == 'b1.b1.b1.b1.leaf1')
         result = list(self.index.query('fakey*'))
         self.assertFalse(result)
+
+    def _query(self, results):
+        return [(path, node.is_leaf()) for (path, node) in results]
+
+    def test_query_nodes(self):
+        self.index.insert(u'b1.b\xe9.leaf1')
+        queries = ['*', '*.*', 'b1.*.*', 'b1.b1.*.*.*', 'b1.b1.*.*.leaf*',
+                   'b1.b1.*.*.*2', 'b1.b1.*.*.{leaf1,leaf2}', 'b1.b1.b?.*',
+                   'b1.b1.b[2-3].*', u'b1.b\xe9.*', 'b1.b1.b1.b1.leaf1',
+                   'b1.b1.b1.b1.leaf1.fake', 'fakey*', '']
+        for query in queries:
+            self.assertEqual(
+                self._query(query_nodes(self.index, query)),
+                self._query(matcher.query_nodes(self.index, query)))
+        results = query_many_nodes(self.index, queries)
+        for query in queries:
+            self.assertEqual(self._query(results[query]),
+                             self._query(matcher.query_nodes(
+                                 self.index, query)))
+        self.assertEqual(list(query_nodes(NodeTreeIndex(), '*')), [])
+
+    def test_query_nodes_lazy(self):
+        index = NodeTreeIndex()
+        series = [u'b%02d.leaf%02d' % (i, j)
+                  for i in range(20) for j in range(50)]
+        for serie in series:
+            index.insert(serie)
+        results = query_nodes(index, '*.*')
+        self.assertEqual([path for (path, _) in islice(results, 11)],
+                         series[:11])
+        # Only first chunk of matches is searched for
+        self.assertEqual(results.matched, 16)
+        self.assertEqual([path for (path, _) in islice(results, 5)],
+                         series[11:16])
+        self.assertEqual(results.matched, 16)
+        # Next search continues after last path of previous chunk
+        index.insert(u'b00.leaf00a')
+        index.insert(u'b19.leaf99')
+        self.assertEqual([path for (path, _) in results],
+                         series[16:] + [u'b19.leaf99'])
+        self.assertEqual(results.matched, len(series) + 1)
+
+    def test_query_during_build(self):
+        series = [u'.'.join([u'b%s' % (i,), u'b%s' % (j,), u'leaf'])
+                  for i in range(100) for j in range(100)]
+        index = NodeTreeIndex()
+        build = threading.Thread(target=parse_series,
+                                 args=(series, None, None),
+                                 kwargs={'index': index})
+        build.start()
+        while build.is_alive():
+            results = list(query_nodes(index, 'b1*.b1.leaf'))
+            self.assertEqual([path for (path, _) in results],
+                             sorted(path for (path, _) in results))
+        build.join()
+        self.assertEqual(len(list(query_nodes(index, '*.*.leaf'))),
+                         len(series))
+
+    def _dump(self, index):
+        file_h = BytesIO()
+        index_file.dump(index, file_h)
+        return file_h.getvalue()
+
+    def test_merge_index_file(self):
+        other = NodeTreeIndex()
+        for serie in [u'b1.b1.b1.b3.leaf1', u'b1.b1.b1.b1.leaf3',
+                      u'b1.b3.leaf1', u'b2.leaf1', u'b1.b1.b1.b1.leaf1']:
+            other.insert(serie)
+        expected = NodeTreeIndex()
+        for index in (self.index, other):
+            for split_path in index_file.read_paths(self._dump(index)):
+                expected.insert_split_path(split_path)
+        merge_index_file(self.index, self._dump(other))
+        for query in ['*', '*.*', '*.*.*', '*.*.*.*', '*.*.*.*.*',
+                      'b1.b1.b1.*.*', 'b1.b1.b1.b1.leaf1']:
+            self.assertEqual(self._query(query_nodes(self.index, query)),
+                             self._query(query_nodes(expected, query)))
+        # Existing paths are not inserted again
+        merge_index_file(self.index, self._dump(other))
+        self.assertEqual(
+            len(list(query_nodes(self.index, 'b1.b1.b1.b1.*'))), 3)
+        empty_index = NodeTreeIndex()
+        merge_index_file(empty_index, self._dump(other))
+        self.assertEqual(self._query(query_nodes(empty_index, '*.*.*')),
+                         self._query(query_nodes(other, '*.*.*')))
+        data = self._dump(other)
+        self.assertRaises(IndexFileError, merge_index_file, NodeTreeIndex(),
+                          data[:-1])
+
+    def test_compact_index(self):
+        self.index.insert(u'b2.leaf1')
+        self.assertEqual(
+            self._dump(compact_index(self.index)),
+            self._dump(CompactIndex.from_index(self.index)))
+        self.assertEqual(list(compact_index(NodeTreeIndex()).query('*')), [])
@@ -3,7 +3,8 @@ from string import ascii_letters
 from random import choice
 from influxgraph.templates import parse_influxdb_graphite_templates
 from influxgraph.utils import parse_series as py_parse_series
-from influxgraph.ext.templates import parse_series
+from influxgraph.ext.templates import parse_series, read_influxdb_values
+from influxdb.resultset import ResultSet
 
 class TemplatesCExtTestCase(unittest.TestCase):
 
@@ -41,6 +42,16 @@ class TemplatesCExtTestCase(unittest.TestCase):
         series = parse_series(paths, fields, templates)
         self.assertTrue(len(series.children) == 0)
 
+    def test_parse_series_incremental(self):
+        index = parse_series(self.series[:2], self.all_fields, self.templates)
+        self.assertTrue(parse_series(self.series[2:], self.all_fields,
+                                     self.templates, index=index) is index)
+        py_index = py_parse_series(self.series, self.all_fields,
+                                   self.templates)
+        for query in ['*', '*.*', '*.*.*', '*.*.*.*']:
+            self.assertEqual([path for (path, _) in index.query(query)],
+                             [path for (path, _) in py_index.query(query)])
+
     def test_template_parse(self):
         measurements = [u''.join([choice(ascii_letters) for _ in range(10)]) for _ in range(10)]
         series = [u'%s,a=1,b=2,c=3,d=4,e=5,f=6,g=7,m=8,n=9,j=10' % (m,) for m in measurements]
@@ -66,6 +77,51 @@ class TemplatesCExtTestCase(unittest.TestCase):
         self.assertEqual(sorted([n[0] for n in index.query('*.*.*.*.*.*.*.*.*.*.%s.*' % (measurements[0],))]),
                          sorted([u'1.2.3.4.5.6.7.8.9.10.%s.%s' % (measurements[0], f,) for f in field_names]))
 
+    def test_template_candidates(self):
+        templates = parse_influxdb_graphite_templates(
+            ['k%s.host.measurement.field*' % (i,) for i in range(50)] + [
+                'h1.* host.measurement.k1', 'host.measurement.field*',
+                'measurement*'])
+        fields = {u'cpu': [u'load', u'idle']}
+        series = [u'cpu,host=h1,k7=v', u'cpu,host=h1,k1=v', u'cpu,host=h2',
+                  u'cpu,k49=v,host=h3', u'cpu,hostname=h4', u'a.b.c', u'cpu']
+        index = parse_series(series, fields, templates)
+        all_index = parse_series(series, fields, list(templates))
+        py_index = py_parse_series(series, fields, templates)
+        for query in ['*', '*.*', '*.*.*', '*.*.*.*']:
+            paths = [path for (path, _) in index.query(query)]
+            self.assertEqual(
+                paths, [path for (path, _) in all_index.query(query)])
+            self.assertEqual(
+                paths, [path for (path, _) in py_index.query(query)])
+        # Tag keys are matched exactly
+        self.assertEqual([path for (path, _) in index.query('*')],
+                         [u'a', u'cpu', u'h2', u'v'])
+
+    def test_parse_series_bulk(self):
+        templates = parse_influxdb_graphite_templates(
+            ['h1.* host.measurement.field*', 'dc.host.measurement.field',
+             'a.* measurement*', 'host.measurement'])
+        fields = {u'cpu': [u'load', u'value', u'x.y'], u'mem': [u'free']}
+        series = [u'cpu,host=h1', u'cpu,host=h2,dc=d1', u'mem,host=h1',
+                  u'disk,host=h1', u'a.b.c', u'b.c', u'cpu,host=h3,host=h4',
+                  u'cpu,host=h5,measurement=m', u'cpu,host=h6,x\\,y=1',
+                  u'cpu,host=h7,flag', u'\u00e9,host=\u00e9']
+        index = parse_series(series, fields, templates)
+        # Plain dict templates are parsed one series at a time
+        serie_index = parse_series(series, fields, [
+            (_filter, dict(template), default_tags, separator)
+            for (_filter, template, default_tags, separator) in templates])
+        for query in ['*', '*.*', '*.*.*', '*.*.*.*', '*.*.*.*.*']:
+            self.assertEqual(
+                [(path, node.is_leaf()) for (path, node) in index.query(query)],
+                [(path, node.is_leaf())
+                 for (path, node) in serie_index.query(query)])
+        self.assertEqual([path for (path, _) in index.query('h1.*.*')],
+                         [u'h1.cpu.load', u'h1.cpu.x', u'h1.mem.free'])
+        self.assertEqual([path for (path, _) in index.query('a.*.*')],
+                         [u'a.b.c'])
+
     def test_templated_index_find(self):
         py_parse_series(self.series, self.all_fields, self.templates)
         index = parse_series(self.series, self.all_fields, self.templates)
@@ -101,3 +157,24 @@ class TemplatesCExtTestCase(unittest.TestCase):
         self.assertEqual(nodes, expected,
                          msg="Got fields query result %s - wanted %s" % (
                              nodes, expected,))
+
+    def test_read_influxdb_values(self):
+        measurement_data = {'load': {
+            'tag_keys': set(['host']), 'fields': ['value'],
+            'series': {(frozenset([('host', 'h1')]), 'value'): 'h1.load',
+                       (frozenset([('host', 'h2')]), 'value'): 'h2.load'}}}
+        # Series returned in different order than paths, with group by
+        # tags not in template
+        data = ResultSet({'series': [
+            {'name': 'load', 'tags': {'host': 'h2', 'dc': ''},
+             'columns': ['time', 'value'], 'values': [[0, 2]]},
+            {'name': 'load', 'tags': {'host': 'h1', 'dc': ''},
+             'columns': ['time', 'value'], 'values': [[0, 1]]},
+            {'name': 'load', 'tags': {'host': 'h3', 'dc': ''},
+             'columns': ['time', 'value'], 'values': [[0, 3]]},
+            {'name': 'cpu', 'tags': {'host': 'h1', 'dc': ''},
+             'columns': ['time', 'value'], 'values': [[0, 4]]},
+            ]})
+        self.assertEqual(read_influxdb_values(
+            data, ['h1.load', 'h2.load'], measurement_data),
+                         {'h1.load': [1], 'h2.load': [2]})
@@ -0,0 +1,37 @@
+import unittest
+
+from influxgraph.classes.cache import LRUCache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        # Least recently used entry is evicted
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_max_weight(self):
+        cache = LRUCache(10, maxweight=10)
+        cache.set('a', [1] * 4, weight=4)
+        cache.set('b', [2] * 4, weight=4)
+        cache.set('c', [3] * 4, weight=4)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.weight, 8)
+        # Replacing entry updates weight
+        cache.set('b', [2], weight=1)
+        self.assertEqual(cache.weight, 5)
+        # Entries heavier than max weight are not cached
+        cache.set('d', [4] * 11, weight=11)
+        self.assertEqual(cache.get('d'), None)
+        self.assertEqual(len(cache), 2)
+        cache.clear()
+        self.assertEqual(cache.weight, 0)
@@ -1,4 +1,6 @@
 import unittest
+import threading
+from fnmatch import fnmatchcase
 from influxgraph.classes.tree import NodeTreeIndex
 from influxgraph.utils import Query
 
@@ -64,3 +66,218 @@ class IndexTreeTestCase(unittest.TestCase):
         self.assertEqual(index2.to_array(), self.index.to_array())
         self.assertEqual([path for (path, _) in self.index.query('*')],
                          [path for (path, _) in index2.query('*')])
+
+    def test_delete(self):
+        self.assertTrue(self.index.delete('b1.b1.b2.b2.leaf1'))
+        self.assertEqual([path for (path, _) in self.index.query('b1.b1.b2.b2.*')],
+                         ['b1.b1.b2.b2.leaf2'])
+        # Branches without children are removed
+        self.assertTrue(self.index.delete_split_path(['b1', 'b1', 'b2', 'b2', 'leaf2']))
+        self.assertEqual([path for (path, _) in self.index.query('b1.b1.*')],
+                         ['b1.b1.b1'])
+        # Non-existent and branch paths are not deleted
+        self.assertFalse(self.index.delete('b1.b1.b2.b2.leaf2'))
+        self.assertFalse(self.index.delete('fakey.b1'))
+        self.assertFalse(self.index.delete('b1.b1.b1'))
+        self.assertEqual(len(list(self.index.query('b1.b1.*.*.*'))), 4)
+
+    def test_delete_leaf_branch(self):
+        self.index.insert('b1.b1')
+        self.index.insert('b2')
+        self.index.insert('b2.leaf1')
+        result = list(self.index.query('b*'))
+        self.assertFalse(result[1][1].is_leaf())
+        self.assertTrue(self.index.delete('b2.leaf1'))
+        # Branch that was also inserted as a leaf becomes a leaf again
+        self.assertTrue(list(self.index.query('b2'))[0][1].is_leaf())
+        self.assertTrue(self.index.delete('b1.b1'))
+        self.assertFalse(list(self.index.query('b1.b1'))[0][1].is_leaf())
+        self.assertEqual(len(list(self.index.query('b1.b1.*.*.*'))), 6)
+
+    def test_wide_branch(self):
+        index = NodeTreeIndex()
+        hosts = ['host%s' % (i,) for i in range(200)]
+        for host in hosts:
+            index.insert('dc1.%s.cpu' % (host,))
+        self.assertEqual([path for (path, _) in index.query('dc1.*')],
+                         sorted('dc1.%s' % (host,) for host in hosts))
+        self.assertEqual([path for (path, _) in index.query('dc1.host1?')],
+                         ['dc1.host%s' % (i,) for i in range(10, 20)])
+        self.assertEqual([path for (path, _) in index.query('dc1.host1{0,99}.*')],
+                         ['dc1.host10.cpu', 'dc1.host199.cpu'])
+        self.assertEqual([path for (path, _) in index.query('dc1.*st5')],
+                         ['dc1.host5'])
+        self.assertEqual([path for (path, _) in index.query('dc1.host150.cpu')],
+                         ['dc1.host150.cpu'])
+        self.assertFalse(list(index.query('dc1.host1000')))
+        self.assertFalse(list(index.query('dc1.fakey*')))
+        for host in hosts[1:]:
+            self.assertTrue(index.delete('dc1.%s.cpu' % (host,)))
+        self.assertEqual([path for (path, _) in index.query('dc1.*.*')],
+                         ['dc1.host0.cpu'])
+        index2 = NodeTreeIndex.from_array(index.to_array())
+        self.assertEqual(index2.to_array(), index.to_array())
+
+    def test_merge(self):
+        other = NodeTreeIndex()
+        for serie in ['b1.b1.b1.b1.leaf3', 'b1.b1.b3.leaf1', 'b2.leaf1',
+                      'b1.b1.b1.b1.leaf1.sub']:
+            other.insert(serie)
+        self.index.insert('b2')
+        self.index.merge(other)
+        self.assertEqual([path for (path, _) in self.index.query('b1.b1.*')],
+                         ['b1.b1.b1', 'b1.b1.b2', 'b1.b1.b3'])
+        self.assertEqual([path for (path, _) in self.index.query('b1.b1.b1.b1.*')],
+                         ['b1.b1.b1.b1.leaf1', 'b1.b1.b1.b1.leaf2',
+                          'b1.b1.b1.b1.leaf3'])
+        self.assertFalse(list(self.index.query('b2'))[0][1].is_leaf())
+        # Leaves that became branches by merging revert to leaves
+        # when their children are deleted
+        self.assertTrue(self.index.delete('b1.b1.b1.b1.leaf1.sub'))
+        self.assertTrue(list(self.index.query('b1.b1.b1.b1.leaf1'))[0][1].is_leaf())
+        self.assertTrue(self.index.delete('b2.leaf1'))
+        self.assertTrue(list(self.index.query('b2'))[0][1].is_leaf())
+
+    def test_leaf_counts(self):
+        self.assertEqual(self.index.stats()['leaves'], 6)
+        self.assertEqual(list(self.index.query('b1.b1'))[0][1].leaf_count(), 6)
+        self.index.insert('b1.b1.b1.b1.leaf1.sub')
+        self.index.insert('b1.b1.b1.b1.leaf3')
+        self.assertEqual(list(self.index.query('b1.b1'))[0][1].leaf_count(), 7)
+        self.index.delete('b1.b1.b1.b1.leaf1.sub')
+        self.index.delete('b1.b1.b2.b2.leaf1')
+        self.assertEqual(list(self.index.query('b1.b1'))[0][1].leaf_count(), 6)
+        self.assertEqual(list(self.index.query('b1.b1.b1.b1.leaf1'))[0][1].leaf_count(), 1)
+
+    def test_estimate(self):
+        for query in ['*', '*.*', 'b1.*.*', 'b1.b1.*.*.*', 'b1.b1.*.*.leaf1',
+                      'b1.b1.*.*.{leaf1,leaf2}', 'fakey*', 'b1.b1.b2.b2.*']:
+            self.assertEqual(self.index.estimate(query),
+                             len(list(self.index.query(query))))
+        # Bound within limit from leaf counts of matches before last level
+        self.assertEqual(self.index.estimate('b1.b1.b2.*.*', limit=2), 2)
+        self.assertTrue(self.index.estimate('b1.b1.*.*.*', limit=5) > 5)
+        self.assertEqual(self.index.estimate('b1.b1.b1.*.*', limit=5), 4)
+
+    def test_sorted_children(self):
+        index = NodeTreeIndex()
+        for serie in ['b.c2', 'a.c1', 'c.c1', 'b.c1', 'a.c0']:
+            index.insert(serie)
+        self.assertEqual([name for (name, _) in index.index.child_items()],
+                         [b'a', b'b', b'c'])
+        results = index.query('*.*')
+        self.assertEqual(next(results)[0], 'a.c0')
+        self.assertEqual([path for (path, _) in results],
+                         ['a.c1', 'b.c1', 'b.c2', 'c.c1'])
+
+    def test_trigram_index(self):
+        series = [u'host%s.%s' % (i, name) for i in range(3)
+                  for name in [u'nginx_%s_requests' % j for j in range(20)] +
+                  [u'apache_%s_requests' % j for j in range(20)] +
+                  [u'cpu', u'ngi', u'été_nginx']]
+        index = NodeTreeIndex()
+        trigram_index = NodeTreeIndex()
+        for serie in series:
+            index.insert(serie)
+            trigram_index.insert(serie)
+        trigram_index.index_trigrams(40)
+        trigram_index.insert(u'host0.nginx_new_requests')
+        trigram_index.delete(u'host0.apache_0_requests')
+        index.insert(u'host0.nginx_new_requests')
+        index.delete(u'host0.apache_0_requests')
+        for query in ['*.*nginx*', '*.*_requests', '*.*ngi*', '*.*gi*',
+                      '*.*nginx*1?_requests', '*.*é_n*', '*.*fake*',
+                      '*.*apache_0*', '*.*_new_*', '*.nginx*', '*.*']:
+            self.assertEqual(
+                [path for (path, _) in trigram_index.query(query)],
+                [path for (path, _) in index.query(query)], msg=query)
+        self.assertEqual(len(list(trigram_index.query('*.*nginx*'))), 64)
+
+    def test_trigram_index_character_classes(self):
+        names = [u'%s%s_requests' % (prefix, i) for i in range(20)
+                 for prefix in [u'nginx', u']nginx', u'!nginx', u'anginx']]
+        index = NodeTreeIndex()
+        for name in names:
+            index.insert(u'host.' + name)
+        index.index_trigrams(32)
+        for pattern in [u'[!]a]nginx1*', u'[]a]nginx1*', u'[!]]nginx*',
+                        u'[]]nginx*', u'*[!]a]nginx*', u'*[]!]nginx*',
+                        u'*[]nginx*', u'*[!]nginx*']:
+            self.assertEqual(
+                [path for (path, _) in index.query(u'host.' + pattern)],
+                sorted(u'host.' + name for name in names
+                       if fnmatchcase(name, pattern)), msg=pattern)
+
+    def test_query_many(self):
+        self.index.insert('b1.b2.leaf3')
+        queries = ['*', 'b1.*', 'b1.b1.*.*.leaf1', 'b1.b1.*.*.*',
+                   'b1.b1.b1.*.{leaf1,leaf2}', 'b1.b1.*.b2', 'b1.b1',
+                   'b1.*.leaf3', 'b1.*.*', 'fakey*', '*.fakey']
+        results = self.index.query_many(queries)
+        self.assertEqual(sorted(results.keys()), sorted(queries))
+        for query in queries:
+            self.assertEqual(
+                [(path, node.is_leaf()) for (path, node) in results[query]],
+                [(path, node.is_leaf())
+                 for (path, node) in self.index.query(query)], msg=query)
+        self.assertEqual(self.index.query_many([]), {})
+
+    def test_copy(self):
+        self.index.insert('b1.b1.b2')
+        copy = self.index.copy()
+        array = self.index.to_array()
+        self.assertTrue(copy.delete('b1.b1.b1.b1.leaf1'))
+        self.assertTrue(copy.delete('b1.b1.b2.b2.leaf1'))
+        self.assertTrue(copy.delete('b1.b1.b2.b2.leaf2'))
+        copy.insert('b1.b1.b1.b3.leaf1')
+        copy.insert('b1.b1.b1.b3.leaf2')
+        copy.insert('b2.leaf1')
+        self.assertEqual(self.index.to_array(), array)
+        self.assertEqual(self.index.index.leaves, 6)
+        self.assertEqual(copy.index.leaves, 7)
+        self.assertTrue(list(copy.query('b1.b1.b2'))[0][1].is_leaf())
+        self.assertFalse(list(self.index.query('b1.b1.b2'))[0][1].is_leaf())
+        self.assertEqual(
+            [path for (path, _) in copy.query('b1.b1.b1.*.*')],
+            ['b1.b1.b1.b1.leaf2', 'b1.b1.b1.b2.leaf1', 'b1.b1.b1.b2.leaf2',
+             'b1.b1.b1.b3.leaf1', 'b1.b1.b1.b3.leaf2'])
+
+    def test_query_during_update(self):
+        index = NodeTreeIndex()
+        hosts = ['host%s' % (i,) for i in range(100)]
+        for host in hosts:
+            index.insert('dc1.%s.cpu' % (host,))
+        index.index_trigrams(32)
+        current = [index]
+        errors = []
+
+        def update():
+            for i in range(200):
+                index = current[0].copy()
+                for host in hosts[i % 2::2]:
+                    index.delete('dc1.%s.cpu' % (host,))
+                    index.insert('dc1.%s.cpu' % (host,))
+                current[0] = index
+
+        def query():
+            while updater.is_alive():
+                try:
+                    for query in ['dc1.*.cpu', 'dc1.*st1*.cpu']:
+                        results = list(current[0].query(query))
+                        if query == 'dc1.*.cpu':
+                            self.assertEqual(len(results), len(hosts))
+                        self.assertTrue(all(node.is_leaf()
+                                            for (_, node) in results))
+                except Exception as ex:
+                    errors.append(ex)
+                    return
+        updater = threading.Thread(target=update)
+        readers = [threading.Thread(target=query) for _ in range(4)]
+        updater.start()
+        for reader in readers:
+            reader.start()
+        updater.join()
+        for reader in readers:
+            reader.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(list(current[0].query('dc1.*st1*.cpu'))), 11)
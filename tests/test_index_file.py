@@ -0,0 +1,291 @@
+import os
+import unittest
+import tempfile
+import shutil
+from io import BytesIO
+
+from influxgraph.classes.tree import NodeTreeIndex
+from influxgraph.classes import index_file
+from influxgraph.classes.index_file import IndexFileError, MMapIndex, \
+    CompactIndex
+try:
+    from influxgraph.ext.nodetrie import Node
+except ImportError:
+    NODE_TRIE = False
+else:
+    NODE_TRIE = True
+
+
+class IndexFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.all_series = [u'b1.b1.b1.b1.leaf1',
+                           u'b1.b1.b1.b2.leaf1',
+                           u'b1.b1.b2.b2.leaf1',
+                           u'b1.b1.b1.b1.leaf2',
+                           u'b1.b1.b1.b2.leaf2',
+                           u'b1.b1.b2.b2.leaf2',
+                           u'b2.leaf1',
+                           ]
+        self.queries = ['*', '*.*', 'b1.*.*', 'b1.b1.*.*.*',
+                        'b1.b1.*.*.{leaf1,leaf2}', 'b2.leaf1', 'fakey*']
+        self.index = NodeTreeIndex()
+        for serie in self.all_series:
+            self.index.insert(serie)
+
+    def _dump(self, index):
+        file_h = BytesIO()
+        index_file.dump(index, file_h)
+        return file_h.getvalue()
+
+    def _query(self, index, query):
+        return [(path, node.is_leaf()) for (path, node) in index.query(query)]
+
+    def test_dump_load(self):
+        loaded = index_file.load(BytesIO(self._dump(self.index)))
+        for query in self.queries:
+            self.assertEqual(self._query(loaded, query),
+                             self._query(self.index, query))
+
+    def test_header(self):
+        data = self._dump(self.index)
+        header = index_file.read_header(data)
+        self.assertEqual(header.version, index_file.FORMAT_VERSION)
+        # Root node plus one node per unique path prefix
+        self.assertEqual(header.node_count, 16)
+        # Node names are interned
+        self.assertEqual(sorted(index_file.read_strings(data, header)),
+                         [b'b1', b'b2', b'leaf1', b'leaf2'])
+
+    def test_empty_index(self):
+        loaded = index_file.load(BytesIO(self._dump(NodeTreeIndex())))
+        self.assertEqual(list(loaded.query('*')), [])
+
+    def test_corrupt_file(self):
+        data = bytearray(self._dump(self.index))
+        data[-1] = ord('x')
+        self.assertRaises(IndexFileError, index_file.load,
+                          BytesIO(bytes(data)))
+        self.assertRaises(IndexFileError, index_file.load,
+                          BytesIO(b'{"not": "an index"}'))
+        self.assertRaises(IndexFileError, index_file.load,
+                          BytesIO(bytes(data[:index_file.HEADER_SIZE + 4])))
+
+    def test_read_paths(self):
+        self.assertEqual(list(index_file.read_paths(self._dump(self.index))),
+                         [serie.split('.') for serie in sorted(self.all_series)])
+        self.assertEqual(list(index_file.read_paths(
+            self._dump(NodeTreeIndex()))), [])
+
+    def test_leaf_branch(self):
+        self.index.insert(u'b2')
+        self.index.insert(u'b1.b1.b1')
+        data = self._dump(self.index)
+        loaded = index_file.load(BytesIO(data))
+        self.assertEqual(self._dump(loaded), data)
+        compact = CompactIndex.from_index(self.index)
+        self.assertEqual(self._dump(compact), data)
+        self.assertEqual(
+            [path for path in index_file.read_paths(data)
+             if path in ([u'b2'], [u'b1', u'b1', u'b1'])],
+            [[u'b1', u'b1', u'b1'], [u'b2']])
+        # Branches become leaves again once their children are deleted
+        for index in (self.index, loaded):
+            self.assertTrue(index.delete(u'b2.leaf1'))
+            for serie in self.all_series[:2] + self.all_series[3:5]:
+                self.assertTrue(index.delete(serie))
+        self.assertEqual(self._dump(loaded), self._dump(self.index))
+        self.assertEqual(self._query(loaded, '*.*.*'),
+                         [(u'b1.b1.b1', True), (u'b1.b1.b2', False)])
+        self.assertEqual(self._query(loaded, 'b2'), [(u'b2', True)])
+
+    def test_read_previous_version(self):
+        data = bytearray(self._dump(self.index))
+        data[4:6] = b'\x02\x00'
+        self.assertEqual(index_file.read_header(bytes(data)).version, 2)
+        loaded = index_file.load(BytesIO(bytes(data)))
+        for query in self.queries:
+            self.assertEqual(self._query(loaded, query),
+                             self._query(self.index, query))
+
+    @unittest.skipUnless(NODE_TRIE, "NodeTrie extension not enabled")
+    def test_c_index_dump(self):
+        c_index = Node()
+        for serie in self.all_series:
+            c_index.insert(serie)
+        loaded = index_file.load(BytesIO(self._dump(c_index)))
+        for query in self.queries:
+            self.assertEqual(self._query(loaded, query),
+                             self._query(c_index, query))
+
+
+class MMapIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tmp_dir, 'index')
+        self.all_series = [u'b1.b1.b1.b1.leaf1',
+                           u'b1.b1.b1.b2.leaf1',
+                           u'b1.b1.b2.b2.leaf1',
+                           u'b1.b1.b1.b1.leaf2',
+                           u'b1.b1.b1.b2.leaf2',
+                           u'b1.b1.b2.b2.leaf2',
+                           u'b2.leaf1',
+                           u'b3.b1.leaf1',
+                           ]
+        self.index = NodeTreeIndex()
+        for serie in self.all_series:
+            self.index.insert(serie)
+        self._write(self.index)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, index):
+        with open(self.index_path, 'wb') as file_h:
+            index_file.dump(index, file_h)
+
+    def _query(self, index, query):
+        return [(path, node.is_leaf()) for (path, node) in index.query(query)]
+
+    def test_query(self):
+        mmap_index = MMapIndex(self.index_path, verify=True)
+        for query in ['*', '*.*', 'b1.*.*', 'b1.b1.*.*.*', 'b1.b1.b1.b1.*',
+                      'b1.b1.*.*.{leaf1,leaf2}', 'b[1-2].*', 'b?.leaf1',
+                      'b2.leaf1', 'b2', 'b2.leaf1.fake', 'fakey*', 'fakey',
+                      'b1.b1.fake.*', '']:
+            self.assertEqual(self._query(mmap_index, query),
+                             self._query(self.index, query))
+
+    def test_children_size(self):
+        mmap_index = MMapIndex(self.index_path)
+        results = dict(mmap_index.query('b1.b1.*'))
+        self.assertEqual(results['b1.b1.b1'].children_size, 2)
+        self.assertEqual(results['b1.b1.b2'].children_size, 1)
+        self.assertEqual(dict(mmap_index.query('b2.*'))[
+            'b2.leaf1'].children_size, 0)
+
+    def test_stale(self):
+        mmap_index = MMapIndex(self.index_path)
+        self.assertFalse(mmap_index.is_stale())
+        self.index.insert(u'b4.leaf1')
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as file_h:
+            index_file.dump(self.index, file_h)
+        os.rename(tmp_path, self.index_path)
+        self.assertTrue(mmap_index.is_stale())
+        # Existing mapping remains usable after file is replaced
+        self.assertEqual([p for (p, _) in mmap_index.query('*')],
+                         ['b1', 'b2', 'b3'])
+        self.assertEqual([p for (p, _) in MMapIndex(
+            self.index_path).query('*')], ['b1', 'b2', 'b3', 'b4'])
+
+    def test_stats(self):
+        stats = MMapIndex(self.index_path).stats()
+        self.assertEqual(stats['representation'], 'mmap')
+        self.assertEqual(stats['nodes'], self.index.stats()['nodes'])
+        self.assertEqual(stats['leaves'], len(self.all_series))
+        self.assertEqual(stats['size'], os.path.getsize(self.index_path))
+
+    def test_estimate(self):
+        mmap_index = MMapIndex(self.index_path)
+        self.assertEqual(mmap_index.estimate('b1.*.*.*.*'), 6)
+        self.assertTrue(mmap_index.estimate('b1.*.*.*.*', limit=5) > 5)
+        self.assertEqual(mmap_index.estimate('b3.*.*', limit=5), 1)
+
+    def test_invalid_file(self):
+        with open(self.index_path, 'wb') as file_h:
+            file_h.write(b'{"not": "an index"}')
+        self.assertRaises(IndexFileError, MMapIndex, self.index_path)
+        open(self.index_path, 'wb').close()
+        self.assertRaises(IndexFileError, MMapIndex, self.index_path)
+
+
+class CompactIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.all_series = [u'b1.b1.b1.b1.leaf1',
+                           u'b1.b1.b1.b2.leaf1',
+                           u'b1.b1.b2.b2.leaf1',
+                           u'b1.b1.b1.b1.leaf2',
+                           u'b1.b1.b1.b2.leaf2',
+                           u'b1.b1.b2.b2.leaf2',
+                           u'b2.leaf1',
+                           u'b3.b1.leaf1',
+                           ]
+        self.index = NodeTreeIndex()
+        for serie in self.all_series:
+            self.index.insert(serie)
+        self.compact_index = CompactIndex.from_index(self.index)
+
+    def _query(self, index, query):
+        return [(path, node.is_leaf()) for (path, node) in index.query(query)]
+
+    def test_query(self):
+        for query in ['*', '*.*', 'b1.*.*', 'b1.b1.*.*.*', 'b1.b1.b1.b1.*',
+                      'b1.b1.*.*.{leaf1,leaf2}', 'b[1-2].*', 'b?.leaf1',
+                      'b2.leaf1', 'b2', 'b2.leaf1.fake', 'fakey*', 'fakey',
+                      'b1.b1.fake.*', '']:
+            self.assertEqual(self._query(self.compact_index, query),
+                             self._query(self.index, query))
+
+    def test_dump_load(self):
+        file_h = BytesIO()
+        index_file.dump(self.compact_index, file_h)
+        file_h.seek(0)
+        loaded = CompactIndex.from_file(file_h)
+        file_h.seek(0)
+        tree_index = index_file.load(file_h)
+        for query in ['*', '*.*', 'b1.b1.*.*.*', 'b3.b1.leaf1']:
+            self.assertEqual(self._query(loaded, query),
+                             self._query(self.index, query))
+            self.assertEqual(self._query(tree_index, query),
+                             self._query(self.index, query))
+        empty_index = CompactIndex.from_index(NodeTreeIndex())
+        self.assertEqual(list(empty_index.query('*')), [])
+        self.assertEqual(empty_index.stats()['leaves'], 0)
+
+    def test_stats(self):
+        stats = self.compact_index.stats()
+        tree_stats = self.index.stats()
+        self.assertEqual(stats['representation'], 'compact')
+        self.assertEqual(tree_stats['representation'], 'tree')
+        self.assertEqual(stats['nodes'], tree_stats['nodes'])
+        self.assertEqual(stats['leaves'], len(self.all_series))
+        self.assertEqual(tree_stats['leaves'], len(self.all_series))
+        # Node names are interned
+        self.assertEqual(stats['strings'], 5)
+        self.assertEqual(tree_stats['strings'], tree_stats['nodes'] - 1)
+        self.assertTrue(stats['size'] < tree_stats['size'])
+
+    def test_query_many(self):
+        queries = ['*', '*.*', 'b1.*.*', 'b1.b1.*.*.*', 'b1.b1.b1.b1.*',
+                   'b1.b1.*.*.{leaf1,leaf2}', 'b2.leaf1', 'fakey*']
+        results = self.compact_index.query_many(queries)
+        for query in queries:
+            self.assertEqual(
+                [(path, node.is_leaf()) for (path, node) in results[query]],
+                self._query(self.index, query))
+
+    def test_estimate(self):
+        file_h = BytesIO()
+        index_file.dump(self.index, file_h)
+        loaded = index_file.load(BytesIO(file_h.getvalue()))
+        for query in ['*', '*.*', 'b1.*.*', 'b1.b1.*.*.*', 'b3.*.*', 'fakey']:
+            expected = len(list(self.index.query(query)))
+            self.assertEqual(self.compact_index.estimate(query), expected)
+            self.assertEqual(loaded.estimate(query), expected)
+        self.assertEqual(self.compact_index.estimate('b1.b1.b2.*.*', limit=2),
+                         2)
+        # Leaf counts of loaded tree index
+        self.assertEqual(list(loaded.query('b1.b1'))[0][1].leaf_count(), 6)
+
+    @unittest.skipUnless(NODE_TRIE, "NodeTrie extension not enabled")
+    def test_c_index(self):
+        c_index = Node()
+        for serie in self.all_series:
+            c_index.insert(serie)
+        compact_index = CompactIndex.from_index(c_index)
+        for query in ['*', '*.*', 'b1.*.*', 'b1.b1.*.*.{leaf1,leaf2}']:
+            self.assertEqual(self._query(compact_index, query),
+                             self._query(self.index, query))
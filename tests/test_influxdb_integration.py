@@ -10,6 +10,7 @@ from gzip import GzipFile
 from random import randint
 import logging
 import fcntl
+import threading
 from retrying import retry
 
 from influxdb import InfluxDBClient
@@ -22,7 +23,10 @@ from influxgraph.constants import SERIES_LOADER_MUTEX_KEY, \
      MEMCACHE_SERIES_DEFAULT_TTL, LOADER_LIMIT, DEFAULT_AGGREGATIONS, \
      _INFLUXDB_CLIENT_PARAMS, FILE_LOCK
 from influxgraph.classes.finder import logger as finder_logger, \
-    _SERIES_LOADER_LOCK
+    _SERIES_LOADER_LOCK, FindResultsLimitError
+from influxgraph.classes import index_file
+from influxgraph.classes.lock import FileLock
+from influxgraph.classes.tree import NodeTreeIndex
 import memcache
 
 finder_logger.setLevel(logging.DEBUG)
@@ -844,8 +848,6 @@ class InfluxGraphIntegrationTestCase(unittest.TestCase):
         except OSError:
             pass
 
-    @unittest.skipUnless(hasattr(Node, 'to_array'),
-                         "Index does not support dumping to array")
     def test_index_save_load(self):
         self.finder.index = None
         try:
@@ -867,14 +869,14 @@ class InfluxGraphIntegrationTestCase(unittest.TestCase):
         finder.index_path = 'index'
         finder.save_index()
         index_path = finder.index_path
-        finder_index = Node.from_array(finder.index.to_array())
+        finder_index = finder.index
         time.sleep(config['influxdb']['reindex_interval'] + 1)
         del finder
         self.assertTrue(os.path.isfile('index'))
         # Reload index from file
-        index_fh = open(index_path, 'rt')
+        index_fh = open(index_path, 'rb')
         try:
-            index = Node.from_file(index_fh)
+            index = index_file.load(index_fh)
         finally:
             index_fh.close()
         self.assertTrue(index is not None)
@@ -882,6 +884,266 @@ class InfluxGraphIntegrationTestCase(unittest.TestCase):
             self.assertEqual([path for (path, _) in index.query(query)],
                              [path for (path, _) in finder_index.query(query)])
 
+    def test_find_cache(self):
+        query = Query('integration_test.*')
+        nodes = list(self.finder.find_nodes(query))
+        generation = self.finder.index_generation
+        self.assertTrue(nodes)
+        cached_nodes = list(self.finder.find_nodes(query))
+        self.assertEqual(len(nodes), len(cached_nodes))
+        for node, cached_node in zip(nodes, cached_nodes):
+            self.assertTrue(node is cached_node)
+        self.finder.build_index()
+        self.assertEqual(self.finder.index_generation, generation + 1)
+        self.assertFalse(list(self.finder.find_nodes(query))[0] is nodes[0])
+        del self.finder
+        config = self.config.copy()
+        config['influxdb'] = dict(config['influxdb'], find_cache_size=0)
+        finder = influxgraph.InfluxDBFinder(config)
+        self.assertTrue(finder.find_cache is None)
+        self.assertEqual([n.path for n in finder.find_nodes(query)],
+                         [n.path for n in nodes])
+
+    def test_find_nodes_offset_limit(self):
+        query = Query('integration_test.*.*')
+        paths = [n.path for n in self.finder.find_nodes(query)]
+        self.assertEqual(len(paths), 4)
+        self.assertEqual(paths, sorted(paths))
+        self.assertEqual([n.path for n in self.finder.find_nodes(
+            query, offset=1, limit=2)], paths[1:3])
+        self.assertEqual([n.path for n in self.finder.find_nodes(
+            query, offset=3)], paths[3:])
+        self.finder.find_cache = None
+        self.assertEqual([n.path for n in self.finder.find_nodes(
+            query, limit=1)], paths[:1])
+
+    def test_find_many_nodes(self):
+        queries = [Query('integration_test.*.*'), Query('integration_test.*'),
+                   Query('integration_test.agg_path.m*'),
+                   Query('integration_test.*')]
+        results = self.finder.find_many_nodes(queries)
+        self.assertEqual(len(results), 3)
+        for query in queries:
+            self.assertEqual([n.path for n in results[query.pattern]],
+                             [n.path for n in self.finder.find_nodes(query)])
+        # Results are cached
+        self.assertTrue(self.finder.find_many_nodes(queries[:1])[
+            queries[0].pattern] is results[queries[0].pattern])
+        self.finder.find_cache = None
+        self.finder.max_find_results = 2
+        self.assertEqual(len(self.finder.find_many_nodes(queries[:1])[
+            queries[0].pattern]), 2)
+
+    def test_max_find_results(self):
+        query = Query('integration_test.*.*')
+        self.finder.find_cache = None
+        self.finder.max_find_results = 3
+        self.assertEqual([n.path for n in self.finder.find_nodes(query)],
+                         ['integration_test.agg_path.last',
+                          'integration_test.agg_path.max',
+                          'integration_test.agg_path.min'])
+        self.assertEqual(len(list(self.finder.find_nodes(
+            Query('integration_test.*')))), 3)
+        self.finder.truncate_find_results = False
+        # Raised by find call, before results are iterated
+        self.assertRaises(FindResultsLimitError, self.finder.find_nodes,
+                          query)
+        self.finder.max_find_results = 4
+        self.assertEqual(len(list(self.finder.find_nodes(query))), 4)
+        config = self.config.copy()
+        config['influxdb'] = dict(config['influxdb'], max_find_results=-1)
+        self.assertRaises(Exception, influxgraph.InfluxDBFinder, config)
+
+    def test_parallel_index_build(self):
+        data = self.finder.get_all_series()
+        self.finder.index_build_processes = 2
+        # One page per series
+        self.finder.loader_limit = 1
+        index, _ = self.finder._parse_series(
+            self.finder._split_pages(data), None, b'.')
+        for query in ['*', '*.*', '*.*.*']:
+            self.assertEqual(
+                [(path, node.is_leaf()) for (path, node) in index.query(query)],
+                [(path, node.is_leaf())
+                 for (path, node) in self.finder.index.query(query)])
+        config = self.config.copy()
+        config['influxdb'] = dict(config['influxdb'], index_build_processes=0)
+        self.assertRaises(Exception, influxgraph.InfluxDBFinder, config)
+
+    def test_index_update(self):
+        # Series are not kept between builds unless enabled
+        self.assertTrue(self.finder.index_series is None)
+        self.finder.index_incremental = True
+        self.finder.build_index()
+        self.assertTrue(self.finder.index_series is None or
+                        self.finder.index_series[0] is self.finder.index)
+        new_serie = 'integration_test.new_branch.leaf_node1'
+        self.assertTrue(self.client.write_points([{
+            "measurement": new_serie, "tags": {},
+            "time": self.end_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "fields": {"value": 1}}]))
+        self.finder.build_index()
+        self.assertEqual([n.path for n in self.finder.find_nodes(
+            Query('integration_test.new_branch.*'))], [new_serie])
+        self.client.query('DROP SERIES FROM "%s"' % (new_serie,))
+        self.client.query('DROP SERIES FROM "%s"' % (self.series1,))
+        self.finder.build_index()
+        self.assertEqual(list(self.finder.find_nodes(
+            Query('integration_test.new_branch'))), [])
+        self.assertEqual(sorted([n.path for n in self.finder.find_nodes(
+            Query('integration_test.*'))]),
+                         ['integration_test.agg_path',
+                          self.series2])
+
+    def test_index_mmap(self):
+        index_path = 'mmap_index'
+        try:
+            os.unlink(index_path)
+        except OSError:
+            pass
+        config = { 'influxdb': { 'host' : 'localhost',
+                                 'port' : 8086,
+                                 'user' : 'root',
+                                 'pass' : 'root',
+                                 'db' : self.db_name,
+                                 'index_mmap': True,
+                                 'log_level': 0,
+                                 'fill': 'previous',
+                                 },
+                   'search_index': index_path,
+                   }
+        finder = influxgraph.InfluxDBFinder(config)
+        self.assertTrue(isinstance(finder.index, index_file.MMapIndex))
+        self.assertTrue(os.path.isfile(index_path))
+        for query in ['*', '*.*', '*.*.*', '*.*.*.*']:
+            self.assertEqual(
+                [n.path for n in finder.find_nodes(Query(query))],
+                [n.path for n in self.finder.find_nodes(Query(query))])
+        # Index file written within re-index interval is re-used
+        # without re-building
+        other_finder = influxgraph.InfluxDBFinder(config)
+        self.assertEqual(other_finder.index.file_id, finder.index.file_id)
+        del config['search_index']
+        self.assertRaises(Exception, influxgraph.InfluxDBFinder, config)
+        os.unlink(index_path)
+
+    def test_index_compact(self):
+        config = self.config.copy()
+        config['influxdb'] = dict(config['influxdb'], index_compact=True)
+        finder = influxgraph.InfluxDBFinder(config)
+        self.assertTrue(isinstance(finder.index, index_file.CompactIndex))
+        for query in ['*', '*.*', '*.*.*', 'integration_test.{agg_path,x}.*']:
+            self.assertEqual(
+                [n.path for n in finder.find_nodes(Query(query))],
+                [n.path for n in self.finder.find_nodes(Query(query))])
+        stats = finder.index_stats()
+        self.assertEqual(stats['representation'], 'compact')
+        self.assertEqual(stats['leaves'], len(self.series))
+        self.assertEqual(stats['nodes'], self.finder.index_stats()['nodes'])
+        # Index file is loaded as compact index
+        finder.index = None
+        finder.load_index()
+        self.assertTrue(isinstance(finder.index, index_file.CompactIndex))
+        finder.build_index()
+        self.assertTrue(isinstance(finder.index, index_file.CompactIndex))
+
+    def test_series_horizon(self):
+        # Series with data older than horizon only
+        old_time = (self.end_time - datetime.timedelta(days=30)).strftime(
+            "%Y-%m-%dT%H:%M:%SZ")
+        self.assertTrue(self.client.write_points([{
+            "measurement": "integration_test.stale.leaf_node1",
+            "tags": {}, "time": old_time, "fields": {"value": 1}}]))
+        self.finder.build_index()
+        self.assertEqual(len(list(self.finder.find_nodes(
+            Query('integration_test.stale.*')))), 1)
+        config = self.config.copy()
+        config['influxdb'] = dict(config['influxdb'], series_horizon='7d')
+        finder = influxgraph.InfluxDBFinder(config)
+        self.assertEqual(list(finder.find_nodes(
+            Query('integration_test.stale.*'))), [])
+        self.assertEqual(
+            [n.path for n in finder.find_nodes(Query('integration_test.*'))],
+            [n.path for n in self.finder.find_nodes(
+                Query('integration_test.*')) if n.path !=
+             'integration_test.stale'])
+        # Estimated from series cardinality by default
+        self.assertTrue(finder.series_pruned is not None)
+        config['influxdb'] = dict(config['influxdb'], series_pruned_exact=True)
+        finder = influxgraph.InfluxDBFinder(config)
+        self.assertEqual(finder.series_pruned, 1)
+        self.assertEqual(finder.index_stats()['series_pruned'], 1)
+        config['influxdb'] = dict(config['influxdb'], series_horizon='7 days')
+        self.assertRaises(Exception, influxgraph.InfluxDBFinder, config)
+
+    def test_index_build_in_other_process(self):
+        # Lock held by another process building index
+        other_lock = FileLock(self.finder.index_lock.filename)
+        self.assertTrue(other_lock.acquire(blocking=False))
+        try:
+            builder = threading.Thread(target=self.finder.build_index)
+            builder.start()
+            time.sleep(.5)
+            self.assertTrue(builder.is_alive())
+            # Queries are served from current index while waiting
+            self.assertEqual([n.path for n in self.finder.find_nodes(
+                Query('integration_test.leaf_node1'))], [self.series1])
+            published = NodeTreeIndex()
+            published.insert('published.leaf_node1')
+            tmp_path = self.finder.index_path + '.tmp'
+            with open(tmp_path, 'wb') as index_fh:
+                index_file.dump(published, index_fh)
+            os.rename(tmp_path, self.finder.index_path)
+        finally:
+            other_lock.release()
+        builder.join()
+        # Index published by other process is loaded instead of built
+        self.assertEqual([n.path for n in self.finder.find_nodes(Query('*'))],
+                         ['published'])
+
+    def test_index_warm_start(self):
+        published = NodeTreeIndex()
+        published.insert('published.leaf_node1')
+        with open(self.finder.index_path, 'wb') as index_fh:
+            index_file.dump(published, index_fh)
+        # Hold lock so background re-build waits
+        other_lock = FileLock(self.finder.index_lock.filename)
+        self.assertTrue(other_lock.acquire(blocking=False))
+        try:
+            finder = influxgraph.InfluxDBFinder(self.config)
+            self.assertTrue(isinstance(finder.index,
+                                       type(self.finder.index)))
+            self.assertEqual([n.path for n in finder.find_nodes(Query('*'))],
+                             ['published'])
+        finally:
+            other_lock.release()
+
+    def test_index_warm_start_shared_file(self):
+        # Index file written by other finder within re-index interval
+        index_path = self.finder.index_path
+        self.assertTrue(os.path.isfile(index_path))
+        data = [{"measurement": "new_series",
+                 "tags": {},
+                 "time": self.end_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                 "fields": {"value": 1}}]
+        self.assertTrue(self.client.write_points(data))
+        finder = influxgraph.InfluxDBFinder(self.config)
+        self.assertEqual(finder.index_file_mtime,
+                         os.stat(index_path).st_mtime)
+        time.sleep(2)
+        # Not re-built from InfluxDB until file is due to be re-built
+        self.assertEqual(list(finder.find_nodes(Query('new_series'))), [])
+        # Index file older than re-index interval is re-built straight away
+        mtime = time.time() - self.finder.reindex_interval - 1
+        os.utime(index_path, (mtime, mtime))
+        finder = influxgraph.InfluxDBFinder(self.config)
+        for _ in range(10):
+            if list(finder.find_nodes(Query('new_series'))):
+                break
+            time.sleep(.5)
+        self.assertEqual([n.path for n in finder.find_nodes(
+            Query('new_series'))], ['new_series'])
+
     def test_index_load_from_file(self):
         values = [['carbon.relays.host.dispatcher1.wallTime_us'],
                   ['carbon.relays.host.metricsReceived'],
@@ -161,6 +161,19 @@ class InfluxGraphTemplatesIntegrationTestCase(unittest.TestCase):
                         msg="Expected %s datapoints for %s - got %s" % (
                             self.num_datapoints, serie, len(datapoints),))
 
+    def test_node_series_resolved_once(self):
+        serie = self.graphite_series[0]
+        nodes = list(self.finder.find_nodes(Query(serie)))
+        self.assertEqual(nodes[0].series, None)
+        data = self._test_data_in_nodes(nodes)
+        series = nodes[0].series
+        self.assertEqual(series[0], 0)
+        # Nodes from find cache keep their resolved series
+        cached_nodes = list(self.finder.find_nodes(Query(serie)))
+        self.assertTrue(cached_nodes[0] is nodes[0])
+        self.assertEqual(self._test_data_in_nodes(cached_nodes), data)
+        self.assertTrue(cached_nodes[0].series is series)
+
     def test_template_drop_path_part(self):
         del self.finder
         template = "..measurement*"
@@ -0,0 +1,28 @@
+import os
+import unittest
+import tempfile
+import shutil
+
+from influxgraph.classes.lock import FileLock
+
+
+class FileLockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.lock_file = os.path.join(self.tmp_dir, 'lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_non_blocking_acquire(self):
+        lock, other_lock = FileLock(self.lock_file), FileLock(self.lock_file)
+        self.assertTrue(lock.acquire(blocking=False))
+        self.assertFalse(other_lock.acquire(blocking=False))
+        lock.release()
+        self.assertTrue(other_lock.acquire(blocking=False))
+        other_lock.release()
+        with lock:
+            self.assertFalse(other_lock.acquire(blocking=False))
+        self.assertTrue(other_lock.acquire())
+        other_lock.release()
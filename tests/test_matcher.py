@@ -0,0 +1,79 @@
+import unittest
+
+from graphite_api.finders import match_entries
+
+from influxgraph.classes.matcher import compile_query, compile_sub_query, \
+     query_nodes, query_many_nodes, LiteralMatcher, AnyMatcher, PrefixMatcher, \
+     SuffixMatcher, AlternationMatcher, PatternMatcher
+from influxgraph.classes.tree import NodeTreeIndex
+try:
+    from influxgraph.ext.nodetrie import Node
+except ImportError:
+    NODE_TRIE = False
+else:
+    NODE_TRIE = True
+
+
+class MatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.names = [u'host1', u'host2', u'host10', u'host', u'hos',
+                      u'ahost1', u'cpu', u'cpu_load', u'b1', u'{a,b}',
+                      u'h[1', u'', u'été']
+
+    def test_matcher_types(self):
+        for sub_query, matcher_type in [
+                ('host1', LiteralMatcher), ('*', AnyMatcher),
+                ('host*', PrefixMatcher), ('*1', SuffixMatcher),
+                ('{host1,cpu}', AlternationMatcher),
+                ('host{1,2}', AlternationMatcher),
+                ('host?', PatternMatcher), ('h[o]st*', PatternMatcher),
+                ('*os*', PatternMatcher), ('{host*,cpu}', PatternMatcher)]:
+            self.assertTrue(isinstance(compile_sub_query(sub_query),
+                                       matcher_type), msg=sub_query)
+        self.assertEqual(compile_sub_query('host{1,2}').prefix, 'host')
+        self.assertEqual(compile_sub_query('h{o*,os}t').prefix, 'ho')
+        self.assertEqual(compile_sub_query('*os*').substrings, ('os',))
+        self.assertEqual(compile_sub_query('h[o]st?1*').substrings,
+                         ('h', 'st', '1'))
+        self.assertEqual(compile_sub_query('{host*,cpu}').substrings, ())
+
+    def test_match_entries_equivalence(self):
+        for sub_query in ['host1', '*', 'host*', '*1', 'host?', 'host??',
+                          '{host1,cpu}', 'host{1,2}', 'h{o*,os}t*',
+                          'h[o]st*', 'host[!1]', 'host[0-9]*', '*os*',
+                          '{a,b}', 'h[1', '{a,b', 'cpu*load', '**',
+                          u'é*', '{,host}', '{}']:
+            matcher = compile_sub_query(sub_query)
+            self.assertEqual(
+                sorted(name for name in self.names if matcher.match(name)),
+                sorted(match_entries(self.names, sub_query)),
+                msg=sub_query)
+
+    def test_compile_query_cache(self):
+        matchers = compile_query('a.b*.{c,d}')
+        self.assertEqual(len(matchers), 3)
+        self.assertTrue(compile_query('a.b*.{c,d}') is matchers)
+
+    @unittest.skipUnless(NODE_TRIE, "NodeTrie extension not enabled")
+    def test_c_query_nodes(self):
+        c_index = Node()
+        py_index = NodeTreeIndex()
+        for serie in ['b1.b1.leaf1', 'b1.b2.leaf1', 'b1.b2.leaf2',
+                      'b2.leaf1', 'host1.cpu', 'host10.cpu']:
+            c_index.insert(serie)
+            py_index.insert(serie)
+        for query in ['*', '*.*', 'b1.*.*', 'b1.b{1,2}.leaf?', 'host1*.cpu',
+                      'b2.leaf1', 'fakey*', 'b1.b2.leaf[12]']:
+            self.assertEqual(
+                [(path, node.is_leaf())
+                 for (path, node) in query_nodes(c_index, query)],
+                [(path, node.is_leaf())
+                 for (path, node) in py_index.query(query)])
+        queries = ['b1.*.*', 'b1.b{1,2}.leaf?', 'b1.b2.*', 'b1.b2.*', 'b*',
+                   'fakey*']
+        results = query_many_nodes(c_index, queries)
+        self.assertEqual(sorted(results.keys()), sorted(set(queries)))
+        for query in queries:
+            self.assertEqual([path for (path, _) in results[query]],
+                             [path for (path, _) in py_index.query(query)])
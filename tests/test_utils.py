@@ -1,5 +1,7 @@
+import re
 import unittest
 import influxgraph.utils
+from influxdb.resultset import ResultSet
 from influxgraph.constants import DEFAULT_AGGREGATIONS
 import datetime
 
@@ -68,3 +70,220 @@ class InfluxGraphUtilsTestCase(unittest.TestCase):
 
     def test_parse_empty_template(self):
         self.assertFalse(influxgraph.templates.parse_influxdb_graphite_templates(['']))
+
+    def test_get_serie_paths(self):
+        self.assertEqual(influxgraph.utils.get_serie_paths(
+            u'cpu.load,host=h1', None, None), [(u'cpu', u'load')])
+        templates = influxgraph.templates.parse_influxdb_graphite_templates(
+            ['host.measurement.field*'])
+        self.assertEqual(sorted(influxgraph.utils.get_serie_paths(
+            u'cpu,host=h1', {u'cpu': [u'load', u'idle']}, templates)),
+                         [(u'h1', u'cpu', u'idle'), (u'h1', u'cpu', u'load')])
+        measurements = influxgraph.utils.group_series_by_measurement(
+            [u'cpu,host=h1', u'cpu,host=h2', u'mem,host=h1', u'a.b'])
+        self.assertEqual(measurements, {u'cpu': set([u'cpu,host=h1', u'cpu,host=h2']),
+                                        u'mem': set([u'mem,host=h1']),
+                                        u'a.b': set([u'a.b'])})
+
+    def test_template_candidates(self):
+        templates = influxgraph.templates.parse_influxdb_graphite_templates(
+            ['k%s.host.measurement.field*' % (i,) for i in range(50)] + [
+                'h1.* host.measurement.k1', 'host.measurement.field*',
+                'measurement*'])
+        fields = {u'cpu': [u'load', u'idle']}
+        series = [u'cpu,host=h1,k7=v', u'cpu,host=h1,k1=v', u'cpu,host=h2',
+                  u'cpu,k49=v,host=h3', u'cpu,dc=d1', u'a.b.c', u'cpu']
+        for serie in series:
+            self.assertEqual(
+                influxgraph.utils.get_serie_paths(serie, fields, templates),
+                influxgraph.utils.get_serie_paths(
+                    serie, fields, list(templates)))
+        self.assertEqual(
+            sorted(influxgraph.utils.get_serie_paths(
+                u'cpu,host=h1,k7=v', fields, templates)),
+            [(u'v', u'h1', u'cpu', u'idle'), (u'v', u'h1', u'cpu', u'load')])
+        # Only templates with series tag keys are tried, in template order
+        self.assertEqual(
+            [tmpl for (_, tmpl, _, _) in templates.candidates(
+                (u'host', u'k7'))],
+            [templates[7][1], templates[51][1], templates[52][1]])
+        self.assertEqual(templates.candidates(()), [templates[52]])
+
+    def test_template_positions(self):
+        template = influxgraph.templates._generate_template_tag_index(
+            'host.dc..measurement.host.field*')
+        self.assertEqual(template.positions, {'host': [0, 4], 'dc': [1],
+                                              'measurement': [3],
+                                              'field*': [5]})
+        self.assertEqual((template.num_items, template.field_inds), (5, 1))
+        self.assertEqual(template.make_path(
+            u'cpu', [[u'dc', u'd1'], [u'host', u'h1']]),
+                         [u'h1', u'd1', u'cpu', u'h1'])
+        self.assertEqual(template.make_path(u'cpu', []), [u'cpu'])
+        # Tag keys repeated in series or naming measurement are matched
+        # one by one
+        self.assertTrue(template.make_path(
+            u'cpu', [[u'host', u'h1'], [u'host', u'h2']]) is None)
+        self.assertTrue(template.make_path(
+            u'cpu', [[u'measurement', u'm']]) is None)
+        templates = influxgraph.templates.parse_influxdb_graphite_templates(
+            ['host.dc..measurement.host.field*'])
+        fields = {u'cpu': [u'load']}
+        for serie in [u'cpu,dc=d1,host=h1', u'cpu,host=h1', u'cpu',
+                      u'cpu,host=h1,measurement=m']:
+            self.assertEqual(
+                influxgraph.utils.get_serie_paths(serie, fields, templates),
+                influxgraph.utils.get_serie_paths(serie, fields, [
+                    (_filter, dict(tmpl), default_tags, separator)
+                    for (_filter, tmpl, default_tags, separator)
+                    in templates]))
+
+    def test_field_suffixes(self):
+        templates = influxgraph.templates.parse_influxdb_graphite_templates(
+            ['host.measurement.field*'])
+        fields = {u'cpu': [u'value', u'load', u'a.value', u'x.y']}
+        field_suffixes = {}
+        for host in [u'h1', u'h2']:
+            self.assertEqual(influxgraph.utils.get_serie_paths(
+                u'cpu,host=%s' % (host,), fields, templates,
+                field_suffixes=field_suffixes),
+                             [(host, u'cpu', u'load'), (host, u'cpu', u'a'),
+                              (host, u'cpu', u'x', u'y')])
+        self.assertEqual(field_suffixes,
+                         {u'cpu': [[u'load'], [u'a'], [u'x', u'y']]})
+        # Measurements not in field keys are not cached
+        self.assertEqual(influxgraph.utils.get_serie_paths(
+            u'mem,host=h1', fields, templates,
+            field_suffixes=field_suffixes), [])
+        self.assertEqual(list(field_suffixes), [u'cpu'])
+
+    def test_parse_series_incremental(self):
+        series = [u'b1.b1.leaf1', u'b1.b2.leaf1', u'b2.leaf1', u'b3']
+        index = influxgraph.utils.parse_series(series[:2], None, None)
+        self.assertTrue(influxgraph.utils.parse_series(
+            series[2:], None, None, index=index) is index)
+        self.assertEqual([path for (path, _) in index.query('*')],
+                         [u'b1', u'b2', u'b3'])
+
+    def test_prefetch(self):
+        self.assertEqual(list(influxgraph.utils.prefetch(iter(range(10)))),
+                         list(range(10)))
+        self.assertEqual(list(influxgraph.utils.prefetch([], size=2)), [])
+        def _failing():
+            yield 1
+            raise ValueError("Failed")
+        items = influxgraph.utils.prefetch(_failing())
+        self.assertEqual(next(items), 1)
+        self.assertRaises(ValueError, next, items)
+        # Consumer stopping early stops retrieval
+        items = influxgraph.utils.prefetch(iter(range(100)))
+        self.assertEqual(next(items), 0)
+        items.close()
+
+    def test_read_influxdb_values(self):
+        measurement_data = {'load': {
+            'tag_keys': set(['host']), 'fields': ['value'],
+            'series': {(frozenset([('host', 'h1')]), 'value'): 'h1.load',
+                       (frozenset([('host', 'h2')]), 'value'): 'h2.load'}}}
+        # Series returned in different order than paths, with group by
+        # tags not in template
+        data = ResultSet({'series': [
+            {'name': 'load', 'tags': {'host': 'h2', 'dc': ''},
+             'columns': ['time', 'value'], 'values': [[0, 2]]},
+            {'name': 'load', 'tags': {'host': 'h1', 'dc': ''},
+             'columns': ['time', 'value'], 'values': [[0, 1]]},
+            {'name': 'load', 'tags': {'host': 'h3', 'dc': ''},
+             'columns': ['time', 'value'], 'values': [[0, 3]]},
+            {'name': 'cpu', 'tags': {'host': 'h1', 'dc': ''},
+             'columns': ['time', 'value'], 'values': [[0, 4]]},
+            ]})
+        self.assertEqual(influxgraph.utils.read_influxdb_values(
+            data, ['h1.load', 'h2.load'], measurement_data),
+                         {'h1.load': [1], 'h2.load': [2]})
+
+    def _select(self, clause, all_tag_sets):
+        """Return tag sets selected by InfluxQL tag condition"""
+        expr = re.sub(r""""(\w+)" = '(\w*)'""",
+                      r"tags.get('\1', '') == '\2'", clause)
+        expr = expr.replace(' AND ', ' and ').replace(' OR ', ' or ')
+        return [tag_set for tag_set in all_tag_sets
+                if eval(expr, {'tags': dict(tag_set)})]
+
+    def test_gen_tag_sets_clause(self):
+        all_tag_sets = [(('dc', dc), ('host', host), ('cpu', cpu))
+                        for dc in ['dc1', 'dc2', 'dc3']
+                        for host in ['a', 'b', 'c']
+                        for cpu in ['cpu0', 'cpu1']]
+        requests = [
+            [(('dc', 'dc1'), ('host', 'a'), ('cpu', 'cpu0')),
+             (('dc', 'dc2'), ('host', 'b'), ('cpu', 'cpu1'))],
+            [(('dc', 'dc1'), ('host', 'a'), ('cpu', 'cpu0')),
+             (('dc', 'dc1'), ('host', 'a'), ('cpu', 'cpu1')),
+             (('dc', 'dc1'), ('host', 'b'), ('cpu', 'cpu0')),
+             (('dc', 'dc1'), ('host', 'b'), ('cpu', 'cpu1')),
+             (('dc', 'dc3'), ('host', 'c'), ('cpu', 'cpu1'))],
+            all_tag_sets[:12],
+            all_tag_sets[::5],
+            ]
+        for tag_sets in requests:
+            clause = influxgraph.utils.gen_tag_sets_clause(tag_sets)
+            self.assertEqual(self._select(clause, all_tag_sets),
+                             [tag_set for tag_set in all_tag_sets
+                              if tag_set in tag_sets])
+        # Cross product of tag values is factored into single condition
+        self.assertEqual(influxgraph.utils.gen_tag_sets_clause(
+            [(('dc', dc), ('host', host))
+             for dc in ['dc1', 'dc2'] for host in ['a', 'b']]),
+            """("dc" = 'dc1' OR "dc" = 'dc2') AND """
+            """("host" = 'a' OR "host" = 'b')""")
+        # Tag sets with different tag keys
+        tag_sets = [(('dc', 'dc1'), ('host', 'a')), (('host', 'b'),)]
+        clause = influxgraph.utils.gen_tag_sets_clause(tag_sets)
+        self.assertEqual(self._select(clause, [
+            (('dc', 'dc1'), ('host', 'a')), (('dc', 'dc2'), ('host', 'a')),
+            (('host', 'b'),), (('dc', 'dc1'), ('host', 'b'))]),
+            [(('dc', 'dc1'), ('host', 'a')), (('host', 'b'),),
+             (('dc', 'dc1'), ('host', 'b'))])
+        self.assertEqual(influxgraph.utils.gen_tag_sets_clause([()]), None)
+
+    def test_gen_tag_sets_clause_regex(self):
+        tag_sets = [(('dc', 'dc1'), ('host', host))
+                    for host in ['a', 'b', 'c.d/e']]
+        self.assertEqual(influxgraph.utils.gen_tag_sets_clause(
+            tag_sets, regex_min_values=3),
+            """("dc" = 'dc1') AND ("host" =~ /^(a|b|c\\.d\\/e)$/)""")
+        self.assertEqual(influxgraph.utils.gen_tag_sets_clause(
+            tag_sets, regex_min_values=4),
+            influxgraph.utils.gen_tag_sets_clause(tag_sets))
+
+    def test_gen_tag_sets_clause_known_values(self):
+        all_tag_sets = [(('dc', dc), ('host', host))
+                        for dc in ['dc1', 'dc2'] for host in ['a', 'b']] + \
+            [(('dc', 'dc3'), ('host', 'c'))]
+
+        def known_values(tag, context):
+            context = dict(context)
+            return frozenset(
+                value for tag_set in all_tag_sets
+                for (_tag, value) in tag_set if _tag == tag and
+                all(dict(tag_set)[_tag] in values
+                    for (_tag, values) in context.items()))
+        order = ['dc', 'host']
+        for tag_sets, expected in [
+                (all_tag_sets, None),
+                (all_tag_sets[:4], """("dc" = 'dc1' OR "dc" = 'dc2')""")]:
+            self.assertEqual(influxgraph.utils.gen_tag_sets_clause(
+                tag_sets, known_values=known_values, tag_order=order.index),
+                             expected)
+        # Not all known hosts of dc2 requested
+        clause = influxgraph.utils.gen_tag_sets_clause(
+            all_tag_sets[:3], known_values=known_values,
+            tag_order=order.index)
+        self.assertEqual(self._select(clause, all_tag_sets),
+                         all_tag_sets[:3])
+        # No known values of tag is not all of them requested
+        clause = influxgraph.utils.gen_tag_sets_clause(
+            all_tag_sets, known_values=lambda tag, context: frozenset())
+        self.assertEqual(self._select(clause, all_tag_sets), all_tag_sets)
+        self.assertEqual(self._select(clause, all_tag_sets + [
+            (('dc', 'dc4'), ('host', 'd'))]), all_tag_sets)